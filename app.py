@@ -19,8 +19,9 @@ from .gradio_utils.traj_utils import (OBJECT_MOTION_MODE, get_provided_traj,
 from .gradio_utils.utils import vis_camera
 from .lvdm.models.samplers.ddim import DDIMSampler
 from .main.evaluation.motionctrl_inference import (DEFAULT_NEGATIVE_PROMPT,
-                                                  load_model_checkpoint,
-                                                  post_prompt)
+                                                  load_model, post_prompt,
+                                                  sample_variants)
+from .utils.cond_cache import get_cond_cache
 from .utils.utils import instantiate_from_config
 
 os.environ['KMP_DUPLICATE_LIB_OK']='True'
@@ -298,14 +299,7 @@ def fn_traj_reset():
 model_path='./checkpoints/motionctrl.pth'
 config_path='./configs/inference/config_both.yaml'
 
-config = OmegaConf.load(config_path)
-model_config = config.pop("model", OmegaConf.create())
-model = instantiate_from_config(model_config)
-if torch.cuda.is_available():
-    model = model.cuda()
-
-model = load_model_checkpoint(model, model_path)
-model.eval()
+model = load_model(config_path, model_path)
 
 
 def model_run(prompts, infer_mode, seed, n_samples):
@@ -368,51 +362,41 @@ def model_run(prompts, infer_mode, seed, n_samples):
     for i in range(len(prompts)):
         prompts[i] = f'{prompts[i]}, {post_prompt}'
 
-    cond = model.get_learned_conditioning(prompts)
+    cond_cache = get_cond_cache()
+    cond = cond_cache.get_learned_conditioning(model, prompts)
     if camera_poses is not None:
         RT = camera_poses[..., None]
     else:
         RT = None
 
     if trajs is not None:
-        traj_features = model.get_traj_features(trajs)
+        traj_features = cond_cache.get_traj_features(model, trajs)
     else:
         traj_features = None
 
     if unconditional_guidance_scale != 1.0:
         # prompts = batch_size * [""]
         prompts = batch_size * [DEFAULT_NEGATIVE_PROMPT]
-        uc = model.get_learned_conditioning(prompts)
+        uc = cond_cache.get_learned_conditioning(model, prompts)
         if traj_features is not None:
-            un_motion = model.get_traj_features(torch.zeros_like(trajs))
+            un_motion = cond_cache.get_uncond_traj_features(model, trajs)
         else:
             un_motion = None
         uc = {"features_adapter": un_motion, "uc": uc}
     else:
         uc = None
 
-    batch_variants = []
-    for _ in range(n_samples):
-        if ddim_sampler is not None:
-            samples, _ = ddim_sampler.sample(S=ddim_steps,
-                                            conditioning=cond,
-                                            batch_size=noise_shape[0],
-                                            shape=noise_shape[1:],
-                                            verbose=False,
-                                            unconditional_guidance_scale=unconditional_guidance_scale,
-                                            unconditional_conditioning=uc,
-                                            eta=ddim_eta,
-                                            temporal_length=noise_shape[2],
-                                            conditional_guidance_scale_temporal=unconditional_guidance_scale_temporal,
-                                            features_adapter=traj_features,
-                                            pose_emb=RT,
-                                            cond_T=cond_T
-                                            )        
-        ## reconstruct from latent to pixel space
-        batch_images = model.decode_first_stage(samples)
-        batch_variants.append(batch_images)
-    ## variants, batch, c, t, h, w
-    batch_variants = torch.stack(batch_variants, dim=1)
+    ## all variants in one batched run, variant i seeded with seed+i when there are several
+    batch_variants, _ = sample_variants(model, ddim_sampler, cond, uc, noise_shape,
+                                        n_samples=n_samples,
+                                        seed=seed,
+                                        ddim_steps=ddim_steps,
+                                        unconditional_guidance_scale=unconditional_guidance_scale,
+                                        eta=ddim_eta,
+                                        conditional_guidance_scale_temporal=unconditional_guidance_scale_temporal,
+                                        features_adapter=traj_features,
+                                        pose_emb=RT,
+                                        cond_T=cond_T)
     batch_variants = batch_variants[0]
     
     # file_path = save_results(batch_variants, "MotionCtrl", "gradio_temp", fps=10)
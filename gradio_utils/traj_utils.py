@@ -1,3 +1,6 @@
+import time
+from functools import lru_cache
+
 import cv2
 import numpy as np
 
@@ -78,7 +81,8 @@ def process_points(points,frames=16):
         res += points[-1:]
         return res
 
-def get_flow(points, video_len=16):
+def get_flow_filter2d(points, video_len=16):
+    """reference implementation: one impulse per frame blurred with cv2.filter2D"""
     optical_flow = np.zeros((video_len, 256, 256, 2), dtype=np.float32)
     for i in range(video_len-1):
         p = points[i]
@@ -92,6 +96,74 @@ def get_flow(points, video_len=16):
     return optical_flow
 
 
+@lru_cache(maxsize=None)
+def reflected_blur_profile(size=256):
+    """
+    [size, size] table, row k is the 1D response of `blur_kernel` to an impulse at position k,
+    including the mirrored copies produced by cv2's default BORDER_REFLECT_101 padding.
+    `blur_kernel` is an isotropic Gaussian, i.e. the outer product of this 1D profile with itself.
+    """
+    kernel_1d = blur_kernel.sum(axis=0)
+    radius = len(kernel_1d) // 2
+    src = np.arange(size)[:, None]
+    dst = np.arange(size)[None, :]
+
+    def response(offset):
+        out = np.zeros(offset.shape, dtype=np.float64)
+        valid = np.abs(offset) <= radius
+        out[valid] = kernel_1d[offset[valid] + radius]
+        return out
+
+    table = response(src - dst)
+    # reflect_101 mirrors around the first/last pixel without repeating it
+    table += np.where(src != 0, response(-src - dst), 0.)
+    table += np.where(src != size - 1, response(2 * (size - 1) - src - dst), 0.)
+    table = table.astype(np.float32)
+    table.setflags(write=False)
+    return table
+
+
+def get_flows(points_list, video_len=16, size=256):
+    """
+    Batched trajectory-to-flow encoder, same output as `get_flow_filter2d` for every trajectory.
+    Each frame holds a single displacement, so the blurred frame is the displacement times the
+    outer product of two cached 1D profiles, no convolution is needed.
+    :param points_list: N trajectories, each with at least `video_len` [x, y] points.
+    :return: float32 array [N, video_len, size, size, 2]
+    """
+    points = np.asarray([p[:video_len] for p in points_list], dtype=np.int64).reshape(-1, video_len, 2)
+    delta = (points[:, 1:] - points[:, :-1]).astype(np.float32)  # [N, T-1, 2]
+    profile = reflected_blur_profile(size)
+    rows = profile[points[:, :-1, 1]]  # [N, T-1, size]
+    cols = profile[points[:, :-1, 0]]  # [N, T-1, size]
+
+    optical_flow = np.zeros((points.shape[0], video_len, size, size, 2), dtype=np.float32)
+    # [N, T-1, size, 1, 1] * [N, T-1, 1, size, 2], written in place into frames 1..T-1
+    np.multiply(rows[:, :, :, None, None], cols[:, :, None, :, None] * delta[:, :, None, None, :],
+                out=optical_flow[:, 1:])
+    return optical_flow
+
+
+def get_flow(points, video_len=16):
+    return get_flows([points], video_len)[0]
+
+
+def benchmark_get_flow(video_lens=(16, 32, 64), repeat=3):
+    """micro-benchmark of the analytic encoder against the filter2D reference"""
+    rng = np.random.default_rng(0)
+    for video_len in video_lens:
+        points = rng.integers(0, 256, size=(video_len, 2)).tolist()
+        timings = []
+        for fn in (get_flow_filter2d, get_flow):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                flow = fn(points, video_len)
+            timings.append((time.perf_counter() - start) / repeat)
+        max_err = np.abs(get_flow_filter2d(points, video_len) - get_flow(points, video_len)).max()
+        print(f'T={video_len}: filter2D {timings[0]*1000:.1f} ms, analytic {timings[1]*1000:.1f} ms, '
+              f'speedup {timings[0]/timings[1]:.1f}x, max abs err {max_err:.2e}')
+
+
 def process_traj(points, device='cpu'):
     xy_range = 1024
     points = process_points(points)
@@ -100,4 +172,9 @@ def process_traj(points, device='cpu'):
     optical_flow = get_flow(points)
     # optical_flow = torch.tensor(optical_flow).to(device)
 
-    return optical_flow
\ No newline at end of file
+    return optical_flow
+
+
+if __name__ == '__main__':
+    # python -m gradio_utils.traj_utils
+    benchmark_get_flow()
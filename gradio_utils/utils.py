@@ -1,8 +1,19 @@
+from functools import lru_cache
+
 import numpy as np
-import plotly.express as px
-import plotly.graph_objects as go
+from PIL import Image, ImageDraw
+
+try:
+    import plotly.express as px
+    import plotly.graph_objects as go
+    PLOTLY_IS_AVAILBLE = True
+except:
+    PLOTLY_IS_AVAILBLE = False
+
+CAMERA_EDGES = [(0, 1), (0, 2), (0, 3), (1, 2), (2, 3), (3, 1), (3, 4)]
 
 def vis_camera(RT_list, rescale_T=1, index=0):
+    assert PLOTLY_IS_AVAILBLE, 'Error: the plotly camera view requires `pip install plotly kaleido`'
     fig = go.Figure()
     showticklabels = False
     visible = True
@@ -11,7 +22,7 @@ def vis_camera(RT_list, rescale_T=1, index=0):
     zoom_scale = 1.5
     fov_deg = 50.0
     
-    edges = [(0, 1), (0, 2), (0, 3), (1, 2), (2, 3), (3, 1), (3, 4)] 
+    edges = CAMERA_EDGES
     
     colors = px.colors.qualitative.Plotly
         
@@ -87,6 +98,59 @@ def vis_camera(RT_list, rescale_T=1, index=0):
     return fig
 
 
+def project_scene_points(points, size=256, scene_bounds=2, fovy_deg=45.0):
+    """
+    Perspective projection of [..., 3] scene points to [..., 2] pixel coordinates, with the view of `vis_camera`:
+    a [-scene_bounds, scene_bounds]^3 scene seen from eye (1, -1, -1) (in plotly's unit-cube coordinates)
+    towards the origin with up (0, -1, 0).
+    """
+    eye = np.array([scene_bounds / 2, -scene_bounds / 2, -scene_bounds / 2])
+    up = np.array([0.0, -1.0, 0.0])
+    forward = -eye / np.linalg.norm(eye)
+    right = np.cross(forward, up)
+    right /= np.linalg.norm(right)
+    true_up = np.cross(right, forward)
+
+    # scene -> plotly unit cube [-0.5, 0.5]^3 -> view space
+    rel = points / (2. * scene_bounds) - eye
+    depth = np.maximum(rel @ forward, 1e-6)
+    focal = 0.5 * size / np.tan(np.deg2rad(fovy_deg) / 2.)
+    u = 0.5 * size + focal * (rel @ right) / depth
+    v = 0.5 * size - focal * (rel @ true_up) / depth
+    return np.stack([u, v], axis=-1)
+
+def camera_cones_2d(RT_list, rescale_T=1, size=256, fov_deg=50.0):
+    """ [n, 5, 2] pixel coordinates of the frustum vertices of every camera in RT_list [n, 3, 4] """
+    cones = np.stack([calc_cam_cone_pts_3d(RT[:, :3], RT[:, -1] / rescale_T, fov_deg, scale=1) for RT in RT_list])
+    return project_scene_points(cones, size=size)
+
+def draw_camera_cone(draw, cone, color, width):
+    for edge in CAMERA_EDGES:
+        draw.line([tuple(cone[edge[0]]), tuple(cone[edge[1]])], fill=color, width=width)
+
+@lru_cache(maxsize=8)
+def _camera_overlay_layers(rt_bytes, num_cameras, rescale_T, size, supersample):
+    """ (static layer with every camera, supersampled 2d cones) for one RT list, cached across frames & runs """
+    RT_list = np.frombuffer(rt_bytes, dtype=np.float64).reshape(num_cameras, 3, 4)
+    cones = camera_cones_2d(RT_list, rescale_T, size * supersample)
+    layer = Image.new('RGBA', (size * supersample, size * supersample), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(layer)
+    for cone in cones:
+        draw_camera_cone(draw, cone, (0, 128, 0, 255), 3 * supersample)
+    return layer.resize((size, size), Image.LANCZOS), cones
+
+def render_camera_overlay(RT_list, index=0, rescale_T=1, size=256, supersample=2):
+    """
+    Transparent RGBA overlay of the camera frustums of `RT_list` with camera `index` highlighted, drawn with PIL.
+    Fast alternative to rasterising `vis_camera` through plotly/kaleido: the static layer holding all cameras is
+    rendered once per RT list, each frame only draws the highlighted camera on top of it.
+    """
+    RT_list = np.ascontiguousarray(RT_list, dtype=np.float64)
+    static_layer, cones = _camera_overlay_layers(RT_list.tobytes(), RT_list.shape[0], rescale_T, size, supersample)
+    highlight = Image.new('RGBA', (size * supersample, size * supersample), (0, 0, 0, 0))
+    draw_camera_cone(ImageDraw.Draw(highlight), cones[index], (255, 255, 0, 255), 3 * supersample)
+    return Image.alpha_composite(static_layer, highlight.resize((size, size), Image.LANCZOS))
+
 def calc_cam_cone_pts_3d(R_W2C, T_W2C, fov_deg, scale=0.1, set_canonical=False, first_frame_RT=None):
     fov_rad = np.deg2rad(fov_deg)
     R_W2C_inv = np.linalg.inv(R_W2C)
@@ -1,5 +1,7 @@
 import os, math
+import threading
 import numpy as np
+from contextlib import contextmanager
 from inspect import isfunction
 
 import torch
@@ -37,6 +39,13 @@ def noise_like(shape, device, repeat=False):
     return repeat_noise() if repeat else noise()
 
 
+def batch_randn(shape, generators, device):
+    """ noise whose batch is split evenly between `generators`, each chunk drawn from its own generator """
+    assert shape[0] % len(generators) == 0, f'batch size {shape[0]} is not a multiple of {len(generators)} generators'
+    chunk = shape[0] // len(generators)
+    return torch.cat([torch.randn((chunk, *shape[1:]), generator=g, device=device) for g in generators])
+
+
 def default(val, d):
     if exists(val):
         return val
@@ -80,6 +89,44 @@ def init_(tensor):
     tensor.uniform_(-std, std)
     return tensor
 
+def shape_signature(value):
+    """ hashable shapes / dtypes / option values of a (nested) model input, e.g. to key compiled forwards """
+    if isinstance(value, torch.Tensor):
+        return (tuple(value.shape), str(value.dtype), value.device.type)
+    if isinstance(value, dict):
+        return tuple((key, shape_signature(v)) for key, v in sorted(value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(shape_signature(v) for v in value)
+    return repr(value)
+
+def is_compiling():
+    """ True while torch.compile traces a function, python-side caches should be bypassed then """
+    compiler = getattr(torch, 'compiler', None)
+    return compiler is not None and hasattr(compiler, 'is_compiling') and compiler.is_compiling()
+
+_inference_state = threading.local()
+
+def is_inference_mode():
+    """ True inside `inference_context()` on this thread """
+    return getattr(_inference_state, 'depth', 0) > 0
+
+@contextmanager
+def inference_context(enabled=True):
+    """
+    Sampling / decoding scope: torch.inference_mode(), and `checkpoint` calls the wrapped function directly as
+    there is no backward pass to save memory for. Only the calling thread and only this scope are affected, so
+    training code in the same process keeps its gradient checkpointing. A no-op context if not `enabled`.
+    """
+    if not enabled:
+        yield
+        return
+    _inference_state.depth = getattr(_inference_state, 'depth', 0) + 1
+    try:
+        with torch.inference_mode():
+            yield
+    finally:
+        _inference_state.depth -= 1
+
 #import deepspeed
 #ckpt = deepspeed.checkpointing.checkpoint
 ckpt = torch.utils.checkpoint.checkpoint
@@ -92,8 +139,9 @@ def checkpoint(func, inputs, params, flag):
     :param params: a sequence of parameters `func` depends on but does not
                    explicitly take as arguments.
     :param flag: if False, disable gradient checkpointing.
+    Bypassed inside `inference_context()`, where there is no backward pass to save memory for.
     """
-    if flag:
+    if flag and not is_inference_mode():
         try:
             return ckpt(func, *inputs)
         except:
@@ -9,7 +9,7 @@ https://github.com/CompVis/taming-transformers
 import logging
 import os
 import random
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext
 from functools import partial
 
 import numpy as np
@@ -26,7 +26,7 @@ from torch.optim.lr_scheduler import CosineAnnealingLR, LambdaLR
 from torchvision.utils import make_grid
 
 from ...lvdm.basics import disabled_train
-from ...lvdm.common import default, exists, extract_into_tensor, noise_like
+from ...lvdm.common import default, exists, extract_into_tensor, inference_context, noise_like, shape_signature
 from ...lvdm.distributions import DiagonalGaussianDistribution, normal_kl
 from ...lvdm.ema import LitEma
 from ...lvdm.models.samplers.ddim import DDIMSampler
@@ -37,6 +37,25 @@ __conditioning_keys__ = {'concat': 'c_concat',
                          'crossattn': 'c_crossattn',
                          'adm': 'y'}
 
+
+def tile_starts(size, tile, stride):
+    """ start offsets of tiles of length `tile` covering [0, size), the last tile is aligned to the end """
+    if size <= tile:
+        return [0]
+    return list(range(0, size - tile, stride)) + [size - tile]
+
+
+def blend_ramp(length, overlap, ramp_start, ramp_end, device):
+    """ 1d blending weights of a tile, ramping linearly over `overlap` on the sides shared with a neighbour """
+    ramp = torch.ones(length, device=device)
+    if overlap > 0:
+        rise = (torch.arange(overlap, device=device, dtype=torch.float32) + 0.5) / overlap
+        if ramp_start:
+            ramp[:overlap] = rise
+        if ramp_end:
+            ramp[length-overlap:] = torch.minimum(ramp[length-overlap:], rise.flip(0))
+    return ramp
+
 class DDPM(pl.LightningModule):
     # classic DDPM with Gaussian diffusion, in image space
     def __init__(self,
@@ -546,17 +565,92 @@ class LatentDiffusion(DDPM):
             model = instantiate_from_config(config)
             self.cond_stage_model = model
     
+    def cast_inference_dtype(self, dtype):
+        """
+        Cast the networks (unet, first stage, cond stage, ...) to `dtype` for inference.
+        The diffusion schedule buffers registered on this module and all normalization layers stay in fp32,
+        half precision networks are meant to be run under `inference_autocast`.
+        """
+        for module in self.children():
+            module.to(dtype)
+            for submodule in module.modules():
+                if isinstance(submodule, (nn.GroupNorm, nn.LayerNorm)):
+                    submodule.float()
+        self.model.diffusion_model.dtype = dtype
+        self.inference_dtype = dtype
+        return self
+
+    def inference_autocast(self):
+        """ autocast context matching `inference_dtype`, a no-op for fp32 models """
+        dtype = getattr(self, 'inference_dtype', torch.float32)
+        if dtype == torch.float32:
+            return nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=dtype)
+
+    @contextmanager
+    def compile_scope(self, mode=None, backend='inductor'):
+        """
+        Opt-in compiled denoising for one sampling run: within the scope, with `mode` ('default', 'reduce-overhead'
+        for CUDA-graph capture, 'max-autotune') the unet call of `apply_model` goes through torch.compile,
+        specialised once per input shape signature; None runs eagerly. The previous mode is restored on exit, so
+        a model shared through the registry keeps no mode between runs, only the compiled forwards. A signature
+        that fails to compile runs eagerly from then on.
+        """
+        if mode is not None and not hasattr(torch, 'compile'):
+            mainlogger.warning('torch.compile requires torch>=2.0, the unet runs eagerly')
+            mode = None
+        previous = getattr(self, 'compile_options', None)
+        self.compile_options = None if mode is None else (mode, backend)
+        try:
+            yield self
+        finally:
+            self.compile_options = previous
+
+    def release_sampling_caches(self):
+        """ called by the samplers at the end of a run, for what the unet keeps over one run (none here) """
+        pass
+
+    def compiled_unet(self, options):
+        compiled = self.__dict__.setdefault('compiled_unets', {})
+        if options not in compiled:
+            mode, backend = options
+            compiled[options] = torch.compile(self.model, mode=mode, backend=backend, dynamic=False)
+        return compiled[options]
+
+    def run_unet(self, x_noisy, t, cond, kwargs):
+        options = getattr(self, 'compile_options', None)
+        if options is None:
+            return self.model(x_noisy, t, **cond, **kwargs)
+        signature = (options, shape_signature((x_noisy, t, cond, kwargs)))
+        eager_signatures = self.__dict__.setdefault('eager_signatures', set())
+        if signature in eager_signatures:
+            return self.model(x_noisy, t, **cond, **kwargs)
+        cuda_graphs = options[0] == 'reduce-overhead'
+        if cuda_graphs and hasattr(torch.compiler, 'cudagraph_mark_step_begin'):
+            torch.compiler.cudagraph_mark_step_begin()
+        try:
+            x_recon = self.compiled_unet(options)(x_noisy, t, **cond, **kwargs)
+        except Exception as e:
+            mainlogger.warning(f'compiled unet failed for {signature}, falling back to eager: {e}')
+            eager_signatures.add(signature)
+            return self.model(x_noisy, t, **cond, **kwargs)
+        # CUDA-graph outputs live in static buffers that the next replay overwrites (e.g. cond & uncond of cfg)
+        if cuda_graphs:
+            x_recon = x_recon[0].clone() if isinstance(x_recon, tuple) else x_recon.clone()
+        return x_recon
+
     def get_learned_conditioning(self, c):
-        if self.cond_stage_forward is None:
-            if hasattr(self.cond_stage_model, 'encode') and callable(self.cond_stage_model.encode):
-                c = self.cond_stage_model.encode(c)
-                if isinstance(c, DiagonalGaussianDistribution):
-                    c = c.mode()
+        with self.inference_autocast():
+            if self.cond_stage_forward is None:
+                if hasattr(self.cond_stage_model, 'encode') and callable(self.cond_stage_model.encode):
+                    c = self.cond_stage_model.encode(c)
+                    if isinstance(c, DiagonalGaussianDistribution):
+                        c = c.mode()
+                else:
+                    c = self.cond_stage_model(c)
             else:
-                c = self.cond_stage_model(c)
-        else:
-            assert hasattr(self.cond_stage_model, self.cond_stage_forward)
-            c = getattr(self.cond_stage_model, self.cond_stage_forward)(c)
+                assert hasattr(self.cond_stage_model, self.cond_stage_forward)
+                c = getattr(self.cond_stage_model, self.cond_stage_forward)(c)
         return c
 
     def get_first_stage_encoding(self, encoder_posterior, noise=None):
@@ -596,9 +690,63 @@ class LatentDiffusion(DDPM):
         results = self.first_stage_model.decode(z, **kwargs)
         return results
 
+    def decode_first_stage_tiled(self, z, tile_size, tile_overlap=8, **kwargs):
+        """
+        decode [n,c,h,w] latents in spatial tiles of `tile_size` latent pixels, neighbouring tiles overlap by
+        `tile_overlap` and are blended with linear ramps to hide the seams
+        """
+        n, _, h, w = z.shape
+        tile_h, tile_w = min(tile_size, h), min(tile_size, w)
+        overlap = min(tile_overlap, tile_size - 1)
+        results, weights = None, None
+        for y0 in tile_starts(h, tile_h, tile_h - overlap):
+            for x0 in tile_starts(w, tile_w, tile_w - overlap):
+                tile = self.first_stage_model.decode(z[:, :, y0:y0+tile_h, x0:x0+tile_w], **kwargs)
+                scale = tile.shape[-1] // tile_w
+                if results is None:
+                    results = torch.zeros((n, tile.shape[1], h*scale, w*scale), dtype=torch.float32, device=tile.device)
+                    weights = torch.zeros((1, 1, h*scale, w*scale), dtype=torch.float32, device=tile.device)
+                ramp_h = blend_ramp(tile_h*scale, overlap*scale, y0 > 0, y0 + tile_h < h, tile.device)
+                ramp_w = blend_ramp(tile_w*scale, overlap*scale, x0 > 0, x0 + tile_w < w, tile.device)
+                mask = ramp_h[:, None] * ramp_w[None, :]
+                region = (slice(None), slice(None), slice(y0*scale, (y0+tile_h)*scale), slice(x0*scale, (x0+tile_w)*scale))
+                results[region] += tile * mask
+                weights[region] += mask
+                del tile
+        return results.div_(weights)
+
+    def decode_first_stage_chunked(self, z, frame_chunk=None, tile_size=None, tile_overlap=8, **kwargs):
+        """
+        decode the frames of all videos in chunks of `frame_chunk` (optionally in spatial tiles) into a
+        preallocated output, peak decoder activation memory is bounded by the chunk / tile size
+        instead of growing with batch size and frame_length
+        """
+        assert self.encoder_type == "2d", "chunked decoding is only supported for the 2d first stage"
+        z = 1. / self.scale_factor * z
+        b, _, t, h, w = z.shape
+        frames = rearrange(z, 'b c t h w -> (b t) c h w')
+        n = frames.shape[0]
+        frame_chunk = n if not frame_chunk else frame_chunk
+        tiled = tile_size is not None and tile_size > 0 and (tile_size < h or tile_size < w)
+        results = None
+        for start in range(0, n, frame_chunk):
+            chunk = frames[start:start+frame_chunk]
+            if tiled:
+                decoded = self.decode_first_stage_tiled(chunk, tile_size, tile_overlap, **kwargs)
+            else:
+                decoded = self.first_stage_model.decode(chunk, **kwargs)
+            if results is None:
+                results = torch.empty((n,) + decoded.shape[1:], dtype=torch.float32, device=decoded.device)
+            results[start:start+chunk.shape[0]] = decoded
+            del decoded
+        return rearrange(results, '(b t) c h w -> b c t h w', b=b, t=t)
+
     @torch.no_grad()
-    def decode_first_stage(self, z, **kwargs):
-        return self._decode_core(z, **kwargs)
+    def decode_first_stage(self, z, frame_chunk=None, tile_size=None, tile_overlap=8, **kwargs):
+        with inference_context(), self.inference_autocast():
+            if frame_chunk or tile_size:
+                return self.decode_first_stage_chunked(z, frame_chunk, tile_size, tile_overlap, **kwargs)
+            return self._decode_core(z, **kwargs).float()
 
     def differentiable_decode_first_stage(self, z, **kwargs):
         """same as decode_first_stage but without decorator"""
@@ -677,12 +825,12 @@ class LatentDiffusion(DDPM):
             key = 'c_concat' if self.model.conditioning_key == 'concat' else 'c_crossattn'
             cond = {key: cond}
 
-        x_recon = self.model(x_noisy, t, **cond, **kwargs)
+        x_recon = self.run_unet(x_noisy, t, cond, kwargs)
 
         if isinstance(x_recon, tuple):
-            return x_recon[0]
-        else:
-            return x_recon
+            x_recon = x_recon[0]
+        # keep the sampler arithmetic in the latents' dtype when the unet runs in half precision
+        return x_recon.type(x_noisy.dtype)
 
     def p_losses(self, x_start, cond, t, noise=None, **kwargs):
         noise = default(noise, lambda: torch.randn_like(x_start))
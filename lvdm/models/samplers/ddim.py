@@ -4,26 +4,166 @@ import numpy as np
 import torch
 from tqdm import tqdm
 
-from ....lvdm.common import noise_like
+from ....lvdm.common import batch_randn, inference_context, noise_like
 from ....lvdm.models.utils_diffusion import (make_ddim_sampling_parameters,
                                          make_ddim_timesteps)
 
 
+def ddim_update(x, e_t, noise, sqrt_a_t, sqrt_one_minus_at, sqrt_a_prev, dir_coef, sigma_t):
+    """ one DDIM step from the unet output e_t, returns (x_prev, pred_x0) """
+    pred_x0 = (x - sqrt_one_minus_at * e_t) / sqrt_a_t
+    x_prev = sqrt_a_prev * pred_x0 + dir_coef * e_t + sigma_t * noise
+    return x_prev, pred_x0
+
+
+class DDIMSamplingPlan(object):
+    """
+    Per-step coefficients of one DDIM schedule (steps, discretization, eta) stacked into float32 tensors on
+    the sampling device and indexed by the ddim step index: a sampling step then allocates nothing for its
+    coefficients and never reads them back from the host.
+    """
+    def __init__(self, ddim_timesteps, alphas, alphas_prev, sigmas, device):
+        to_torch = lambda x: torch.as_tensor(np.asarray(x, dtype=np.float64))
+        alphas, alphas_prev, sigmas = map(to_torch, (alphas, alphas_prev, sigmas))
+        to_device = lambda x: x.to(torch.float32).to(device)
+        self.timesteps = torch.as_tensor(np.asarray(ddim_timesteps), dtype=torch.long).to(device)
+        self.sqrt_alphas = to_device(alphas.sqrt())
+        self.sqrt_one_minus_alphas = to_device((1. - alphas).sqrt())
+        self.sqrt_alphas_prev = to_device(alphas_prev.sqrt())
+        # coefficient of the direction pointing to x_t
+        self.dir_coefs = to_device((1. - alphas_prev - sigmas ** 2).sqrt())
+        self.sigmas = to_device(sigmas)
+
+    def step_timesteps(self, index, batch_size):
+        return self.timesteps[index].expand(batch_size)
+
+    def step_coefficients(self, index):
+        """ (sqrt(a_t), sqrt(1 - a_t), sqrt(a_prev), sqrt(1 - a_prev - sigma_t^2), sigma_t) as 0-d views """
+        return (self.sqrt_alphas[index], self.sqrt_one_minus_alphas[index], self.sqrt_alphas_prev[index],
+                self.dir_coefs[index], self.sigmas[index])
+
+
+GUIDANCE_SIGNALS = ['text', 'traj', 'camera']
+
+
+def in_guidance_window(window, t):
+    """ window: None (every step), T (steps t >= T, as `cond_T`) or (low, high) for low <= t <= high """
+    if window is None:
+        return True
+    if isinstance(window, (tuple, list)):
+        low, high = window
+        return low <= t <= high
+    return t >= window
+
+
+def subset_steps(timesteps, total):
+    """
+    number of steps run by ddim_sampling with `timesteps` on a schedule of `total` steps: the first
+    min(timesteps, total) - 1 of the schedule. The product below is rounded, truncating it loses a step to float
+    error for some pairs (e.g. timesteps=15 of 22 ran 13 steps).
+    """
+    return int(round(min(timesteps / total, 1) * total)) - 1
+
+
+def restart_split(ddim_timesteps, restart_T):
+    """
+    (skipped, remaining) steps of a run restarted from a latent at timestep `restart_T`: the steps above
+    restart_T are skipped, at least one on each side, (0, S) if restart_T is not below the first timestep.
+    The remaining steps run with `timesteps=remaining + 1` (the subset convention of ddim_sampling) and x_T the
+    latent after the skipped steps of a full run, intermediates['x_inter'][skipped] with log_every_t=1.
+    """
+    total = len(ddim_timesteps)
+    skipped = int((np.asarray(ddim_timesteps) > restart_T).sum())
+    if skipped == 0 or total < 2:
+        return 0, total
+    skipped = min(skipped, total - 1)
+    return skipped, total - skipped
+
+
+class GuidanceSchedule(object):
+    """
+    The steps of one sampling run on which each conditioning signal is used, resolved once from its timesteps:
+    text (classifier-free guidance, the unconditional pass is skipped outside its window), traj (the adapter
+    features `features_adapter` of both cfg branches) and camera (`pose_emb`).
+    `cond_T` is the traj window T unless `windows['traj']` is given. The schedule holds the adapter features
+    for the run and drops them after the last step of the traj window.
+    """
+    def __init__(self, timesteps, windows=None, cond_T=None):
+        windows = dict(windows or {})
+        assert set(windows) <= set(GUIDANCE_SIGNALS), \
+            f"Error: guidance windows should be among {GUIDANCE_SIGNALS}, got {list(windows.keys())}"
+        if cond_T is not None:
+            windows.setdefault('traj', cond_T)
+        self.windows = {signal: windows.get(signal) for signal in GUIDANCE_SIGNALS}
+        self.active = {signal: [in_guidance_window(window, int(t)) for t in timesteps]
+                       for signal, window in self.windows.items()}
+        traj = self.active['traj']
+        self.last_traj_step = max([i for i, active in enumerate(traj) if active], default=-1)
+        self.features_adapter = None
+        self.un_features_adapter = None
+
+    def hold_adapter_features(self, kwargs, unconditional_conditioning):
+        """ moves the adapter features out of the run's kwargs / uc dict, returns the uc dict without them """
+        self.features_adapter = kwargs.pop('features_adapter', None)
+        if isinstance(unconditional_conditioning, dict) and 'features_adapter' in unconditional_conditioning:
+            unconditional_conditioning = dict(unconditional_conditioning)
+            self.un_features_adapter = unconditional_conditioning.pop('features_adapter')
+        return unconditional_conditioning
+
+    def step_inputs(self, i, kwargs, unconditional_conditioning, unconditional_guidance_scale):
+        """ (kwargs, unconditional_conditioning, unconditional_guidance_scale) of step i """
+        kwargs = dict(kwargs)
+        if self.active['traj'][i] and self.features_adapter is not None:
+            kwargs['features_adapter'] = self.features_adapter
+            if isinstance(unconditional_conditioning, dict):
+                unconditional_conditioning = dict(unconditional_conditioning,
+                                                  features_adapter=self.un_features_adapter)
+        if not self.active['camera'][i]:
+            kwargs.pop('pose_emb', None)
+        if not self.active['text'][i]:
+            unconditional_guidance_scale = 1.
+        return kwargs, unconditional_conditioning, unconditional_guidance_scale
+
+    def step_done(self, i, sampler):
+        """ after the last step of the traj window, release the adapter features and their stacked cfg inputs """
+        if i != self.last_traj_step or self.features_adapter is None:
+            return
+        held = [value for value in (self.features_adapter, self.un_features_adapter) if value is not None]
+        sampler.cfg_inputs = {key: entry for key, entry in sampler.cfg_inputs.items()
+                              if not any(entry[0] is value or entry[1] is value for value in held)}
+        self.features_adapter = None
+        self.un_features_adapter = None
+
+
 class DDIMSampler(object):
-    def __init__(self, model, schedule="linear", **kwargs):
+    # draws step noise, i.e. `eta`, `temperature` and `noise_dropout` apply
+    stochastic = True
+
+    def __init__(self, model, schedule="linear", compile=None, **kwargs):
         super().__init__()
         self.model = model
+        # torch.compile mode of the unet for this sampler's runs ('off' / None: eager), see model.compile_scope
+        self.compile = None if compile == 'off' else compile
         self.ddpm_num_timesteps = model.num_timesteps
         self.schedule = schedule
         self.counter = 0
+        # sampling plans by (steps, discretization, eta, device), the schedule buffers are those of `schedule_key`
+        self.plans = {}
+        self.plan = None
+        self.schedule_key = None
+        # (id(cond), id(uncond)) -> (cond, uncond, stacked) of the current sampling run, see stack_cfg_inputs
+        self.cfg_inputs = {}
 
     def register_buffer(self, name, attr):
         if type(attr) == torch.Tensor:
-            if attr.device != torch.device("cuda"):
-                attr = attr.to(torch.device("cuda"))
+            if attr.device != self.model.device:
+                attr = attr.to(self.model.device)
         setattr(self, name, attr)
 
     def make_schedule(self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
+        key = (ddim_num_steps, ddim_discretize, float(ddim_eta), str(self.model.device))
+        if key == self.schedule_key:
+            return
         self.ddim_timesteps = make_ddim_timesteps(ddim_discr_method=ddim_discretize, num_ddim_timesteps=ddim_num_steps,
                                                   num_ddpm_timesteps=self.ddpm_num_timesteps,verbose=verbose)
         alphas_cumprod = self.model.alphas_cumprod
@@ -45,6 +185,10 @@ class DDIMSampler(object):
         ddim_sigmas, ddim_alphas, ddim_alphas_prev = make_ddim_sampling_parameters(alphacums=alphas_cumprod.cpu(),
                                                                                    ddim_timesteps=self.ddim_timesteps,
                                                                                    eta=ddim_eta,verbose=verbose)
+        if key not in self.plans:
+            self.plans[key] = DDIMSamplingPlan(self.ddim_timesteps, ddim_alphas, ddim_alphas_prev, ddim_sigmas,
+                                               self.model.device)
+        self.plan = self.plans[key]
         self.register_buffer('ddim_sigmas', ddim_sigmas)
         self.register_buffer('ddim_alphas', ddim_alphas)
         self.register_buffer('ddim_alphas_prev', ddim_alphas_prev)
@@ -53,6 +197,7 @@ class DDIMSampler(object):
             (1 - self.alphas_cumprod_prev) / (1 - self.alphas_cumprod) * (
                         1 - self.alphas_cumprod / self.alphas_cumprod_prev))
         self.register_buffer('ddim_sigmas_for_original_num_steps', sigmas_for_original_sampling_steps)
+        self.schedule_key = key
 
     @torch.no_grad()
     def sample(self,
@@ -78,6 +223,8 @@ class DDIMSampler(object):
                unconditional_guidance_scale=1.,
                unconditional_conditioning=None,
                # this has to come in the same format as the conditioning, # e.g. as encoded tokens, ...
+               batched_cfg=False,
+               generators=None,
                **kwargs
                ):
         
@@ -106,22 +253,32 @@ class DDIMSampler(object):
             size = (batch_size, C, T, H, W)
         # print(f'Data shape for DDIM sampling is {size}, eta {eta}')
         
-        samples, intermediates = self.ddim_sampling(conditioning, size,
-                                                    callback=callback,
-                                                    img_callback=img_callback,
-                                                    quantize_denoised=quantize_x0,
-                                                    mask=mask, x0=x0,
-                                                    ddim_use_original_steps=False,
-                                                    noise_dropout=noise_dropout,
-                                                    temperature=temperature,
-                                                    score_corrector=score_corrector,
-                                                    corrector_kwargs=corrector_kwargs,
-                                                    x_T=x_T,
-                                                    log_every_t=log_every_t,
-                                                    unconditional_guidance_scale=unconditional_guidance_scale,
-                                                    unconditional_conditioning=unconditional_conditioning,
-                                                    verbose=verbose,
-                                                    **kwargs)
+        # schedule & latents stay fp32, only the model's forward passes are autocast
+        self.cfg_inputs = {}
+        try:
+            with inference_context(), self.model.inference_autocast(), self.model.compile_scope(self.compile):
+                samples, intermediates = self.ddim_sampling(conditioning, size,
+                                                            callback=callback,
+                                                            img_callback=img_callback,
+                                                            quantize_denoised=quantize_x0,
+                                                            mask=mask, x0=x0,
+                                                            ddim_use_original_steps=False,
+                                                            noise_dropout=noise_dropout,
+                                                            temperature=temperature,
+                                                            score_corrector=score_corrector,
+                                                            corrector_kwargs=corrector_kwargs,
+                                                            x_T=x_T,
+                                                            log_every_t=log_every_t,
+                                                            unconditional_guidance_scale=unconditional_guidance_scale,
+                                                            unconditional_conditioning=unconditional_conditioning,
+                                                            verbose=verbose,
+                                                            batched_cfg=batched_cfg,
+                                                            generators=generators,
+                                                            **kwargs)
+        finally:
+            # per-run caches: stacked cfg inputs here, camera pose terms in the model
+            self.cfg_inputs = {}
+            self.model.release_sampling_caches()
         return samples, intermediates
 
     @torch.no_grad()
@@ -131,22 +288,22 @@ class DDIMSampler(object):
                       mask=None, x0=None, img_callback=None, log_every_t=100,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
                       unconditional_guidance_scale=1., unconditional_conditioning=None, verbose=True,
-                      **kwargs):
+                      batched_cfg=False, generators=None, **kwargs):
         device = self.model.betas.device        
         b = shape[0]
         if x_T is None:
-            img = torch.randn(shape, device=device)
+            img = torch.randn(shape, device=device) if generators is None else batch_randn(shape, generators, device)
         else:
             img = x_T
         
         if timesteps is None:
             timesteps = self.ddpm_num_timesteps if ddim_use_original_steps else self.ddim_timesteps
         elif timesteps is not None and not ddim_use_original_steps:
-            subset_end = int(min(timesteps / self.ddim_timesteps.shape[0], 1) * self.ddim_timesteps.shape[0]) - 1
+            subset_end = subset_steps(timesteps, self.ddim_timesteps.shape[0])
             timesteps = self.ddim_timesteps[:subset_end]
             
         intermediates = {'x_inter': [img], 'pred_x0': [img]}
-        time_range = reversed(range(0,timesteps)) if ddim_use_original_steps else np.flip(timesteps)
+        time_range = list(reversed(range(0,timesteps))) if ddim_use_original_steps else np.flip(timesteps)
         total_steps = timesteps if ddim_use_original_steps else timesteps.shape[0]
         if verbose:
             iterator = tqdm(time_range, desc='DDIM Sampler', total=total_steps)
@@ -154,9 +311,13 @@ class DDIMSampler(object):
             iterator = time_range
 
         clean_cond = kwargs.pop("clean_cond", False)
+        guidance, unconditional_conditioning = self.guidance_schedule(time_range, kwargs, unconditional_conditioning)
         for i, step in enumerate(iterator):
             index = total_steps - i - 1
-            ts = torch.full((b,), step, device=device, dtype=torch.long)
+            if ddim_use_original_steps:
+                ts = torch.full((b,), step, device=device, dtype=torch.long)
+            else:
+                ts = self.plan.step_timesteps(index, b)
 
             # use mask to blend noised original latent (img_orig) & new sampled latent (img)
             if mask is not None:
@@ -166,14 +327,20 @@ class DDIMSampler(object):
                 else:
                     img_orig = self.model.q_sample(x0, ts)  # TODO: deterministic forward pass? <ddim inversion>
                 img = img_orig * mask + (1. - mask) * img # keep original & modify use img
-                            
+
+            step_kwargs, step_uc, step_scale = guidance.step_inputs(i, kwargs, unconditional_conditioning,
+                                                                    unconditional_guidance_scale)
             outs = self.p_sample_ddim(img, cond, ts, index=index, use_original_steps=ddim_use_original_steps,
                                       quantize_denoised=quantize_denoised, temperature=temperature,
                                       noise_dropout=noise_dropout, score_corrector=score_corrector,
                                       corrector_kwargs=corrector_kwargs,
-                                      unconditional_guidance_scale=unconditional_guidance_scale,
-                                      unconditional_conditioning=unconditional_conditioning,
-                                      **kwargs)
+                                      unconditional_guidance_scale=step_scale,
+                                      unconditional_conditioning=step_uc,
+                                      batched_cfg=batched_cfg,
+                                      generators=generators,
+                                      **step_kwargs)
+            del step_kwargs, step_uc
+            guidance.step_done(i, self)
             
             img, pred_x0 = outs
             if callback: callback(i)
@@ -189,12 +356,64 @@ class DDIMSampler(object):
     def p_sample_ddim(self, x, c, t, index, repeat_noise=False, use_original_steps=False, quantize_denoised=False,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
                       unconditional_guidance_scale=1., unconditional_conditioning=None,
-                      uc_type=None, conditional_guidance_scale_temporal=None, **kwargs):
+                      uc_type=None, conditional_guidance_scale_temporal=None, batched_cfg=False,
+                      generators=None, **kwargs):
         b, *_, device = *x.shape, x.device
         if x.dim() == 5:
             is_video = True
         else:
             is_video = False
+        e_t = self.guided_eps(x, c, t, unconditional_guidance_scale=unconditional_guidance_scale,
+                              unconditional_conditioning=unconditional_conditioning, uc_type=uc_type,
+                              conditional_guidance_scale_temporal=conditional_guidance_scale_temporal,
+                              batched_cfg=batched_cfg, score_corrector=score_corrector,
+                              corrector_kwargs=corrector_kwargs, **kwargs)
+
+        if use_original_steps:
+            alphas = self.model.alphas_cumprod
+            alphas_prev = self.model.alphas_cumprod_prev
+            sqrt_one_minus_alphas = self.model.sqrt_one_minus_alphas_cumprod
+            sigmas = self.model.ddim_sigmas_for_original_num_steps
+            # select parameters corresponding to the currently considered timestep
+            size = (b, 1, 1, 1, 1) if is_video else (b, 1, 1, 1)
+            a_t = torch.full(size, alphas[index], device=device)
+            a_prev = torch.full(size, alphas_prev[index], device=device)
+            sigma_t = torch.full(size, sigmas[index], device=device)
+            sqrt_a_t, sqrt_a_prev = a_t.sqrt(), a_prev.sqrt()
+            sqrt_one_minus_at = torch.full(size, sqrt_one_minus_alphas[index],device=device)
+            dir_coef = (1. - a_prev - sigma_t**2).sqrt()
+        else:
+            # precomputed per-step coefficients, broadcast over the batch
+            sqrt_a_t, sqrt_one_minus_at, sqrt_a_prev, dir_coef, sigma_t = self.plan.step_coefficients(index)
+
+        if generators is None:
+            noise = noise_like(x.shape, device, repeat_noise)
+        else:
+            # per-sample generators keep every sample reproducible from its own seed
+            noise = batch_randn(x.shape, generators, device)
+        if temperature != 1.:
+            noise = noise * temperature
+        if noise_dropout > 0.:
+            noise = torch.nn.functional.dropout(noise, p=noise_dropout)
+
+        if quantize_denoised:
+            # current prediction for x_0
+            pred_x0 = (x - sqrt_one_minus_at * e_t) / sqrt_a_t
+            pred_x0, _, *_ = self.model.first_stage_model.quantize(pred_x0)
+            x_prev = sqrt_a_prev * pred_x0 + dir_coef * e_t + sigma_t * noise
+        else:
+            x_prev, pred_x0 = ddim_update(x, e_t, noise, sqrt_a_t, sqrt_one_minus_at, sqrt_a_prev, dir_coef, sigma_t)
+
+        return x_prev, pred_x0
+
+    def guided_eps(self, x, c, t, unconditional_guidance_scale=1., unconditional_conditioning=None,
+                   uc_type=None, conditional_guidance_scale_temporal=None, batched_cfg=False,
+                   score_corrector=None, corrector_kwargs=None, **kwargs):
+        """
+        noise prediction of the unet at (x, t) with classifier-free / temporal guidance, shared by all samplers.
+        `unconditional_conditioning` may be a dict overriding kwargs of the unconditional branch (e.g. its
+        `features_adapter`). The signals of the step are those of its GuidanceSchedule, `cond_T` is not read here.
+        """
         # f=open('/apdcephfs_cq2/share_1290939/yingqinghe/code/LVDM-private/cfg_range_s5noclamp.txt','a')
         # print(f't={t}, model input, min={torch.min(x)}, max={torch.max(x)}',file=f)
         if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
@@ -208,25 +427,18 @@ class DDIMSampler(object):
                         if uk in un_kwargs:
                             un_kwargs[uk] = uv
                     unconditional_conditioning = unconditional_conditioning['uc']
-                if 'cond_T' in kwargs and t < kwargs['cond_T']:
-                    if 'features_adapter' in kwargs:
-                        kwargs.pop('features_adapter')
-                        un_kwargs.pop('features_adapter')
-                        # kwargs['features_adapter'] = None
-                        # un_kwargs['features_adapter'] = None
-                    # if 'pose_emb' in kwargs:
-                    #     kwargs.pop('pose_emb')
-                        # un_kwargs.pop('pose_emb')
-                        # kwargs['pose_emb'] = None
-                        # un_kwargs['pose_emb'] = None
-                e_t = self.model.apply_model(x, t, c, **kwargs)
-                # e_t_uncond = self.model.apply_model(x, t, unconditional_conditioning, **kwargs)
-                e_t_uncond = self.model.apply_model(x, t, unconditional_conditioning, **un_kwargs)
+                if batched_cfg:
+                    e_t, e_t_uncond = self.apply_model_cfg(x, t, c, unconditional_conditioning, kwargs, un_kwargs)
+                else:
+                    e_t = self.model.apply_model(x, t, c, **kwargs)
+                    # e_t_uncond = self.model.apply_model(x, t, unconditional_conditioning, **kwargs)
+                    e_t_uncond = self.model.apply_model(x, t, unconditional_conditioning, **un_kwargs)
             elif isinstance(c, dict):
                 e_t = self.model.apply_model(x, t, c, **kwargs)
                 e_t_uncond = self.model.apply_model(x, t, unconditional_conditioning, **kwargs)
             else:
                 raise NotImplementedError
+            e_t_cond = e_t
             # text cfg
             if uc_type is None:
                 e_t = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
@@ -239,45 +451,83 @@ class DDIMSampler(object):
                     raise NotImplementedError
             # temporal guidance
             if conditional_guidance_scale_temporal is not None:
-                e_t_temporal = self.model.apply_model(x, t, c, **kwargs)
+                if batched_cfg:
+                    # identical inputs to the conditional branch above, reuse its prediction
+                    e_t_temporal = e_t_cond
+                else:
+                    e_t_temporal = self.model.apply_model(x, t, c, **kwargs)
                 e_t_image = self.model.apply_model(x, t, c, no_temporal_attn=True, **kwargs)
                 e_t = e_t + conditional_guidance_scale_temporal * (e_t_temporal - e_t_image)
 
         if score_corrector is not None:
             assert self.model.parameterization == "eps"
             e_t = score_corrector.modify_score(self.model, e_t, x, t, c, **corrector_kwargs)
+        return e_t
 
-        alphas = self.model.alphas_cumprod if use_original_steps else self.ddim_alphas
-        alphas_prev = self.model.alphas_cumprod_prev if use_original_steps else self.ddim_alphas_prev
-        sqrt_one_minus_alphas = self.model.sqrt_one_minus_alphas_cumprod if use_original_steps else self.ddim_sqrt_one_minus_alphas
-        sigmas = self.model.ddim_sigmas_for_original_num_steps if use_original_steps else self.ddim_sigmas
-        # select parameters corresponding to the currently considered timestep
-        
-        if is_video:
-            size = (b, 1, 1, 1, 1)
-        else:
-            size = (b, 1, 1, 1)
-        a_t = torch.full(size, alphas[index], device=device)
-        a_prev = torch.full(size, alphas_prev[index], device=device)
-        sigma_t = torch.full(size, sigmas[index], device=device)
-        sqrt_one_minus_at = torch.full(size, sqrt_one_minus_alphas[index],device=device)
-
-        # current prediction for x_0
-        pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
-        # print(f't={t}, pred_x0, min={torch.min(pred_x0)}, max={torch.max(pred_x0)}',file=f)
-        if quantize_denoised:
-            pred_x0, _, *_ = self.model.first_stage_model.quantize(pred_x0)
-        # direction pointing to x_t
-        dir_xt = (1. - a_prev - sigma_t**2).sqrt() * e_t
-        # # norm pred_x0
-        # p=2
-        # s=()
-        # pred_x0 = pred_x0 - torch.max(torch.abs(pred_x0))
-
-        noise = sigma_t * noise_like(x.shape, device, repeat_noise) * temperature
-        if noise_dropout > 0.:
-            noise = torch.nn.functional.dropout(noise, p=noise_dropout)
-    
-        x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
+    def guidance_schedule(self, timesteps, kwargs, unconditional_conditioning):
+        """
+        GuidanceSchedule of a run over `timesteps` (in sampling order) from its `guidance_windows` / `cond_T`
+        kwargs, which are consumed here. The schedule takes over the adapter features of kwargs and of the uc
+        dict, returns (schedule, unconditional_conditioning without them).
+        """
+        guidance = GuidanceSchedule(timesteps, kwargs.pop('guidance_windows', None), kwargs.pop('cond_T', None))
+        unconditional_conditioning = guidance.hold_adapter_features(kwargs, unconditional_conditioning)
+        return guidance, unconditional_conditioning
 
-        return x_prev, pred_x0
+    def apply_model_cfg(self, x, t, c, unconditional_conditioning, kwargs, un_kwargs):
+        """
+        Run the conditional and unconditional branches as a single forward pass of size 2B.
+        Latents, timesteps, contexts and every tensor (or list of tensors) kwarg such as
+        `features_adapter` / `pose_emb` are stacked along the batch axis, the prediction is
+        split back into (e_t, e_t_uncond). Falls back to two passes if the branches can not
+        be stacked (e.g. adapter features on one side only).
+        """
+        batched_kwargs = {}
+        can_batch = isinstance(unconditional_conditioning, torch.Tensor) and \
+            c.shape == unconditional_conditioning.shape and set(kwargs) == set(un_kwargs)
+        if can_batch:
+            for key, value in kwargs.items():
+                batched = self.stack_cfg_inputs(value, un_kwargs[key])
+                if batched is NotImplemented:
+                    can_batch = False
+                    break
+                batched_kwargs[key] = batched
+        if not can_batch:
+            e_t = self.model.apply_model(x, t, c, **kwargs)
+            e_t_uncond = self.model.apply_model(x, t, unconditional_conditioning, **un_kwargs)
+            return e_t, e_t_uncond
+
+        e_t_both = self.model.apply_model(torch.cat([x, x]), torch.cat([t, t]),
+                                          torch.cat([c, unconditional_conditioning]), **batched_kwargs)
+        e_t, e_t_uncond = e_t_both.chunk(2)
+        return e_t, e_t_uncond
+
+    def stack_cfg_inputs(self, cond_value, uncond_value):
+        """
+        cat_cfg_inputs memoised over a sampling run: kwargs such as `features_adapter` / `pose_emb` are the
+        same objects at every step, so they are stacked once and keep their identity (see the pose term cache
+        of the temporal blocks). The entry holds both inputs, their ids can not be reused during the run.
+        """
+        key = (id(cond_value), id(uncond_value))
+        if key not in self.cfg_inputs:
+            self.cfg_inputs[key] = (cond_value, uncond_value, cat_cfg_inputs(cond_value, uncond_value))
+        return self.cfg_inputs[key][2]
+
+
+def cat_cfg_inputs(cond_value, uncond_value):
+    """stack a cond / uncond kwarg pair along the batch axis, NotImplemented if not stackable"""
+    if isinstance(cond_value, torch.Tensor) and isinstance(uncond_value, torch.Tensor):
+        if cond_value.shape != uncond_value.shape:
+            return NotImplemented
+        return torch.cat([cond_value, uncond_value])
+    if isinstance(cond_value, (list, tuple)) and isinstance(uncond_value, (list, tuple)):
+        if len(cond_value) != len(uncond_value):
+            return NotImplemented
+        stacked = [cat_cfg_inputs(cv, uv) for cv, uv in zip(cond_value, uncond_value)]
+        if any(item is NotImplemented for item in stacked):
+            return NotImplemented
+        return stacked
+    if isinstance(cond_value, torch.Tensor) or isinstance(uncond_value, torch.Tensor):
+        return NotImplemented
+    # non-tensor options (temporal_length, cond_T, None, ...) are shared by both branches
+    return cond_value if cond_value == uncond_value else NotImplemented
@@ -0,0 +1,185 @@
+"""SAMPLING ONLY."""
+import warnings
+
+import torch
+from tqdm import tqdm
+
+from ....lvdm.common import batch_randn
+from ....lvdm.models.samplers.ddim import DDIMSampler, subset_steps
+
+
+class MultistepSolverSampler(DDIMSampler):
+    """
+    Base of the deterministic multistep solvers of the diffusion ODE. Same `sample()` interface and conditioning
+    kwargs as DDIMSampler (cfg, `features_adapter`, `pose_emb`, `cond_T` / `guidance_windows`, `batched_cfg`,
+    ...), the unet is evaluated on the DDIM timesteps of the sampling plan. Solvers work on data predictions
+    x0 = (x - sigma_t * eps) / alpha_t in log-SNR time lambda_t = log(alpha_t / sigma_t), the last evaluation
+    returns its x0 prediction. `eta`, `temperature` and `noise_dropout` do not apply, a warning is issued when
+    they are not the defaults.
+    """
+    stochastic = False
+
+    def sample(self, *args, eta=0., temperature=1., noise_dropout=0., **kwargs):
+        ignored = {name: value for name, value, default in
+                   (('eta', eta, 0.), ('temperature', temperature, 1.), ('noise_dropout', noise_dropout, 0.))
+                   if value != default}
+        if ignored:
+            warnings.warn(f'{self.__class__.__name__} is deterministic, ignoring {ignored}', stacklevel=2)
+        return super().sample(*args, **kwargs)
+
+    def reset_solver(self):
+        self.history = []  # (ddim index, x0 prediction) of the previous evaluations, most recent last
+        self.lambdas = self.plan.sqrt_alphas.log() - self.plan.sqrt_one_minus_alphas.log()
+
+    def solver_step(self, x, pred_x0, index, next_index):
+        """ x at `next_index` from x and its x0 prediction at `index`, the final x0 if `next_index` is None """
+        raise NotImplementedError
+
+    @torch.no_grad()
+    def ddim_sampling(self, cond, shape,
+                      x_T=None, ddim_use_original_steps=False,
+                      callback=None, timesteps=None, quantize_denoised=False,
+                      mask=None, x0=None, img_callback=None, log_every_t=100,
+                      temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
+                      unconditional_guidance_scale=1., unconditional_conditioning=None, verbose=True,
+                      batched_cfg=False, generators=None, **kwargs):
+        assert not ddim_use_original_steps, f'{self.__class__.__name__} samples on the ddim timesteps only'
+        device = self.model.betas.device
+        b = shape[0]
+        if x_T is None:
+            img = torch.randn(shape, device=device) if generators is None else batch_randn(shape, generators, device)
+        else:
+            img = x_T
+
+        total_steps = self.ddim_timesteps.shape[0]
+        if timesteps is not None:
+            total_steps = subset_steps(timesteps, total_steps)
+        indices = list(reversed(range(total_steps)))
+
+        intermediates = {'x_inter': [img], 'pred_x0': [img]}
+        iterator = tqdm(indices, desc=self.__class__.__name__, total=total_steps) if verbose else indices
+
+        clean_cond = kwargs.pop("clean_cond", False)
+        guidance, unconditional_conditioning = self.guidance_schedule(
+            [self.ddim_timesteps[index] for index in indices], kwargs, unconditional_conditioning)
+        self.reset_solver()
+        for i, index in enumerate(iterator):
+            ts = self.plan.step_timesteps(index, b)
+
+            # use mask to blend noised original latent (img_orig) & new sampled latent (img)
+            if mask is not None:
+                assert x0 is not None
+                img_orig = x0 if clean_cond else self.model.q_sample(x0, ts)
+                img = img_orig * mask + (1. - mask) * img
+
+            step_kwargs, step_uc, step_scale = guidance.step_inputs(i, kwargs, unconditional_conditioning,
+                                                                    unconditional_guidance_scale)
+            e_t = self.guided_eps(img, cond, ts, unconditional_guidance_scale=step_scale,
+                                  unconditional_conditioning=step_uc,
+                                  batched_cfg=batched_cfg, score_corrector=score_corrector,
+                                  corrector_kwargs=corrector_kwargs, **step_kwargs)
+            del step_kwargs, step_uc
+            guidance.step_done(i, self)
+            pred_x0 = (img - self.plan.sqrt_one_minus_alphas[index] * e_t) / self.plan.sqrt_alphas[index]
+            if quantize_denoised:
+                pred_x0, _, *_ = self.model.first_stage_model.quantize(pred_x0)
+
+            next_index = indices[i + 1] if i + 1 < len(indices) else None
+            img = self.solver_step(img, pred_x0, index, next_index)
+            self.history = self.history[-2:]
+
+            if callback: callback(i)
+            if img_callback: img_callback(pred_x0, i)
+
+            if index % log_every_t == 0 or next_index is None:
+                intermediates['x_inter'].append(img)
+                intermediates['pred_x0'].append(pred_x0)
+
+        return img, intermediates
+
+
+class DPMSolverSampler(MultistepSolverSampler):
+    """ DPM-Solver++(2M) (https://arxiv.org/abs/2211.01095), first order on its first step """
+    def solver_step(self, x, pred_x0, index, next_index):
+        self.history.append((index, pred_x0))
+        if next_index is None:
+            return pred_x0
+        lambdas, alphas, sigmas = self.lambdas, self.plan.sqrt_alphas, self.plan.sqrt_one_minus_alphas
+        h = lambdas[next_index] - lambdas[index]
+        if len(self.history) < 2:
+            d = pred_x0
+        else:
+            prev_index, prev_x0 = self.history[-2]
+            r = (lambdas[index] - lambdas[prev_index]) / h
+            d = pred_x0 + (pred_x0 - prev_x0) / (2. * r)
+        return (sigmas[next_index] / sigmas[index]) * x - alphas[next_index] * torch.expm1(-h) * d
+
+
+class UniPCSampler(MultistepSolverSampler):
+    """
+    UniPC (https://arxiv.org/abs/2302.04867) with the B(h) = e^h - 1 variant (bh2): a 2nd order UniP predictor,
+    and a UniC corrector which refines each predicted point with the unet output already evaluated there,
+    so it costs no extra evaluation.
+    """
+    def reset_solver(self):
+        super().reset_solver()
+        self.last_x = None  # x at the most recent evaluation point, before its predictor step
+        self.last_order = None
+
+    def coefficients(self, index, s0_index):
+        h = self.lambdas[index] - self.lambdas[s0_index]
+        hh = -h  # data prediction
+        h_phi_1 = torch.expm1(hh)
+        return h, hh, h_phi_1, h_phi_1  # B(h) = h_phi_1 for bh2
+
+    def corrector(self, x_t, pred_x0, index):
+        alphas, sigmas = self.plan.sqrt_alphas, self.plan.sqrt_one_minus_alphas
+        s0_index, m0 = self.history[-1]
+        h, hh, h_phi_1, b_h = self.coefficients(index, s0_index)
+        x_t_ = (sigmas[index] / sigmas[s0_index]) * self.last_x - alphas[index] * h_phi_1 * m0
+        d1_t = pred_x0 - m0
+        if self.last_order == 1:
+            return x_t_ - alphas[index] * b_h * 0.5 * d1_t
+        # rhos solve [[1, 1], [r1, 1]] @ rhos = [b1, b2]
+        s1_index, m1 = self.history[-2]
+        r1 = (self.lambdas[s1_index] - self.lambdas[s0_index]) / h
+        h_phi_k = h_phi_1 / hh - 1.
+        b1 = h_phi_k / b_h
+        b2 = (h_phi_k / hh - 0.5) * 2. / b_h
+        rho_0 = (b1 - b2) / (1. - r1)
+        rho_1 = b1 - rho_0
+        corr_res = rho_0 * (m1 - m0) / r1
+        return x_t_ - alphas[index] * b_h * (corr_res + rho_1 * d1_t)
+
+    def predictor(self, x, next_index, order):
+        alphas, sigmas = self.plan.sqrt_alphas, self.plan.sqrt_one_minus_alphas
+        s0_index, m0 = self.history[-1]
+        h, hh, h_phi_1, b_h = self.coefficients(next_index, s0_index)
+        x_t_ = (sigmas[next_index] / sigmas[s0_index]) * x - alphas[next_index] * h_phi_1 * m0
+        if order == 1:
+            return x_t_
+        s1_index, m1 = self.history[-2]
+        r1 = (self.lambdas[s1_index] - self.lambdas[s0_index]) / h
+        return x_t_ - alphas[next_index] * b_h * 0.5 * (m1 - m0) / r1
+
+    def solver_step(self, x, pred_x0, index, next_index):
+        if self.last_x is not None:
+            x = self.corrector(x, pred_x0, index)
+        self.history.append((index, pred_x0))
+        if next_index is None:
+            return pred_x0
+        self.last_x = x
+        self.last_order = min(2, len(self.history))
+        return self.predictor(x, next_index, self.last_order)
+
+
+SAMPLERS = {
+    'ddim': DDIMSampler,
+    'dpmpp_2m': DPMSolverSampler,
+    'unipc': UniPCSampler,
+}
+
+
+def make_sampler(name, model, compile=None):
+    assert name in SAMPLERS, f"Error: sampler should be one of {list(SAMPLERS.keys())}, got {name}"
+    return SAMPLERS[name](model, compile=compile)
@@ -7,14 +7,9 @@ import torch.nn.functional as F
 from einops import rearrange, repeat
 from torch import einsum, nn
 
-try:
-    import xformers
-    import xformers.ops
-    XFORMERS_IS_AVAILBLE = True
-except:
-    XFORMERS_IS_AVAILBLE = False
 from ...lvdm.basics import conv_nd, normalization, zero_module
 from ...lvdm.common import checkpoint, default, exists, init_, max_neg_value, uniq
+from ...lvdm.modules.attention_backend import MAX_ATTENTION_BATCH, attention
 
 
 class RelativePosition(nn.Module):
@@ -41,6 +36,14 @@ class RelativePosition(nn.Module):
         return embeddings
 
 
+def shared_context_groups(x, context):
+    """ number r of consecutive sequences of x [(b r) ...] attending to each sequence of context [b ...] """
+    if context.shape[0] == 0 or x.shape[0] % context.shape[0] != 0:
+        raise ValueError(f'a batch of {x.shape[0]} query sequences cannot share a context batch of '
+                         f'{context.shape[0]}, it should divide it')
+    return x.shape[0] // context.shape[0]
+
+
 class CrossAttention(nn.Module):
 
     def __init__(self, query_dim, context_dim=None, heads=8, dim_head=64, dropout=0., 
@@ -63,19 +66,25 @@ class CrossAttention(nn.Module):
             assert(temporal_length is not None)
             self.relative_position_k = RelativePosition(num_units=dim_head, max_relative_position=temporal_length)
             self.relative_position_v = RelativePosition(num_units=dim_head, max_relative_position=temporal_length)
-        else:
-            ## only used for spatial attention, while NOT for temporal attention
-            if XFORMERS_IS_AVAILBLE and temporal_length is None:
-                self.forward = self.efficient_forward
 
     def forward(self, x, context=None, mask=None):
+        if exists(context) and context.shape[0] != x.shape[0] and not self.relative_position and not exists(mask):
+            return self.shared_context_forward(x, context)
         h = self.heads
 
         q = self.to_q(x)
         context = default(context, x)
         k = self.to_k(context)
         v = self.to_v(context)
-
+        if k.shape[0] != q.shape[0]:
+            ## relative positions / masks depend on the query length: broadcast the projected context instead,
+            ## only its projection is shared, k/v take the memory of one context per query sequence
+            k, v = map(lambda t: t.repeat_interleave(shared_context_groups(q, t), dim=0), (k, v))
+        if not self.relative_position:
+            ## naive / xformers / sdpa, see attention_backend.py
+            return self.to_out(attention(q, k, v, h, mask=mask))
+
+        ## relative positions add terms to the similarity matrix and to the output, always computed explicitly
         q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h), (q, k, v))
         sim = torch.einsum('b i d, b j d -> b i j', q, k) * self.scale
         if self.relative_position:
@@ -102,33 +111,17 @@ class CrossAttention(nn.Module):
         out = rearrange(out, '(b h) n d -> b n (h d)', h=h)
         return self.to_out(out)
     
-    def efficient_forward(self, x, context=None, mask=None):
-        q = self.to_q(x)
-        context = default(context, x)
-        k = self.to_k(context)
-        v = self.to_v(context)
-
-        b, _, _ = q.shape
-        q, k, v = map(
-            lambda t: t.unsqueeze(3)
-            .reshape(b, t.shape[1], self.heads, self.dim_head)
-            .permute(0, 2, 1, 3)
-            .reshape(b * self.heads, t.shape[1], self.dim_head)
-            .contiguous(),
-            (q, k, v),
-        )
-        # actually compute the attention, what we cannot get enough of
-        out = xformers.ops.memory_efficient_attention(q, k, v, attn_bias=None, op=None)
-
-        if exists(mask):
-            raise NotImplementedError
-        out = (
-            out.unsqueeze(0)
-            .reshape(b, self.heads, out.shape[1], self.dim_head)
-            .permute(0, 2, 1, 3)
-            .reshape(b, out.shape[1], self.heads * self.dim_head)
-        )
-        return self.to_out(out)
+    def shared_context_forward(self, x, context):
+        """
+        x [(b r) n c] where each group of r consecutive sequences attends to the same context [b l c].
+        Without mask / relative positions the queries are independent, so each group is folded into a
+        single query sequence rather than repeating the context r times. With them, forward repeats the projected
+        k/v r times instead, which saves the context projections but no attention memory.
+        """
+        r = shared_context_groups(x, context)
+        x = rearrange(x, '(b r) n c -> b (r n) c', r=r)
+        out = self.forward(x, context=context)
+        return rearrange(out, 'b (r n) c -> (b r) n c', r=r)
 
 
 class BasicTransformerBlock(nn.Module):
@@ -223,8 +216,8 @@ class SpatialTransformer(nn.Module):
         if not self.use_linear:
             x = self.proj_out(x)
         return x + x_in
-    
-    
+
+
 class TemporalTransformer(nn.Module):
     """
     Transformer block for image-like data in temporal axis.
@@ -273,6 +266,29 @@ class TemporalTransformer(nn.Module):
             self.proj_out = zero_module(nn.Linear(inner_dim, in_channels))
         self.use_linear = use_linear
 
+    def cross_attention_blocks(self, x, context, t, hw):
+        """
+        x [(b hw) t c] attending to context [(b t) l con], every sample to the context of its first frame.
+        Samples are processed in chunks as large as MAX_ATTENTION_BATCH allows, the context is passed once
+        per sample and shared by its hw sequences (see CrossAttention.shared_context_forward; with relative
+        positions it is repeated per sequence after its projection, as memory hungry as the per-sample loop was).
+        """
+        if context.shape[0] % t != 0 or x.shape[0] != context.shape[0] // t * hw:
+            raise ValueError(f'context of {context.shape[0]} frames does not match {x.shape[0]} query sequences '
+                             f'of {t} frames, expected {x.shape[0] // hw * t} frames for {hw} sequences per sample')
+        context = rearrange(context, '(b t) l con -> b t l con', t=t)[:, 0].contiguous()
+        b = context.shape[0]
+        heads = self.transformer_blocks[0].attn1.heads
+        chunk = max(1, MAX_ATTENTION_BATCH // (hw * heads))
+        out = []
+        for j in range(0, b, chunk):
+            x_j = x[j * hw:(j + chunk) * hw]
+            for i, block in enumerate(self.transformer_blocks):
+                ## note: causal mask will not applied in cross-attention case
+                x_j = block(x_j, context=context[j:j + chunk])
+            out.append(x_j)
+        return out[0] if len(out) == 1 else torch.cat(out, dim=0)
+
     def forward(self, x, context=None, is_imgbatch=False):
         b, c, t, h, w = x.shape
         x_in = x
@@ -301,15 +317,8 @@ class TemporalTransformer(nn.Module):
                 x = block(x, mask=mask)
             x = rearrange(x, '(b hw) t c -> b hw t c', b=b).contiguous()
         else:
+            x = self.cross_attention_blocks(x, context, t, h * w)
             x = rearrange(x, '(b hw) t c -> b hw t c', b=b).contiguous()
-            context = rearrange(context, '(b t) l con -> b t l con', t=t).contiguous()
-            for i, block in enumerate(self.transformer_blocks):
-                # calculate each batch one by one (since number in shape could not greater then 65,535 for some package)
-                for j in range(b):
-                    unit_context = context[j][0:1]
-                    context_j = repeat(unit_context, 't l con -> (t r) l con', r=(h * w)).contiguous()
-                    ## note: causal mask will not applied in cross-attention case
-                    x[j] = block(x[j], context=context_j)
         
         if self.use_linear:
             x = self.proj_out(x)
@@ -0,0 +1,118 @@
+import os
+
+import torch
+import torch.nn.functional as F
+from einops import rearrange, repeat
+
+try:
+    import xformers
+    import xformers.ops
+    XFORMERS_IS_AVAILBLE = True
+except:
+    XFORMERS_IS_AVAILBLE = False
+SDPA_IS_AVAILBLE = hasattr(F, 'scaled_dot_product_attention')
+
+ATTENTION_BACKENDS = ['auto', 'naive', 'xformers', 'sdpa']
+## batch x heads limit of the attention kernels of some packages (CUDA grid dimension), see attention
+MAX_ATTENTION_BATCH = 65535
+
+
+def resolve_attention_backend(name='auto'):
+    """ 'auto' -> the fastest available backend: xformers, then torch's fused sdpa, then naive """
+    if name not in ATTENTION_BACKENDS:
+        raise ValueError(f"attention backend should be one of {ATTENTION_BACKENDS}, got {name}")
+    if name == 'auto':
+        return 'xformers' if XFORMERS_IS_AVAILBLE else 'sdpa' if SDPA_IS_AVAILBLE else 'naive'
+    if name == 'xformers' and not XFORMERS_IS_AVAILBLE:
+        raise ValueError("attention backend 'xformers' requested but xformers is not installed")
+    if name == 'sdpa' and not SDPA_IS_AVAILBLE:
+        raise ValueError("attention backend 'sdpa' requires torch>=2.0")
+    return name
+
+
+## process-wide like the inference switch, chosen when the model is loaded (MOTIONCTRL_ATTENTION sets the default)
+_ATTENTION_BACKEND = resolve_attention_backend(os.environ.get('MOTIONCTRL_ATTENTION') or 'auto')
+
+
+def set_attention_backend(name='auto'):
+    global _ATTENTION_BACKEND
+    _ATTENTION_BACKEND = resolve_attention_backend(name)
+    return _ATTENTION_BACKEND
+
+
+def get_attention_backend():
+    return _ATTENTION_BACKEND
+
+
+def naive_attention(q, k, v, heads, mask=None):
+    """ einsum / softmax / einsum, materialises the [(b h), n, m] similarity matrix """
+    scale = (q.shape[-1] // heads) ** -0.5
+    q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=heads), (q, k, v))
+    sim = torch.einsum('b i d, b j d -> b i j', q, k) * scale
+    del q, k
+    if mask is not None:
+        max_neg_value = -torch.finfo(sim.dtype).max
+        mask = repeat(mask.expand(v.shape[0] // heads, -1, -1), 'b i j -> (b h) i j', h=heads)
+        sim.masked_fill_(~mask, max_neg_value)
+    sim = sim.softmax(dim=-1)
+    out = torch.einsum('b i j, b j d -> b i d', sim, v)
+    return rearrange(out, '(b h) n d -> b n (h d)', h=heads)
+
+
+def sdpa_attention(q, k, v, heads, mask=None):
+    """ torch.nn.functional.scaled_dot_product_attention, fused kernels without the similarity matrix """
+    q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h=heads), (q, k, v))
+    if mask is not None:
+        mask = mask[:, None]  # broadcast over heads
+    out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+    return rearrange(out, 'b h n d -> b n (h d)')
+
+
+def xformers_attention(q, k, v, heads):
+    b, _, _ = q.shape
+    dim_head = q.shape[-1] // heads
+    q, k, v = map(
+        lambda t: t.unsqueeze(3)
+        .reshape(b, t.shape[1], heads, dim_head)
+        .permute(0, 2, 1, 3)
+        .reshape(b * heads, t.shape[1], dim_head)
+        .contiguous(),
+        (q, k, v),
+    )
+    out = xformers.ops.memory_efficient_attention(q, k, v, attn_bias=None, op=None)
+    return (
+        out.unsqueeze(0)
+        .reshape(b, heads, out.shape[1], dim_head)
+        .permute(0, 2, 1, 3)
+        .reshape(b, out.shape[1], heads * dim_head)
+    )
+
+
+def attention(q, k, v, heads, mask=None, backend=None):
+    """
+    Multi-head attention of q [b n (h d)] over k, v [b m (h d)], returns [b n (h d)].
+    :param mask: optional [b or 1, n, m], True / >0.5 marks the keys a query may attend to (causal or identity
+                 masks of TemporalTransformer), shared by all heads. Every query must keep at least one key,
+                 fully masked rows are NaN on sdpa.
+    :param backend: one of ATTENTION_BACKENDS, the process-wide backend if None. Masked calls on xformers run
+                    on sdpa instead.
+    A batch whose b * heads exceeds MAX_ATTENTION_BATCH (temporal attention has b = batch * h * w, doubled by
+    batched cfg) runs in chunks of sequences below it, on every backend.
+    """
+    backend = get_attention_backend() if backend is None else resolve_attention_backend(backend)
+    chunk = max(1, MAX_ATTENTION_BATCH // heads)
+    if q.shape[0] > chunk:
+        per_sequence_mask = mask is not None and mask.shape[0] > 1
+        return torch.cat([attention(q[i:i + chunk], k[i:i + chunk], v[i:i + chunk], heads,
+                                    mask=mask[i:i + chunk] if per_sequence_mask else mask, backend=backend)
+                          for i in range(0, q.shape[0], chunk)], dim=0)
+    if mask is not None:
+        mask = mask.to(q.device)
+        mask = mask if mask.dtype == torch.bool else mask > 0.5
+        if backend == 'xformers':
+            backend = 'sdpa' if SDPA_IS_AVAILBLE else 'naive'
+    if backend == 'xformers':
+        return xformers_attention(q, k, v, heads)
+    if backend == 'sdpa':
+        return sdpa_attention(q, k, v, heads, mask)
+    return naive_attention(q, k, v, heads, mask)
@@ -6,13 +6,7 @@ import torch as th
 from torch import nn, einsum
 import torch.nn.functional as F
 from einops import rearrange, repeat
-try:
-    import xformers
-    import xformers.ops
-    XFORMERS_IS_AVAILBLE = True
-except:
-    XFORMERS_IS_AVAILBLE = False
-    
+
 from ...lvdm.common import (
     checkpoint,
     exists,
@@ -26,6 +20,7 @@ from ...lvdm.basics import (
     zero_module,
     normalization
 )
+from ...lvdm.modules.attention_backend import attention
 
 
 class GEGLU(nn.Module):
@@ -194,6 +189,12 @@ class TemporalCrossAttention(nn.Module):
         v = self.to_v(context)
         # print(f'q ={q.shape},k={k.shape}')
 
+        if not (self.use_relative_position or self.bidirectional_causal_attn or self.img_video_joint_train):
+            ## naive / xformers / sdpa, see attention_backend.py
+            if exists(self.mask):
+                mask = self.mask.bool() if mask is None else self.mask.bool() & mask.bool()
+            return self.to_out(attention(q, k, v, nh, mask=mask))
+
         q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=nh), (q, k, v))
         sim = einsum('b i d, b j d -> b i j', q, k) * self.scale
 
@@ -289,8 +290,6 @@ class CrossAttention(nn.Module):
             nn.Linear(inner_dim, query_dim),
             nn.Dropout(dropout)
         )
-        if XFORMERS_IS_AVAILBLE:
-            self.forward = self.efficient_forward
 
     def forward(self, x, context=None, mask=None):
         h = self.heads
@@ -307,49 +306,12 @@ class CrossAttention(nn.Module):
             else:
                 raise NotImplementedError
 
-        q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h), (q, k, v))
-
-        sim = einsum('b i d, b j d -> b i j', q, k) * self.scale
-
         if exists(mask):
-            mask = rearrange(mask, 'b ... -> b (...)')
-            max_neg_value = -torch.finfo(sim.dtype).max
-            mask = repeat(mask, 'b j -> (b h) () j', h=h)
-            sim.masked_fill_(~mask, max_neg_value)
+            ## key mask [b, ...] shared by all queries & heads
+            mask = rearrange(mask, 'b ... -> b () (...)')
 
         # attention, what we cannot get enough of
-        attn = sim.softmax(dim=-1)
-
-        out = einsum('b i j, b j d -> b i d', attn, v)
-        out = rearrange(out, '(b h) n d -> b n (h d)', h=h)
-        return self.to_out(out)
-    
-    def efficient_forward(self, x, context=None, mask=None):
-        q = self.to_q(x)
-        context = default(context, x)
-        k = self.to_k(context)
-        v = self.to_v(context)
-
-        b, _, _ = q.shape
-        q, k, v = map(
-            lambda t: t.unsqueeze(3)
-            .reshape(b, t.shape[1], self.heads, self.dim_head)
-            .permute(0, 2, 1, 3)
-            .reshape(b * self.heads, t.shape[1], self.dim_head)
-            .contiguous(),
-            (q, k, v),
-        )
-        # actually compute the attention, what we cannot get enough of
-        out = xformers.ops.memory_efficient_attention(q, k, v, attn_bias=None, op=None)
-
-        if exists(mask):
-            raise NotImplementedError
-        out = (
-            out.unsqueeze(0)
-            .reshape(b, self.heads, out.shape[1], self.dim_head)
-            .permute(0, 2, 1, 3)
-            .reshape(b, out.shape[1], self.heads * self.dim_head)
-        )
+        out = attention(q, k, v, h, mask=mask)
         return self.to_out(out)
 
 class VideoSpatialCrossAttention(CrossAttention):
@@ -0,0 +1,77 @@
+"""
+Op-count / latency benchmark of one `apply_model` call outside `inference_context()` (activation checkpointing,
+autograd bookkeeping) and inside it (checkpointing bypassed, torch.inference_mode()).
+Without --ckpt_path the model keeps its random initialisation, which is enough for timing.
+"""
+import argparse
+import time
+
+import torch
+from omegaconf import OmegaConf
+from torch.profiler import ProfilerActivity, profile
+
+from ...lvdm.common import inference_context
+from ...utils.utils import instantiate_from_config
+from .motionctrl_inference import load_model_checkpoint
+
+
+def make_inputs(model, batch_size=1, height=256, width=256, device='cuda'):
+    t = model.temporal_length
+    x = torch.randn(batch_size, model.channels, t, height // 8, width // 8, device=device)
+    ts = torch.full((batch_size,), 500, device=device, dtype=torch.long)
+    context = torch.randn(batch_size, 77, 1024, device=device)
+    pose_emb = torch.randn(batch_size, t, 12, 1, device=device)
+    return x, ts, context, {'pose_emb': pose_emb, 'temporal_length': t}
+
+
+def run_apply_model(model, inputs, inference, repeats=5):
+    """ (ops per call, seconds per call) of `model.apply_model` """
+    x, ts, context, kwargs = inputs
+    sync = torch.cuda.synchronize if x.is_cuda else (lambda: None)
+    # the baseline matches sampling outside inference_context: no_grad, every block routed through `checkpoint`
+    with torch.no_grad(), inference_context(inference):
+        model.apply_model(x, ts, context, **kwargs)  # warm up
+        sync()
+        start = time.time()
+        for _ in range(repeats):
+            model.apply_model(x, ts, context, **kwargs)
+        sync()
+        seconds = (time.time() - start) / repeats
+
+        activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if x.is_cuda else [])
+        with profile(activities=activities) as prof:
+            model.apply_model(x, ts, context, **kwargs)
+    ops = sum(event.count for event in prof.key_averages())
+    return ops, seconds
+
+
+def benchmark_apply_model(model, batch_size=1, height=256, width=256, repeats=5):
+    device = model.betas.device
+    inputs = make_inputs(model, batch_size, height, width, device)
+    results = {}
+    for inference in (False, True):
+        results[inference] = run_apply_model(model, inputs, inference, repeats)
+    for inference, (ops, seconds) in results.items():
+        print(f'inference mode {"on " if inference else "off"}: {ops:8d} profiled ops, {seconds * 1000:8.1f} ms / apply_model')
+    return results
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base", type=str, required=True, help="config (yaml) path")
+    parser.add_argument("--ckpt_path", type=str, default=None, help="checkpoint path, random weights if not set")
+    parser.add_argument("--bs", type=int, default=1, help="batch size")
+    parser.add_argument("--height", type=int, default=256)
+    parser.add_argument("--width", type=int, default=256)
+    parser.add_argument("--repeats", type=int, default=5)
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    config = OmegaConf.load(args.base)
+    model = instantiate_from_config(config.pop("model", OmegaConf.create()))
+    if args.ckpt_path:
+        model = load_model_checkpoint(model, args.ckpt_path)
+    model = model.to('cuda' if torch.cuda.is_available() else 'cpu').eval()
+    benchmark_apply_model(model, args.bs, args.height, args.width, args.repeats)
@@ -0,0 +1,97 @@
+"""
+Parity / latency benchmark of the attention backends (naive, xformers, sdpa) on the attention shapes of the unet:
+spatial self-attention over h*w tokens, spatial cross-attention to the 77 text tokens and masked temporal
+self-attention over the frames. Runs on CPU; fails if a backend deviates from naive by more than --atol.
+"""
+import argparse
+import sys
+import time
+
+import torch
+
+from ...lvdm.modules.attention_backend import ATTENTION_BACKENDS, attention, resolve_attention_backend
+
+
+def available_backends():
+    backends = []
+    for name in ATTENTION_BACKENDS[1:]:
+        try:
+            backends.append(resolve_attention_backend(name))
+        except ValueError:
+            pass
+    return backends
+
+
+def make_case(batch, n, m, heads, dim_head, causal=False, device='cpu', dtype=torch.float32):
+    q = torch.randn(batch, n, heads * dim_head, device=device, dtype=dtype)
+    k = torch.randn(batch, m, heads * dim_head, device=device, dtype=dtype)
+    v = torch.randn(batch, m, heads * dim_head, device=device, dtype=dtype)
+    mask = torch.tril(torch.ones([1, n, m], device=device)) if causal else None
+    return q, k, v, mask
+
+
+def time_backend(backend, q, k, v, heads, mask, repeats):
+    sync = torch.cuda.synchronize if q.is_cuda else (lambda: None)
+    with torch.no_grad():
+        out = attention(q, k, v, heads, mask=mask, backend=backend)  # warm up
+        sync()
+        start = time.time()
+        for _ in range(repeats):
+            attention(q, k, v, heads, mask=mask, backend=backend)
+        sync()
+    return out, (time.time() - start) / repeats
+
+
+def benchmark_attention(cases, heads=5, dim_head=64, repeats=5, device='cpu', dtype=torch.float32):
+    """ {(case name, backend): (max abs error vs naive, seconds per call)} """
+    results = {}
+    for name, (batch, n, m, causal) in cases.items():
+        q, k, v, mask = make_case(batch, n, m, heads, dim_head, causal, device, dtype)
+        reference = None
+        for backend in available_backends():
+            if backend == 'xformers' and not q.is_cuda:
+                continue
+            out, seconds = time_backend(backend, q, k, v, heads, mask, repeats)
+            if reference is None:
+                reference = out.float()
+            error = (out.float() - reference).abs().max().item()
+            results[(name, backend)] = (error, seconds)
+            # the naive backend holds a [(b h), n, m] similarity matrix
+            sim_mb = batch * heads * n * m * q.element_size() / 2 ** 20
+            print(f'{name:>20s} {backend:>8s}: {seconds * 1000:9.2f} ms, max abs err {error:.2e}'
+                  + (f', similarity matrix {sim_mb:.1f} MB' if backend == 'naive' else ''))
+    return results
+
+
+def default_cases(latent_size=32, frames=16, batch=2):
+    hw = latent_size * latent_size
+    return {
+        f'spatial self {hw // 16}': (batch * frames, hw // 16, hw // 16, False),
+        f'spatial self {hw // 4}': (batch * frames, hw // 4, hw // 4, False),
+        f'spatial self {hw}': (batch * frames, hw, hw, False),
+        f'spatial cross {hw}x77': (batch * frames, hw, 77, False),
+        f'temporal causal {frames}': (batch * hw, frames, frames, True),
+    }
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latent_size", type=int, default=32, help="latent h = w, 32 for 256x256 videos")
+    parser.add_argument("--frames", type=int, default=16)
+    parser.add_argument("--bs", type=int, default=1, help="batch size (x2 for cfg)")
+    parser.add_argument("--heads", type=int, default=5)
+    parser.add_argument("--dim_head", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--device", type=str, default='cpu')
+    parser.add_argument("--atol", type=float, default=1e-4, help="fail above this max abs error vs naive")
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    cases = default_cases(args.latent_size, args.frames, 2 * args.bs)
+    results = benchmark_attention(cases, args.heads, args.dim_head, args.repeats, args.device)
+    failed = [key for key, (error, _) in results.items() if error > args.atol]
+    for name, backend in failed:
+        print(f'>>> {backend} deviates from naive on {name}')
+    sys.exit(1 if failed else 0)
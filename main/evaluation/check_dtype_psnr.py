@@ -0,0 +1,79 @@
+"""
+Regression check of half precision inference: samples the same prompt / camera pose / trajectory with
+identical noise in fp32 and in `--dtype`, and fails if the PSNR of the decoded videos drops below `--min_psnr`.
+"""
+import argparse
+import gc
+import math
+import sys
+
+import torch
+
+from .motionctrl_inference import INFERENCE_DTYPES, build_model, load_camera_pose, load_trajs, motionctrl_sample
+
+
+def video_psnr(reference, video):
+    """ PSNR (dB) between two videos in [-1, 1] """
+    reference = reference.float().clamp(-1., 1.)
+    video = video.float().clamp(-1., 1.)
+    mse = ((reference - video) / 2.).pow(2).mean().item()
+    return float('inf') if mse == 0 else 10. * math.log10(1. / mse)
+
+
+def sample_with_dtype(args, dtype, device):
+    model = build_model(args.base, args.ckpt_path, adapter_ckpt=args.adapter_ckpt, device=device, dtype=dtype)
+    h, w = args.height // 8, args.width // 8
+    noise_shape = [1, model.channels, model.temporal_length, h, w]
+    camera_poses, _ = load_camera_pose(args.cond_dir, [args.camera_pose])
+    trajs, _ = load_trajs(args.cond_dir, [args.traj]) if args.traj else (None, None)
+
+    # the sampler draws x_T and the ddim noise from the global generator
+    torch.manual_seed(args.seed)
+    videos = motionctrl_sample(
+        model,
+        [args.prompt],
+        noise_shape,
+        camera_poses=camera_poses[0][None].to(device),
+        trajs=None if trajs is None else trajs[0][None].to(device),
+        unconditional_guidance_scale=args.unconditional_guidance_scale,
+        ddim_steps=args.ddim_steps,
+        ddim_eta=args.ddim_eta,
+        cond_T=args.cond_T,
+    )
+    videos = videos.float().cpu()
+    del model
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    return videos
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt_path", type=str, required=True, help="checkpoint path")
+    parser.add_argument("--adapter_ckpt", type=str, default=None, help="adapter checkpoint path")
+    parser.add_argument("--base", type=str, required=True, help="config (yaml) path")
+    parser.add_argument("--cond_dir", type=str, default='examples', help="condition dir")
+    parser.add_argument("--camera_pose", type=str, default='test_camera_L', help="camera pose name in cond_dir/camera_poses")
+    parser.add_argument("--traj", type=str, default=None, help="trajectory name in cond_dir/trajectories")
+    parser.add_argument("--prompt", type=str, default='a rose swaying in the wind')
+    parser.add_argument("--dtype", type=str, default='fp16', choices=list(INFERENCE_DTYPES.keys()), help="precision checked against fp32")
+    parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument("--ddim_steps", type=int, default=25)
+    parser.add_argument("--ddim_eta", type=float, default=0.0)
+    parser.add_argument("--height", type=int, default=256)
+    parser.add_argument("--width", type=int, default=256)
+    parser.add_argument("--unconditional_guidance_scale", type=float, default=7.5)
+    parser.add_argument("--cond_T", type=int, default=800)
+    parser.add_argument("--seed", type=int, default=20230211)
+    parser.add_argument("--min_psnr", type=float, default=30.0, help="fail below this PSNR (dB)")
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    reference = sample_with_dtype(args, 'fp32', args.device)
+    video = sample_with_dtype(args, args.dtype, args.device)
+    psnr = video_psnr(reference, video)
+    print(f'>>> {args.dtype} vs fp32: PSNR {psnr:.2f} dB (min {args.min_psnr:.2f} dB)')
+    sys.exit(0 if psnr >= args.min_psnr else 1)
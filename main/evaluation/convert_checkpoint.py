@@ -0,0 +1,52 @@
+"""
+One-shot conversion of a MotionCtrl .pth checkpoint (lightning or deepspeed) into a plain
+.safetensors file, which `load_model_checkpoint` streams into the model without a full host copy.
+The unwrapping is the one of `load_model_checkpoint`; the `wrapper` metadata keeps whether the source was a
+deepspeed checkpoint, whose keys are then checked strictly on load as for the .pth.
+
+    python -m <package>.main.evaluation.convert_checkpoint --ckpt_path checkpoints/motionctrl.pth
+"""
+import argparse
+import os
+from collections import OrderedDict
+
+import torch
+from safetensors.torch import save_file
+
+from .motionctrl_inference import load_state_dict_file, unwrap_state_dict
+
+
+def convert_checkpoint(ckpt_path, out_path=None):
+    if out_path is None:
+        out_path = os.path.splitext(ckpt_path)[0] + '.safetensors'
+    state_dict, is_deepspeed = unwrap_state_dict(load_state_dict_file(ckpt_path))
+
+    tensors = OrderedDict()
+    seen_storages = set()
+    for key, value in state_dict.items():
+        if not isinstance(value, torch.Tensor):
+            print(f'skip non-tensor entry {key}')
+            continue
+        # safetensors refuses tensors sharing memory, give every duplicate its own storage
+        storage_ptr = value.untyped_storage().data_ptr()
+        if storage_ptr in seen_storages:
+            value = value.clone()
+        seen_storages.add(storage_ptr)
+        tensors[key] = value.contiguous()
+
+    save_file(tensors, out_path, metadata={'format': 'pt', 'source': os.path.basename(ckpt_path),
+                                           'wrapper': 'deepspeed' if is_deepspeed else 'lightning'})
+    print(f'>>> {len(tensors)} tensors written to {out_path}')
+    return out_path
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt_path", type=str, required=True, help="input .pth checkpoint path")
+    parser.add_argument("--out_path", type=str, default=None, help="output .safetensors path, defaults next to the input")
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    convert_checkpoint(args.ckpt_path, args.out_path)
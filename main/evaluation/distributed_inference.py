@@ -0,0 +1,247 @@
+"""
+Sharded batch inference for evaluation sweeps. The (prompt, camera pose, trajectory) items of --condtype are
+split in batches of --bs items and handed out by the parent to one worker process per device (every local GPU,
+or --cpu_workers processes without CUDA) as it frees up, so faster devices take more of the sweep.
+Each worker loads the conditions of its next --prefetch batches in a background thread while it samples.
+The parent process is the only writer of <savedir>/manifest.jsonl, one line per finished or failed item; a rerun
+skips the items already done there. Each batch is seeded with --seed plus the index of its first item, whichever
+worker runs it. Items of a failed batch are retried one by one, with the seed of their batch, up to --max_retries
+times; when a worker dies, the items of the batch it was sampling count as failed and the batches it had not
+started go back on the queue as they were.
+Takes the sampling options of motionctrl_inference.py, e.g.
+    python -m <package>.main.evaluation.distributed_inference --base configs/inference/config_both.yaml \
+        --ckpt_path motionctrl.pth --condtype both --cond_dir examples --savedir results --bs 2
+"""
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+import torch
+import torch.multiprocessing as mp
+from pytorch_lightning import seed_everything
+
+from .motionctrl_inference import (eval_items, get_parser, item_filename, load_item_conditions, load_model,
+                                   sample_items)
+
+MANIFEST_NAME = 'manifest.jsonl'
+
+
+class Manifest(object):
+    """ append-only record of the processed items of a sweep, the last record of an item wins """
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # line cut short by a crash
+                    self.records[record['name']] = record
+
+    def is_done(self, name):
+        record = self.records.get(name)
+        return record is not None and record['status'] == 'done'
+
+    def append(self, record):
+        self.records[record['name']] = record
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+
+
+def worker_devices(cpu_workers=1):
+    if torch.cuda.is_available():
+        return [f'cuda:{i}' for i in range(torch.cuda.device_count())]
+    return ['cpu'] * cpu_workers
+
+
+def prefetch_batches(device, args, task_queue, batches):
+    """
+    moves the (items, seed) batches the parent sent to this worker into the bounded local queue `batches`, with
+    their conditions loaded and copied to the device; a None task ends the worker
+    """
+    while True:
+        task = task_queue.get()
+        if task is None:
+            batches.put(None)
+            return
+        items, seed = task
+        try:
+            camera_poses, trajs = load_item_conditions(args.cond_dir, items)
+            to_device = lambda x: None if x is None else \
+                (x.pin_memory() if device.type == 'cuda' else x).to(device, non_blocking=True)
+            batches.put((items, seed, to_device(camera_poses), to_device(trajs), None))
+        except Exception:
+            batches.put((items, seed, None, None, traceback.format_exc()))
+
+
+def worker_main(rank, device, args, task_queue, result_queue):
+    device = torch.device(device)
+    if device.type == 'cuda':
+        torch.cuda.set_device(device)
+    try:
+        model = load_model(args.base, args.ckpt_path, adapter_ckpt=args.adapter_ckpt, device=device, dtype=args.dtype,
+                           attention=args.attention)
+    except Exception:
+        result_queue.put(('exit', rank, traceback.format_exc()))
+        return
+    savedir = os.path.join(args.savedir, "samples")
+    batches = queue.Queue(maxsize=max(args.prefetch, 1))
+    threading.Thread(target=prefetch_batches, args=(device, args, task_queue, batches), daemon=True).start()
+    while True:
+        batch = batches.get()
+        if batch is None:
+            break
+        items, seed, camera_poses, trajs, error = batch
+        start = time.time()
+        if error is None:
+            try:
+                # seeded by the batch, not by the worker that happens to run it; a single sample draws its noise
+                # from the global RNG
+                seed_everything(seed)
+                filenames = sample_items(model, args, items, camera_poses, trajs, savedir, seed=seed)
+            except Exception:
+                error = traceback.format_exc()
+                if device.type == 'cuda':
+                    torch.cuda.empty_cache()
+        seconds = (time.time() - start) / len(items)
+        for n, item in enumerate(items):
+            if error is None:
+                result_queue.put(('done', rank, item.index, {'file': filenames[n], 'seconds': seconds}))
+            else:
+                result_queue.put(('failed', rank, item.index, {'error': error}))
+    result_queue.put(('exit', rank, None))
+
+
+def run_distributed(args):
+    """ runs the sweep of --condtype over all local devices, returns the number of items not done """
+    assert (args.height % 16 == 0) and (args.width % 16 == 0), "Error: image size [h,w] should be multiples of 16!"
+    os.makedirs(os.path.join(args.savedir, "samples"), exist_ok=True)
+    manifest = Manifest(os.path.join(args.savedir, MANIFEST_NAME))
+    items = {item.index: item for item in eval_items(args.condtype)}
+    pending = [item for item in items.values() if not manifest.is_done(item_filename(item))]
+    print(f'>>> {len(items) - len(pending)}/{len(items)} items already done in {manifest.path}')
+    if not pending:
+        return 0
+
+    # (items, seed) batches to hand out, a retried item keeps the seed of the batch it was first sampled in
+    todo = deque((batch, args.seed + batch[0].index) for batch in
+                 (pending[i:i + args.bs] for i in range(0, len(pending), args.bs)))
+    seeds = {item.index: seed for batch, seed in todo for item in batch}
+    devices = worker_devices(args.cpu_workers)
+    ctx = mp.get_context('spawn')
+    result_queue = ctx.Queue()
+    task_queues, workers = {}, {}
+    for rank, device in enumerate(devices):
+        task_queues[rank] = ctx.Queue()
+        workers[rank] = ctx.Process(target=worker_main, args=(rank, device, args, task_queues[rank], result_queue))
+        workers[rank].start()
+    print(f'>>> {len(pending)} items on {len(devices)} workers: {devices}')
+
+    # the batches sent to a worker and not fully reported yet, as sets of item indices in the order the worker
+    # runs them; a worker holds at most the batch it samples plus --prefetch more, the rest stays in `todo` for
+    # whichever worker frees up first
+    held = {rank: [] for rank in workers}
+    attempts = {}
+    failed = []
+    remaining = len(pending)
+    live = set(workers)
+
+    def dispatch():
+        for rank in sorted(live):
+            while todo and len(held[rank]) <= args.prefetch:
+                batch, seed = todo.popleft()
+                held[rank].append({item.index for item in batch})
+                task_queues[rank].put((batch, seed))
+
+    def release(rank, index):
+        for batch in held[rank]:
+            batch.discard(index)
+        held[rank] = [batch for batch in held[rank] if batch]
+
+    def fail(index, rank, error):
+        nonlocal remaining
+        attempts[index] = attempts.get(index, 0) + 1
+        if attempts[index] <= args.max_retries:
+            todo.append(([items[index]], seeds[index]))
+            return
+        record = {'name': item_filename(items[index]), 'index': index, 'status': 'failed', 'worker': rank,
+                  'attempts': attempts[index], 'error': error}
+        manifest.append(record)
+        failed.append(record)
+        remaining -= 1
+
+    def drop_worker(rank, reason, started=True):
+        """ the first held batch was being sampled if the worker `started`, the others go back to `todo` free """
+        live.discard(rank)
+        unstarted = held[rank][1:] if started else held[rank]
+        todo.extendleft(reversed([([items[index] for index in sorted(batch)], seeds[min(batch)])
+                                  for batch in unstarted]))
+        if started and held[rank]:
+            for index in sorted(held[rank][0]):
+                fail(index, rank, reason)
+        held[rank] = []
+
+    start = time.time()
+    while remaining > 0 and live:
+        dispatch()
+        try:
+            message = result_queue.get(timeout=5)
+        except queue.Empty:
+            # a worker killed by the OS (OOM, driver reset) reports nothing: requeue what it held
+            for rank in [rank for rank in live if not workers[rank].is_alive()]:
+                print(f'>>> worker {rank} ({devices[rank]}) died with exit code {workers[rank].exitcode}')
+                drop_worker(rank, f'worker {rank} died with exit code {workers[rank].exitcode}')
+            continue
+        kind, rank = message[:2]
+        if kind == 'done':
+            index, info = message[2:]
+            release(rank, index)
+            manifest.append({'name': item_filename(items[index]), 'index': index, 'status': 'done',
+                             'worker': rank, **info})
+            remaining -= 1
+            print(f'>>> [{len(pending) - remaining}/{len(pending)}] {info["file"]} on worker {rank}')
+        elif kind == 'failed':
+            index, info = message[2:]
+            release(rank, index)
+            print(f'>>> item {index} failed on worker {rank}:\n{info["error"]}')
+            fail(index, rank, info['error'])
+        elif kind == 'exit':
+            if message[2] is not None:
+                print(f'>>> worker {rank} ({devices[rank]}) could not start:\n{message[2]}')
+            drop_worker(rank, f'worker {rank} exited', started=message[2] is None)
+
+    for rank in live:
+        task_queues[rank].put(None)
+    for worker in workers.values():
+        worker.join(timeout=60)
+        if worker.is_alive():
+            worker.terminate()
+    if remaining > 0:
+        print(f'>>> no worker left, {remaining} items not processed')
+    print(f"Saved in {args.savedir}. Time used: {(time.time() - start):.2f} seconds, "
+          f"{len(pending) - remaining - len(failed)} done, {len(failed)} failed")
+    return len(failed) + remaining
+
+
+def get_distributed_parser():
+    parser = get_parser()
+    parser.add_argument("--cpu_workers", type=int, default=1, help="worker processes when no GPU is available")
+    parser.add_argument("--prefetch", type=int, default=2, help="batches whose conditions a worker loads ahead")
+    parser.add_argument("--max_retries", type=int, default=1, help="retries of an item before it is marked failed")
+    return parser
+
+
+if __name__ == '__main__':
+    args, unknown = get_distributed_parser().parse_known_args()
+    sys.exit(1 if run_distributed(args) else 0)
@@ -6,7 +6,7 @@ import math
 import os
 import sys
 import time
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 
 import cv2
 import numpy as np
@@ -17,10 +17,20 @@ from omegaconf import OmegaConf
 from pytorch_lightning import seed_everything
 from tqdm import tqdm
 
+try:
+    from safetensors import safe_open
+    from safetensors.torch import load_file as safetensors_load_file
+    SAFETENSORS_IS_AVAILBLE = True
+except:
+    SAFETENSORS_IS_AVAILBLE = False
+
 #sys.path.insert(1, os.path.join(sys.path[0], '..', '..'))
-from ...lvdm.models.samplers.ddim import DDIMSampler
+from ...lvdm.models.samplers.solvers import SAMPLERS, make_sampler
+from ...lvdm.modules.attention_backend import ATTENTION_BACKENDS, set_attention_backend
 from ...main.evaluation.motionctrl_prompts_camerapose_trajs import (
     both_prompt_camerapose_traj, cmcm_prompt_camerapose, omom_prompt_traj)
+from ...utils.cond_cache import get_cond_cache
+from ...utils.model_registry import get_model_registry
 from ...utils.utils import instantiate_from_config
 
 DEFAULT_NEGATIVE_PROMPT = 'blur, haze, deformed iris, deformed pupils, semi-realistic, cgi, 3d, render, '\
@@ -28,43 +38,137 @@ DEFAULT_NEGATIVE_PROMPT = 'blur, haze, deformed iris, deformed pupils, semi-real
                           'disfigured, poorly drawn, bad anatomy, wrong anatomy, extra limb, missing limb, '\
                           'floating limbs, disconnected limbs, mutation, mutated, ugly, disgusting, amputation'
 
+IncompatibleKeys = namedtuple('IncompatibleKeys', ['missing_keys', 'unexpected_keys'])
+
+INFERENCE_DTYPES = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+# torch.compile modes of the denoising unet, 'reduce-overhead' adds CUDA-graph capture
+COMPILE_MODES = ['off', 'default', 'reduce-overhead', 'max-autotune']
+
 post_prompt = 'Ultra-detail, masterpiece, best quality, cinematic lighting, 8k uhd, dslr, soft lighting, film grain, Fujifilm XT3'
 
 
+def is_safetensors(ckpt):
+    return ckpt.endswith('.safetensors')
+
+def load_state_dict_file(ckpt):
+    """
+    Read a checkpoint without materialising a full in-RAM copy when possible:
+    .safetensors files and zipfile .pth files (torch>=2.1) are memory-mapped and paged in on demand.
+    """
+    if is_safetensors(ckpt):
+        assert SAFETENSORS_IS_AVAILBLE, 'Error: loading .safetensors checkpoints requires `pip install safetensors`'
+        return safetensors_load_file(ckpt, device="cpu")
+    try:
+        return torch.load(ckpt, map_location="cpu", mmap=True)
+    except (TypeError, RuntimeError):
+        # torch<2.1 has no mmap, legacy (non-zipfile) checkpoints can not be mapped
+        return torch.load(ckpt, map_location="cpu")
+
+def unwrap_state_dict(state_dict):
+    """ return (state_dict, is_deepspeed) with the lightning / deepspeed wrapping removed """
+    if "state_dict" in list(state_dict.keys()):
+        return state_dict["state_dict"], False
+    if "module" not in list(state_dict.keys()):
+        # already a plain state dict, e.g. converted by convert_checkpoint.py
+        return state_dict, False
+    # deepspeed: strip the `_forward_module.` prefix, entries are moved (not copied) one by one
+    module_state_dict = state_dict['module']
+    new_pl_sd = OrderedDict()
+    for key in list(module_state_dict.keys()):
+        new_pl_sd[key[16:]] = module_state_dict.pop(key)
+    return new_pl_sd, True
+
+def is_deepspeed_safetensors(ckpt):
+    """ whether a .safetensors file was converted from a deepspeed checkpoint (see convert_checkpoint.py) """
+    with safe_open(ckpt, framework="pt", device="cpu") as f:
+        return (f.metadata() or {}).get('wrapper') == 'deepspeed'
+
+def load_safetensors_into_model(model, ckpt, strict=False):
+    """
+    Stream a .safetensors checkpoint tensor by tensor straight into the model's parameter storage,
+    host memory peaks at a single tensor instead of the whole checkpoint.
+    Returns the missing / unexpected keys like `load_state_dict`, with `strict` raises on any of them before
+    copying anything.
+    """
+    assert SAFETENSORS_IS_AVAILBLE, 'Error: loading .safetensors checkpoints requires `pip install safetensors`'
+    own_state = model.state_dict(keep_vars=True)
+    with safe_open(ckpt, framework="pt", device="cpu") as f, torch.no_grad():
+        keys = list(f.keys())
+        key_set = set(keys)
+        result = IncompatibleKeys([key for key in own_state if key not in key_set],
+                                  [key for key in keys if key not in own_state])
+        if strict and (result.missing_keys or result.unexpected_keys):
+            raise RuntimeError(f'Error(s) in loading {ckpt} into {model.__class__.__name__}: '
+                               f'missing keys {result.missing_keys}, unexpected keys {result.unexpected_keys}')
+        for key in keys:
+            if key not in own_state:
+                continue
+            tensor = f.get_tensor(key)
+            target = own_state[key]
+            assert target.shape == tensor.shape, \
+                f'Error: size mismatch for {key}: checkpoint {tuple(tensor.shape)}, model {tuple(target.shape)}'
+            target.copy_(tensor)
+    return result
+
 def load_model_checkpoint(model, ckpt, adapter_ckpt=None):
-    if adapter_ckpt:
-        ## main model
-        state_dict = torch.load(ckpt, map_location="cpu")
-        if "state_dict" in list(state_dict.keys()):
-            state_dict = state_dict["state_dict"]
-            result = model.load_state_dict(state_dict, strict=False)
-        else:       
-            # deepspeed
-            new_pl_sd = OrderedDict()
-            for key in state_dict['module'].keys():
-                new_pl_sd[key[16:]]=state_dict['module'][key]
-            result = model.load_state_dict(new_pl_sd, strict=False)
+    ## main model
+    ## deepspeed checkpoints (and files converted from them) must match the model exactly
+    if is_safetensors(ckpt):
+        result = load_safetensors_into_model(model, ckpt, strict=is_deepspeed_safetensors(ckpt) and not adapter_ckpt)
+    else:
+        state_dict, is_deepspeed = unwrap_state_dict(load_state_dict_file(ckpt))
+        result = model.load_state_dict(state_dict, strict=is_deepspeed and not adapter_ckpt)
+        del state_dict
+    if adapter_ckpt or result.missing_keys or result.unexpected_keys:
         print(result)
-        print('>>> model checkpoint loaded.')
+    print('>>> model checkpoint loaded.')
+
+    if adapter_ckpt:
         ## adapter
-        state_dict = torch.load(adapter_ckpt, map_location="cpu")
+        state_dict = load_state_dict_file(adapter_ckpt)
         if "state_dict" in list(state_dict.keys()):
             state_dict = state_dict["state_dict"]
         model.adapter.load_state_dict(state_dict, strict=True)
         print('>>> adapter checkpoint loaded.')
-    else:
-        state_dict = torch.load(ckpt, map_location="cpu")
-        if "state_dict" in list(state_dict.keys()):
-            state_dict = state_dict["state_dict"]
-            model.load_state_dict(state_dict, strict=False)
-        else:       
-            # deepspeed
-            new_pl_sd = OrderedDict()
-            for key in state_dict['module'].keys():
-                new_pl_sd[key[16:]]=state_dict['module'][key]
-            model.load_state_dict(new_pl_sd)
-        
-        print('>>> model checkpoint loaded.')
+    return model
+
+def build_model(config_path, ckpt_path, temporal_length=None, adapter_ckpt=None, device=None, dtype='fp32', attention=None):
+    if attention is not None:
+        set_attention_backend(attention)
+    config = OmegaConf.load(config_path)
+    if temporal_length is not None:
+        OmegaConf.update(config, "model.params.unet_config.params.temporal_length", temporal_length)
+    model_config = config.pop("model", OmegaConf.create())
+    model = instantiate_from_config(model_config)
+    model = model.to(device)
+    assert os.path.exists(ckpt_path), f"Error: checkpoint {ckpt_path} Not Found!"
+    print(f"Loading checkpoint from {ckpt_path}")
+    model = load_model_checkpoint(model, ckpt_path, adapter_ckpt)
+    model.eval()
+    if INFERENCE_DTYPES[dtype] != torch.float32:
+        # weights are cast once here, sampling & decoding then run under autocast
+        model.cast_inference_dtype(INFERENCE_DTYPES[dtype])
+    return model
+
+def load_model(config_path, ckpt_path, temporal_length=None, adapter_ckpt=None, device=None, dtype='fp32', attention=None):
+    """
+    build & load a model through the process-wide registry, reusing it if already resident.
+    `attention` selects the process-wide attention backend (one of ATTENTION_BACKENDS), also on a registry hit.
+    Compiled denoising is chosen per sampler (make_sampler(..., compile=)), not on the shared model.
+    """
+    assert dtype in INFERENCE_DTYPES, f"Error: dtype should be one of {list(INFERENCE_DTYPES.keys())}, got {dtype}"
+    if attention is not None:
+        print(f'>>> attention backend: {set_attention_backend(attention)}')
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    device = torch.device(device)
+    if device.type == 'cuda' and device.index is None:
+        device = torch.device('cuda', torch.cuda.current_device())
+    assert os.path.exists(ckpt_path), f"Error: checkpoint {ckpt_path} Not Found!"
+    build_fn = lambda: build_model(config_path, ckpt_path, temporal_length, adapter_ckpt, device, dtype)
+    model = get_model_registry().get(ckpt_path, build_fn,
+                                     os.path.realpath(config_path), temporal_length, adapter_ckpt, str(device), dtype)
     return model
 
 def load_trajs(cond_dir, trajs):
@@ -120,6 +224,60 @@ def save_results(samples, filename, savedir, fps=10):
         path = os.path.join(savedirs[idx], "%s.mp4"%filename)
         torchvision.io.write_video(path, grid, fps=fps, video_codec='h264', options={'crf': '10'})
 
+def repeat_batch(value, n):
+    """ repeat the batch of a tensor, or of every tensor in a list / dict, `n` times: [B,...] -> [n*B,...] """
+    if value is None or n == 1:
+        return value
+    if isinstance(value, torch.Tensor):
+        return value.repeat(n, *([1] * (value.dim() - 1)))
+    if isinstance(value, (list, tuple)):
+        return [repeat_batch(v, n) for v in value]
+    if isinstance(value, dict):
+        return {k: repeat_batch(v, n) for k, v in value.items()}
+    return value
+
+def sample_variants(
+        model,
+        ddim_sampler,
+        cond,
+        uc,
+        noise_shape,
+        n_samples=1,
+        seed=None,
+        ddim_steps=50,
+        decode_frame_chunk=None,
+        decode_tile_size=None,
+        **kwargs):
+    """
+    Generate `n_samples` variants of a batch as a single DDIM run over batch n_samples*B:
+    cond, uc and every tensor kwarg (features_adapter, pose_emb, x_T, ...) are repeated along the batch.
+    A single sample (n_samples=1) draws its noise from the global RNG as it always did, so seeded outputs are
+    unchanged. With `seed` and n_samples > 1, variant i draws its initial & step noise from its own generator
+    seeded with seed+i, so a variant does not depend on how many others are generated with it.
+    Decoding runs `decode_frame_chunk` frames at a time if given (see decode_first_stage), in one call otherwise.
+    Returns the decoded videos [B, n_samples, c, t, h, w] and the sampler intermediates.
+    """
+    batch_size = noise_shape[0]
+    generators = None
+    if seed is not None and n_samples > 1:
+        device = model.betas.device
+        generators = [torch.Generator(device=device).manual_seed(seed + i) for i in range(n_samples)]
+    kwargs = {k: repeat_batch(v, n_samples) for k, v in kwargs.items()}
+    samples, intermediates = ddim_sampler.sample(S=ddim_steps,
+                                                 conditioning=repeat_batch(cond, n_samples),
+                                                 batch_size=n_samples * batch_size,
+                                                 shape=noise_shape[1:],
+                                                 verbose=False,
+                                                 unconditional_conditioning=repeat_batch(uc, n_samples),
+                                                 temporal_length=noise_shape[2],
+                                                 generators=generators,
+                                                 **kwargs)
+    ## reconstruct from latent to pixel space
+    batch_images = model.decode_first_stage(samples, frame_chunk=decode_frame_chunk, tile_size=decode_tile_size)
+    ## variants*batch, c, t, h, w -> batch, variants, c, t, h, w
+    batch_variants = batch_images.view(n_samples, batch_size, *batch_images.shape[1:]).transpose(0, 1)
+    return batch_variants, intermediates
+
 def motionctrl_sample(
         model, 
         prompts, 
@@ -131,9 +289,15 @@ def motionctrl_sample(
         unconditional_guidance_scale_temporal=None,
         ddim_steps=50,
         ddim_eta=1.,
+        decode_frame_chunk=None,
+        decode_tile_size=None,
+        seed=None,
+        sampler='ddim',
+        compile='off',
         **kwargs):
     
-    ddim_sampler = DDIMSampler(model)
+    assert compile in COMPILE_MODES, f"Error: compile should be one of {COMPILE_MODES}, got {compile}"
+    ddim_sampler = make_sampler(sampler, model, compile=compile)
     batch_size = noise_shape[0]
     ## get condition embeddings (support single prompt only)
     if isinstance(prompts, str):
@@ -142,161 +306,147 @@ def motionctrl_sample(
     for i in range(len(prompts)):
         prompts[i] = f'{prompts[i]}, {post_prompt}'
 
-    cond = model.get_learned_conditioning(prompts)
+    cond_cache = get_cond_cache()
+    cond = cond_cache.get_learned_conditioning(model, prompts)
     if camera_poses is not None:
         RT = camera_poses[..., None]
     else:
         RT = None
 
     if trajs is not None:
-        traj_features = model.get_traj_features(trajs)
+        traj_features = cond_cache.get_traj_features(model, trajs)
     else:
         traj_features = None
 
     if unconditional_guidance_scale != 1.0:
         # prompts = batch_size * [""]
         prompts = batch_size * [DEFAULT_NEGATIVE_PROMPT]
-        uc = model.get_learned_conditioning(prompts)
+        uc = cond_cache.get_learned_conditioning(model, prompts)
         if traj_features is not None:
-            un_motion = model.get_traj_features(torch.zeros_like(trajs))
+            un_motion = cond_cache.get_uncond_traj_features(model, trajs)
         else:
             un_motion = None
         uc = {"features_adapter": un_motion, "uc": uc}
     else:
         uc = None
 
-    batch_variants = []
-    for _ in range(n_samples):
-        if ddim_sampler is not None:
-            samples, _ = ddim_sampler.sample(S=ddim_steps,
-                                            conditioning=cond,
-                                            batch_size=noise_shape[0],
-                                            shape=noise_shape[1:],
-                                            verbose=False,
-                                            unconditional_guidance_scale=unconditional_guidance_scale,
-                                            unconditional_conditioning=uc,
-                                            eta=ddim_eta,
-                                            temporal_length=noise_shape[2],
-                                            conditional_guidance_scale_temporal=unconditional_guidance_scale_temporal,
-                                            features_adapter=traj_features,
-                                            pose_emb=RT,
-                                            **kwargs
-                                            )        
-        ## reconstruct from latent to pixel space
-        batch_images = model.decode_first_stage(samples)
-        batch_variants.append(batch_images)
-    ## variants, batch, c, t, h, w
-    batch_variants = torch.stack(batch_variants)
-    return batch_variants.permute(1, 0, 2, 3, 4, 5)
+    batch_variants, _ = sample_variants(model, ddim_sampler, cond, uc, noise_shape,
+                                        n_samples=n_samples,
+                                        seed=seed,
+                                        ddim_steps=ddim_steps,
+                                        decode_frame_chunk=decode_frame_chunk,
+                                        decode_tile_size=decode_tile_size,
+                                        unconditional_guidance_scale=unconditional_guidance_scale,
+                                        eta=ddim_eta,
+                                        conditional_guidance_scale_temporal=unconditional_guidance_scale_temporal,
+                                        features_adapter=traj_features,
+                                        pose_emb=RT,
+                                        **kwargs)
+    return batch_variants
+
+EvalItem = namedtuple('EvalItem', ['index', 'prompt', 'camera_pose', 'traj', 'save_name'])
+
+def eval_items(condtype):
+    """ the (prompt, camera pose, trajectory) items of an evaluation sweep, conditions by file name """
+    if condtype == 'camera_motion':
+        prompt_list = cmcm_prompt_camerapose['prompts']
+        camera_pose_list = cmcm_prompt_camerapose['camera_poses']
+        traj_list = [None] * len(prompt_list)
+    elif condtype == 'object_motion':
+        prompt_list = omom_prompt_traj['prompts']
+        camera_pose_list = [None] * len(prompt_list)
+        traj_list = omom_prompt_traj['trajs']
+    elif condtype == 'both':
+        prompt_list = both_prompt_camerapose_traj['prompts']
+        camera_pose_list = both_prompt_camerapose_traj['camera_poses']
+        traj_list = both_prompt_camerapose_traj['trajs']
+    else:
+        raise NotImplementedError
+    items = []
+    for i, (prompt, camera_pose, traj) in enumerate(zip(prompt_list, camera_pose_list, traj_list)):
+        names = [] if camera_pose is None else [camera_pose.replace('test_camera_', '')]
+        names += [] if traj is None else [traj]
+        save_name = '__'.join(names + [prompt.replace(' ', '_').replace(',', '')])
+        items.append(EvalItem(i, prompt, camera_pose, traj, save_name))
+    return items
+
+def load_item_conditions(cond_dir, items):
+    """ (camera poses [b,t,12], trajectories [b,c,t,h,w]) of a batch of items on the cpu, None if not used """
+    camera_poses, trajs = None, None
+    if items[0].camera_pose is not None:
+        camera_poses = torch.stack(load_camera_pose(cond_dir, [item.camera_pose for item in items])[0], dim=0)
+    if items[0].traj is not None:
+        trajs = torch.stack(load_trajs(cond_dir, [item.traj for item in items])[0], dim=0)
+    return camera_poses, trajs
+
+def item_filename(item, rank=None):
+    name = item.save_name[:90]
+    return f'{name}_{item.index:04d}' + ('' if rank is None else f'_randk{rank}')
+
+def sample_items(model, args, items, camera_poses, trajs, savedir, rank=None, seed=None):
+    """ sample & save a batch of items with the sampling options of `args`, returns the saved file names """
+    h, w = args.height // 8, args.width // 8
+    noise_shape = [len(items), model.channels, model.temporal_length, h, w]
+    batch_samples = motionctrl_sample(
+        model, 
+        [item.prompt for item in items], 
+        noise_shape,
+        camera_poses=camera_poses,
+        trajs=trajs,
+        n_samples=args.n_samples,
+        unconditional_guidance_scale=args.unconditional_guidance_scale,
+        unconditional_guidance_scale_temporal=args.unconditional_guidance_scale_temporal,
+        ddim_steps=args.ddim_steps,
+        ddim_eta=args.ddim_eta if args.ddim_eta is not None else (1. if SAMPLERS[args.sampler].stochastic else 0.),
+        cond_T = args.cond_T,
+        guidance_windows={'text': args.text_T, 'camera': args.camera_T},
+        batched_cfg=args.batched_cfg,
+        decode_frame_chunk=args.decode_frame_chunk,
+        decode_tile_size=args.decode_tile_size,
+        sampler=args.sampler,
+        compile=args.compile,
+        seed=seed,
+    )
+    
+    ## save each example individually
+    filenames = []
+    for item, samples in zip(items, batch_samples):
+        ## samples : [n_samples,c,t,h,w]
+        filename = item_filename(item, rank)
+        save_results(samples, filename, savedir, fps=10)
+        if args.save_imgs:
+            prname = item.prompt.replace(' ', '_').replace(',', '')
+            cur_outdir = os.path.join(savedir, *item.save_name.split('__')[:-1], prname)
+            os.makedirs(cur_outdir, exist_ok=True)
+            save_images(samples, cur_outdir)
+        filenames.append(filename)
+    return filenames
 
 def run_inference(args, gpu_num, gpu_no):
     ## model config
-    config = OmegaConf.load(args.base)
-    model_config = config.pop("model", OmegaConf.create())
-    model = instantiate_from_config(model_config)
-    model = model.cuda(gpu_no)
-    assert os.path.exists(args.ckpt_path), f"Error: checkpoint {args.ckpt_path} Not Found!"
-    print(f"Loading checkpoint from {args.ckpt_path}")
-    model = load_model_checkpoint(model, args.ckpt_path, args.adapter_ckpt)
-    model.eval()
+    model = load_model(args.base, args.ckpt_path, adapter_ckpt=args.adapter_ckpt, device=f'cuda:{gpu_no}', dtype=args.dtype,
+                       attention=args.attention)
 
     ## run over data
     assert (args.height % 16 == 0) and (args.width % 16 == 0), "Error: image size [h,w] should be multiples of 16!"
-    
-    ## latent noise shape
-    h, w = args.height // 8, args.width // 8
-    channels = model.channels
-    frames = model.temporal_length
-    noise_shape = [args.bs, channels, frames, h, w]
 
     savedir = os.path.join(args.savedir, "samples")
     os.makedirs(savedir, exist_ok=True)
 
-    if args.condtype == 'camera_motion':
-        prompt_list = cmcm_prompt_camerapose['prompts']
-        camera_pose_list, pose_name = load_camera_pose(args.cond_dir, cmcm_prompt_camerapose['camera_poses'])
-        traj_list = None
-        save_name_list = []
-        for i in range(len(pose_name)):
-            save_name_list.append(f"{pose_name[i]}__{prompt_list[i].replace(' ', '_').replace(',', '')}")
-    elif args.condtype == 'object_motion':
-        prompt_list = omom_prompt_traj['prompts']
-        traj_list, traj_name = load_trajs(args.cond_dir, omom_prompt_traj['trajs'])
-        camera_pose_list = None
-        save_name_list = []
-        for i in range(len(traj_name)):
-            save_name_list.append(f"{traj_name[i]}__{prompt_list[i].replace(' ', '_').replace(',', '')}")
-    elif args.condtype == 'both':
-        prompt_list = both_prompt_camerapose_traj['prompts']
-        camera_pose_list, pose_name = load_camera_pose(args.cond_dir, both_prompt_camerapose_traj['camera_poses'])
-        traj_list, traj_name = load_trajs(args.cond_dir, both_prompt_camerapose_traj['trajs'])
-        save_name_list = []
-        for i in range(len(pose_name)):
-            save_name_list.append(f"{pose_name[i]}__{traj_name[i]}__{prompt_list[i].replace(' ', '_').replace(',', '')}")
-    
-    num_samples = len(prompt_list)
-    samples_split = num_samples // gpu_num
-    print('Prompts testing [rank:%d] %d/%d samples loaded.'%(gpu_no, samples_split, num_samples))
-    #indices = random.choices(list(range(0, num_samples)), k=samples_per_device)
-    indices = list(range(samples_split*gpu_no, samples_split*(gpu_no+1)))
-    prompt_list_rank = [prompt_list[i] for i in indices]
-    camera_pose_list_rank = None if camera_pose_list is None else [camera_pose_list[i] for i in indices]
-    traj_list_rank = None if traj_list is None else [traj_list[i] for i in indices]
-    save_name_list_rank = [save_name_list[i] for i in indices]
+    items = eval_items(args.condtype)
+    num_samples = len(items)
+    # contiguous shards, the first num_samples % gpu_num ranks take one more item
+    items_rank = items[num_samples * gpu_no // gpu_num: num_samples * (gpu_no + 1) // gpu_num]
+    print('Prompts testing [rank:%d] %d/%d samples loaded.'%(gpu_no, len(items_rank), num_samples))
     
     start = time.time() 
-    for idx, indice in tqdm(enumerate(range(0, len(prompt_list_rank), args.bs)), desc='Sample Batch'):
-        prompts = prompt_list_rank[indice:indice+args.bs]
-        camera_poses = None if camera_pose_list_rank is None else camera_pose_list_rank[indice:indice+args.bs]
-        trajs = None if traj_list_rank is None else traj_list_rank[indice:indice+args.bs]
-        save_name = save_name_list_rank[indice:indice+args.bs]
-        print(f'Processing {save_name}')
-
-        if camera_poses is not None:
-            camera_poses = torch.stack(camera_poses, dim=0).to("cuda")
-        if trajs is not None:
-            trajs = torch.stack(trajs, dim=0).to("cuda")
-
-        batch_samples = motionctrl_sample(
-            model, 
-            prompts, 
-            noise_shape,
-            camera_poses=camera_poses,
-            trajs=trajs,
-            n_samples=args.n_samples,
-            unconditional_guidance_scale=args.unconditional_guidance_scale,
-            unconditional_guidance_scale_temporal=args.unconditional_guidance_scale_temporal,
-            ddim_steps=args.ddim_steps,
-            ddim_eta=args.ddim_eta,
-            cond_T = args.cond_T,
-        )
-        
-        ## save each example individually
-        for nn, samples in enumerate(batch_samples):
-            ## samples : [n_samples,c,t,h,w]
-            prompt = prompts[nn]
-            name = save_name[nn]
-            if len(name) > 90:
-                name = name[:90]
-            filename = f'{name}_{idx*args.bs+nn:04d}_randk{gpu_no}'
-            
-            save_results(samples, filename, savedir, fps=10)
-            if args.save_imgs:
-                parts = save_name[nn].split('__')
-                if len(parts) == 2:
-                    cond_name = parts[0]
-                    prname = prompts[nn].replace(' ', '_').replace(',', '')
-                    cur_outdir = os.path.join(savedir, cond_name, prname)
-                elif len(parts) == 3:
-                    poname, trajname, _ = save_name[nn].split('__')
-                    prname = prompts[nn].replace(' ', '_').replace(',', '')
-                    cur_outdir = os.path.join(savedir, poname, trajname, prname)
-                else:
-                    raise NotImplementedError
-                os.makedirs(cur_outdir, exist_ok=True)
-                save_images(samples, cur_outdir)
-            if nn % 100 == 0:
-                print(f'Finish {nn}/{len(batch_samples)}')
+    for indice in tqdm(range(0, len(items_rank), args.bs), desc='Sample Batch'):
+        items_batch = items_rank[indice:indice+args.bs]
+        print(f'Processing {[item.save_name for item in items_batch]}')
+        camera_poses, trajs = load_item_conditions(args.cond_dir, items_batch)
+        camera_poses = None if camera_poses is None else camera_poses.to(model.device)
+        trajs = None if trajs is None else trajs.to(model.device)
+        sample_items(model, args, items_batch, camera_poses, trajs, savedir, rank=gpu_no)
 
     print(f"Saved in {args.savedir}. Time used: {(time.time() - start):.2f} seconds")
 
@@ -327,7 +477,8 @@ def get_parser():
     parser.add_argument("--prompt_dir", type=str, default=None, help="a data dir containing videos and prompts")
     parser.add_argument("--n_samples", type=int, default=1, help="num of samples per prompt",)
     parser.add_argument("--ddim_steps", type=int, default=50, help="steps of ddim if positive, otherwise use DDPM",)
-    parser.add_argument("--ddim_eta", type=float, default=1.0, help="eta for ddim sampling (0.0 yields deterministic sampling)",)
+    parser.add_argument("--sampler", type=str, default='ddim', choices=list(SAMPLERS.keys()), help="dpmpp_2m / unipc reach ddim quality in 15-20 steps, ddim_eta does not apply to them")
+    parser.add_argument("--ddim_eta", type=float, default=None, help="eta for ddim sampling, 1.0 by default (0.0 yields deterministic sampling)",)
     parser.add_argument("--bs", type=int, default=1, help="batch size for inference")
     parser.add_argument("--height", type=int, default=512, help="image height, in pixel space")
     parser.add_argument("--width", type=int, default=512, help="image width, in pixel space")
@@ -335,6 +486,14 @@ def get_parser():
     parser.add_argument("--unconditional_guidance_scale_temporal", type=float, default=None, help="temporal consistency guidance")
     parser.add_argument("--seed", type=int, default=20230211, help="seed for seed_everything")
     parser.add_argument("--cond_T", default=800, type=int, help="Steps smaller than cond_T will not contain condition")
+    parser.add_argument("--camera_T", default=None, type=int, help="Steps smaller than camera_T will not contain camera poses")
+    parser.add_argument("--text_T", default=None, type=int, help="Steps smaller than text_T skip classifier-free guidance")
+    parser.add_argument("--batched_cfg", action='store_true', help="run cond & uncond branches of cfg as one 2B forward pass")
+    parser.add_argument("--decode_frame_chunk", type=int, default=None, help="decode this many frames at a time to bound vae memory")
+    parser.add_argument("--decode_tile_size", type=int, default=None, help="decode in spatial tiles of this many latent pixels")
+    parser.add_argument("--dtype", type=str, default='fp32', choices=list(INFERENCE_DTYPES.keys()), help="inference precision of the unet, vae & text encoder")
+    parser.add_argument("--attention", type=str, default='auto', choices=ATTENTION_BACKENDS, help="attention backend, auto picks xformers > sdpa > naive")
+    parser.add_argument("--compile", type=str, default='off', choices=COMPILE_MODES, help="torch.compile the unet, compiled once per input shape")
     parser.add_argument("--save_imgs", action='store_true', help="save condition")
     parser.add_argument("--cond_dir", type=str, default=None, help="condition dir")
     
@@ -1,8 +1,10 @@
 import logging
 
 import torch
+import torch.nn.functional as F
 from einops import rearrange, repeat
 
+from ..lvdm.common import is_compiling
 from ..lvdm.models.utils_diffusion import timestep_embedding
 
 try:
@@ -44,15 +46,8 @@ def TemporalTransformer_forward(self, x, context=None, is_imgbatch=False):
             x = block(x, context=context, mask=mask)
         x = rearrange(x, '(b hw) t c -> b hw t c', b=b).contiguous()
     else:
+        x = self.cross_attention_blocks(x, context, t, h * w)
         x = rearrange(x, '(b hw) t c -> b hw t c', b=b).contiguous()
-        context = rearrange(context, '(b t) l con -> b t l con', t=t).contiguous()
-        for i, block in enumerate(self.transformer_blocks):
-            # calculate each batch one by one (since number in shape could not greater then 65,535 for some package)
-            for j in range(b):
-                unit_context = context[j][0:1]
-                context_j = repeat(unit_context, 't l con -> (t r) l con', r=(h * w)).contiguous()
-                ## note: causal mask will not applied in cross-attention case
-                x[j] = block(x[j], context=context_j)
     
     if self.use_linear:
         x = self.proj_out(x)
@@ -130,6 +125,30 @@ def spatial_forward_BasicTransformerBlock(self, x, context=None, mask=None):
     x = self.ff(self.norm3(x)) + x
     return x
 
+def cc_projection_pose_term(self, pose_emb, dim):
+    """
+    pose half of `cc_projection` plus its bias, [B, t, dim] for pose_emb [B, t, pose_dim, 1].
+    pose_emb is constant over a sampling run, so without autograd the term is cached for as long as the same
+    tensor is passed in; the sampler drops the cache at the end of the run (MotionCtrl.release_sampling_caches).
+    """
+    weight, bias = self.cc_projection.weight, self.cc_projection.bias
+    B, t, _, _ = pose_emb.shape
+    if is_compiling():
+        # traced into the compiled graph, where it is a negligible part of the step
+        return F.linear(pose_emb.reshape(B, t, -1).to(weight.dtype), weight[:, dim:], bias)
+    cache = getattr(self, 'pose_term_cache', None)
+    if cache is not None and cache[0] is pose_emb and cache[1] == weight.dtype:
+        return cache[2]
+    # computed outside autocast so the cached term does not depend on the context of the first call
+    with torch.autocast(device_type=pose_emb.device.type, enabled=False):
+        pose_term = F.linear(pose_emb.reshape(B, t, -1).to(weight.dtype), weight[:, dim:], bias)
+    if not torch.is_grad_enabled():
+        self.pose_term_cache = (pose_emb, weight.dtype, pose_term)
+    return pose_term
+
+def clear_pose_term_cache(self):
+    self.pose_term_cache = None
+
 def temporal_selfattn_forward_BasicTransformerBlock(self, x, context=None, mask=None):
     if isinstance(context, dict) and 'pose_emb' in context:
         pose_emb = context['pose_emb'] # {channel_num: [B, video_length, pose_dim, pose_embedding_dim]}
@@ -144,9 +163,11 @@ def temporal_selfattn_forward_BasicTransformerBlock(self, x, context=None, mask=
     if pose_emb is not None:
         B, t, _, _ = pose_emb.shape # [B, video_length, pose_dim, pose_embedding_dim]
         hw = x.shape[0] // B
-        pose_emb = pose_emb.reshape(B, t, -1)
-        pose_emb = pose_emb.repeat_interleave(repeats=hw, dim=0)
-        x = self.cc_projection(torch.cat([x, pose_emb], dim=-1))
+        # cc_projection(cat([x, pose])) == x @ W_x^T + (pose @ W_pose^T + bias), the pose term is broadcast over hw
+        dim = x.shape[-1]
+        x = F.linear(x, self.cc_projection.weight[:, :dim])
+        pose_term = cc_projection_pose_term(self, pose_emb, dim).to(x.dtype)
+        x = (x.view(B, hw, t, dim) + pose_term[:, None]).view(B * hw, t, dim)
 
     x = self.attn2(self.norm2(x), context=context, mask=mask) + x
     x = self.ff(self.norm3(x)) + x
@@ -3,7 +3,7 @@ from einops import rearrange
 
 from ..lvdm.models.ddpm3d import LatentDiffusion
 from ..motionctrl.lvdm_modified_modules import (
-    TemporalTransformer_forward, selfattn_forward_unet,
+    TemporalTransformer_forward, clear_pose_term_cache, selfattn_forward_unet,
     spatial_forward_BasicTransformerBlock,
     temporal_selfattn_forward_BasicTransformerBlock)
 from ..utils.utils import instantiate_from_config
@@ -62,6 +62,13 @@ class MotionCtrl(LatentDiffusion):
         b, c, t, h, w = extra_cond.shape
         ## process in 2D manner
         extra_cond = rearrange(extra_cond, 'b c t h w -> (b t) c h w')
-        traj_features = self.omcm(extra_cond)
+        with self.inference_autocast():
+            traj_features = self.omcm(extra_cond)
         traj_features = [rearrange(feature, '(b t) c h w -> b c t h w', b=b, t=t) for feature in traj_features]
         return traj_features
+
+    def release_sampling_caches(self):
+        """ drops the camera pose terms cached by the temporal blocks during the sampling run that ended """
+        for module in self.model.diffusion_model.modules():
+            if hasattr(module, 'cc_projection'):
+                clear_pose_term_cache(module)
@@ -6,6 +6,7 @@ import math
 import os
 import tempfile
 import folder_paths
+import comfy.utils
 
 import imageio
 import sys
@@ -20,16 +21,31 @@ import torchvision
 from omegaconf import OmegaConf
 from pytorch_lightning import seed_everything
 from tqdm import tqdm
-from .lvdm.models.samplers.ddim import DDIMSampler
+from .lvdm.models.samplers.ddim import restart_split
+from .lvdm.models.samplers.solvers import SAMPLERS, make_sampler
+from .lvdm.modules.attention_backend import ATTENTION_BACKENDS
 from .main.evaluation.motionctrl_prompts_camerapose_trajs import (
     both_prompt_camerapose_traj, cmcm_prompt_camerapose, omom_prompt_traj)
-from .main.evaluation.motionctrl_inference import motionctrl_sample,save_images,load_camera_pose,load_trajs,load_model_checkpoint,post_prompt,DEFAULT_NEGATIVE_PROMPT
+from .main.evaluation.motionctrl_inference import COMPILE_MODES,motionctrl_sample,save_images,load_camera_pose,load_trajs,load_model_checkpoint,load_model,post_prompt,DEFAULT_NEGATIVE_PROMPT,sample_variants
+from .utils.cond_cache import get_cond_cache, model_identity, tensor_digest
+from .utils.continuation_state import DEFAULT_SESSION, get_continuation_store
+from .utils.latent_preview import PREVIEW_MODES, SamplingPreview
 from .utils.utils import instantiate_from_config
 from .gradio_utils.traj_utils import process_points,get_flow
 from PIL import Image, ImageFont, ImageDraw
-from .gradio_utils.utils import vis_camera
+from .gradio_utils.utils import render_camera_overlay, vis_camera
 from io import BytesIO
 
+PREVIEW_MAX_SIZE = 512
+
+def sampling_progress(model, steps, preview="latent2rgb", preview_every=5):
+    """ img_callback updating ComfyUI's progress bar every step, with a pred_x0 preview every `preview_every` steps;
+    the progress hook is also where ComfyUI interrupts a running prompt """
+    pbar = comfy.utils.ProgressBar(steps)
+    def on_step(step, total, image):
+        pbar.update_absolute(step, total, None if image is None else ("JPEG", image, PREVIEW_MAX_SIZE))
+    return SamplingPreview(model, steps, on_step, mode=preview, every=preview_every)
+
 def process_camera(camera_pose_str,frame_length):
     RT=json.loads(camera_pose_str)
     for i in range(frame_length):
@@ -70,54 +86,67 @@ def process_traj(points_str,frame_length):
 
     return optical_flow
     
-def save_results(video, fps=10,traj="[]",draw_traj_dot=False,cameras=[],draw_camera_dot=False,context_overlap=0):
-    
-    # b,c,t,h,w
-    video = video.detach().cpu()
-    video = torch.clamp(video.float(), -1., 1.)
-    n = video.shape[0]
-    video = video.permute(2, 0, 1, 3, 4) # t,n,c,h,w
-    frame_grids = [torchvision.utils.make_grid(framesheet, nrow=int(n)) for framesheet in video] #[3, 1*h, n*w]
-    grid = torch.stack(frame_grids, dim=0) # stack in temporal dim [t, 3, n*h, w]
+def video_to_frames(video, padding=2):
+    """
+    [b,c,t,h,w] video in [-1,1] -> uint8 [t,h',w',c] frames, the b samples of a frame side by side as laid out by
+    torchvision make_grid(nrow=b). Runs as a few tensor ops on the video's device.
+    """
+    video = torch.clamp(video.detach().float(), -1., 1.)
+    b, c, t, h, w = video.shape
+    if b == 1:
+        grid = video[0].permute(1, 0, 2, 3) # t,c,h,w
+    else:
+        # make_grid: each image framed by `padding` pixels of pad_value=0
+        grid = video.new_zeros((t, c, h + 2 * padding, b * (w + padding) + padding))
+        for k in range(b):
+            x0 = padding + k * (w + padding)
+            grid[:, :, padding:padding+h, x0:x0+w] = video[k].permute(1, 0, 2, 3)
     grid = (grid + 1.0) / 2.0
-    grid = (grid * 255).to(torch.uint8).permute(0, 2, 3, 1) # [t, h, w*n, 3]
-    
-    path = tempfile.NamedTemporaryFile(suffix='.mp4', delete=False).name
-
-    outframes=[]
-    
-    #writer = imageio.get_writer(path, format='mp4', mode='I', fps=fps)
-    for i in range(grid.shape[0]):
-        img = grid[i].numpy()
-        image=Image.fromarray(img)
+    return (grid * 255).to(torch.uint8).permute(0, 2, 3, 1) # [t, h, w*n, 3]
+
+CAMERA_OVERLAY_MODES = ["fast", "plotly"]
+
+def overlay_frames(frames, traj="[]", draw_traj_dot=False, cameras=[], draw_camera_dot=False, start=0, camera_overlay="fast"):
+    """
+    generator of the frames[start:] (uint8 [h,w,3] numpy) with trajectory dots and camera frustums drawn on them.
+    camera_overlay "fast" draws the frustums with PIL, "plotly" rasterises the plotly view (needs kaleido, slow).
+    """
+    traj_list = json.loads(traj) if draw_traj_dot else None
+    num_frames = frames.shape[0]
+    for i in range(start, num_frames):
+        image = Image.fromarray(frames[i].numpy())
         draw = ImageDraw.Draw(image)
-        #draw.ellipse((0,0,255,255),fill=(255,0,0), outline=(255,0,0))
         if draw_traj_dot:
-            traj_list=json.loads(traj)
-            
-            #print(traj_point)
             size=3
-            for j in range(grid.shape[0]):
+            for j in range(num_frames):
                 traj_point=traj_list[len(traj_list)-1]
                 if len(traj_list)>j:
                     traj_point=traj_list[j]
-                if i==j:
-                    draw.ellipse((traj_point[0]/4-size,traj_point[1]/4-size,traj_point[0]/4+size,traj_point[1]/4+size),fill=(255,0,0), outline=(255,0,0))
-                else:
-                    draw.ellipse((traj_point[0]/4-size,traj_point[1]/4-size,traj_point[0]/4+size,traj_point[1]/4+size),fill=(255,255,255), outline=(255,255,255))
-            
-        if draw_traj_dot:
-            fig = vis_camera(cameras,1,i)
-            camimg=Image.open(BytesIO(fig.to_image('png',256,256)))
-            image.paste(camimg,(0,0),camimg.convert('RGBA'))
-        
-        image_tensor_out = torch.tensor(np.array(image).astype(np.float32) / 255.0)  # Convert back to CxHxW
-        image_tensor_out = torch.unsqueeze(image_tensor_out, 0)
-        outframes.append(image_tensor_out)
-        #writer.append_data(img)
+                fill = (255,0,0) if i==j else (255,255,255)
+                draw.ellipse((traj_point[0]/4-size,traj_point[1]/4-size,traj_point[0]/4+size,traj_point[1]/4+size),fill=fill, outline=fill)
 
-    #writer.close()
-    return torch.cat(tuple(outframes[context_overlap:]), dim=0).unsqueeze(0)
+        if draw_camera_dot:
+            if camera_overlay == "plotly":
+                fig = vis_camera(cameras,1,i)
+                camimg=Image.open(BytesIO(fig.to_image('png',256,256)))
+            else:
+                camimg=render_camera_overlay(cameras,i,size=256)
+            image.paste(camimg,(0,0),camimg.convert('RGBA'))
+        yield np.array(image)
+
+def save_results(video, fps=10,traj="[]",draw_traj_dot=False,cameras=[],draw_camera_dot=False,context_overlap=0,camera_overlay="fast"):
+    # b,c,t,h,w -> IMAGE batch [1, t-context_overlap, h, w*b, 3]
+    frames = video_to_frames(video)
+    if not (draw_traj_dot or draw_camera_dot):
+        # fast path: a single device -> host copy of the uint8 frames
+        frames = frames[context_overlap:].cpu()
+        return (frames.float() / 255.0).unsqueeze(0)
+
+    frames = frames.cpu()
+    out = torch.empty((frames.shape[0] - context_overlap,) + tuple(frames.shape[1:]), dtype=torch.float32)
+    for i, frame in enumerate(overlay_frames(frames, traj, draw_traj_dot, cameras, draw_camera_dot, start=context_overlap, camera_overlay=camera_overlay)):
+        out[i] = torch.from_numpy(frame).float() / 255.0
+    return out.unsqueeze(0)
 
 MOTION_CAMERA_OPTIONS = ["U", "D", "L", "R", "O", "O_0.2x", "O_0.4x", "O_1.0x", "O_2.0x", "O_0.2x", "O_0.2x", "Round-RI", "Round-RI_90", "Round-RI-120", "Round-ZoomIn", "SPIN-ACW-60", "SPIN-CW-60", "I", "I_0.2x", "I_0.4x", "I_1.0x", "I_2.0x", "1424acd0007d40b5", "d971457c81bca597", "018f7907401f2fef", "088b93f15ca8745d", "b133a504fc90a2d1"]
 
@@ -192,6 +221,12 @@ class MotionctrlLoader:
             "required": {
                 "ckpt_name": (folder_paths.get_filename_list("checkpoints"), {"default": "motionctrl.pth"}),
                 "frame_length": ("INT", {"default": 16}),
+            },
+            "optional": {
+                "dtype": (["fp32", "fp16", "bf16"], {"default": "fp32"}),
+                "attention": (ATTENTION_BACKENDS, {"default": "auto"}),
+                "compile": (COMPILE_MODES, {"default": "off"}),
+                "sampler": (list(SAMPLERS.keys()), {"default": "ddim"}),
             }
         }
         
@@ -200,7 +235,7 @@ class MotionctrlLoader:
     FUNCTION = "load_checkpoint"
     CATEGORY = "motionctrl"
 
-    def load_checkpoint(self, ckpt_name, frame_length):
+    def load_checkpoint(self, ckpt_name, frame_length, dtype="fp32", attention="auto", compile="off", sampler="ddim"):
         gpu_num=1
         gpu_no=0
         ckpt_path = folder_paths.get_full_path("checkpoints", ckpt_name)
@@ -208,17 +243,9 @@ class MotionctrlLoader:
         config_path = os.path.join(comfy_path, 'custom_nodes/ComfyUI-MotionCtrl/configs/inference/config_both.yaml')
         args={"ckpt_path":f"{ckpt_path}","adapter_ckpt":None,"base":f"{config_path}","condtype":"both","prompt_dir":None,"n_samples":1,"ddim_steps":50,"ddim_eta":1.0,"bs":1,"height":256,"width":256,"unconditional_guidance_scale":1.0,"unconditional_guidance_scale_temporal":None,"seed":1234,"cond_T":800}
         
-        config = OmegaConf.load(args["base"])
-        OmegaConf.update(config, "model.params.unet_config.params.temporal_length", frame_length)
-        model_config = config.pop("model", OmegaConf.create())
-        model = instantiate_from_config(model_config)
-        model = model.cuda(gpu_no)
-        assert os.path.exists(args["ckpt_path"]), f'Error: checkpoint {args["ckpt_path"]} Not Found!'
-        print(f'Loading checkpoint from {args["ckpt_path"]}')
-        model = load_model_checkpoint(model, args["ckpt_path"], args["adapter_ckpt"])
-        model.eval()
-
-        ddim_sampler = DDIMSampler(model)
+        model = load_model(args["base"], args["ckpt_path"], frame_length, args["adapter_ckpt"], device=f'cuda:{gpu_no}', dtype=dtype, attention=attention)
+
+        ddim_sampler = make_sampler(sampler, model, compile=compile)
 
         return (model,model.cond_stage_model,model.first_stage_model,ddim_sampler,)
 
@@ -234,18 +261,19 @@ class MotionctrlCond:
                 "traj": ("STRING", {"multiline": True, "default":"[[117, 102]]"}),
                 "infer_mode": (MODE, {"default":"control both camera and object motion"}),
                 "context_overlap": ("INT", {"default": 0, "min": 0, "max": 32}),
+            },
+            "optional": {
+                "session_id": ("STRING", {"multiline": False, "default": DEFAULT_SESSION}),
             }
         }
         
-    RETURN_TYPES = ("CONDITIONING", "CONDITIONING","TRAJ_LIST","RT_LIST","TRAJ_FEATURES","RT","NOISE_SHAPE","INT")
-    RETURN_NAMES = ("positive", "negative","traj_list","rt_list","traj","rt","noise_shape","context_overlap")
+    RETURN_TYPES = ("CONDITIONING", "CONDITIONING","TRAJ_LIST","RT_LIST","TRAJ_FEATURES","RT","NOISE_SHAPE","INT","MOTIONCTRL_STATE")
+    RETURN_NAMES = ("positive", "negative","traj_list","rt_list","traj","rt","noise_shape","context_overlap","state")
     FUNCTION = "load_cond"
     CATEGORY = "motionctrl"
 
-    def load_cond(self, model, prompt, camera, traj,infer_mode,context_overlap):
-        comfy_path = os.path.dirname(folder_paths.__file__)
-        camera_align_file = os.path.join(comfy_path, 'custom_nodes/ComfyUI-MotionCtrl/camera.json')
-        traj_align_file = os.path.join(comfy_path, 'custom_nodes/ComfyUI-MotionCtrl/traj.json')
+    def load_cond(self, model, prompt, camera, traj,infer_mode,context_overlap,session_id=DEFAULT_SESSION):
+        state = get_continuation_store().get(session_id, device=model.betas.device)
         frame_length=model.temporal_length
 
         camera_align=json.loads(camera)
@@ -260,21 +288,11 @@ class MotionctrlCond:
         traj=json.dumps(traj_align)
 
         if context_overlap>0:
-            if os.path.exists(camera_align_file):
-                with open(camera_align_file, 'r') as file:
-                    pre_camera_align=json.load(file)
-                    camera_align=pre_camera_align[:context_overlap]+camera_align[:-context_overlap]
-
-            if os.path.exists(traj_align_file):
-                with open(traj_align_file, 'r') as file:
-                    pre_traj_align=json.load(file)
-                    traj_align=pre_traj_align[:context_overlap]+traj_align[:-context_overlap]
-
-            with open(camera_align_file, 'w') as file:
-                json.dump(camera_align, file)
-
-            with open(traj_align_file, 'w') as file:
-                json.dump(traj_align, file)
+            if state.camera_align is not None:
+                camera_align=state.camera_align[:context_overlap]+camera_align[:-context_overlap]
+            if state.traj_align is not None:
+                traj_align=state.traj_align[:context_overlap]+traj_align[:-context_overlap]
+            state.update_align(camera_align, traj_align)
         
         prompts = prompt
         RT = process_camera(camera,frame_length).reshape(-1,12)
@@ -331,7 +349,8 @@ class MotionctrlCond:
         for i in range(len(prompts)):
             prompts[i] = f'{prompts[i]}, {post_prompt}'
 
-        cond = model.get_learned_conditioning(prompts)
+        cond_cache = get_cond_cache()
+        cond = cond_cache.get_learned_conditioning(model, prompts)
         if camera_poses is not None:
             RT = camera_poses[..., None]
         else:
@@ -339,20 +358,20 @@ class MotionctrlCond:
 
         traj_features = None
         if trajs is not None:
-            traj_features = model.get_traj_features(trajs)
+            traj_features = cond_cache.get_traj_features(model, trajs, traj_key=traj)
         else:
             traj_features = None
         
         uc = None
         prompts = batch_size * [DEFAULT_NEGATIVE_PROMPT]
-        uc = model.get_learned_conditioning(prompts)
+        uc = cond_cache.get_learned_conditioning(model, prompts)
         if traj_features is not None:
-            un_motion = model.get_traj_features(torch.zeros_like(trajs))
+            un_motion = cond_cache.get_uncond_traj_features(model, trajs)
         else:
             un_motion = None
         uc = {"features_adapter": un_motion, "uc": uc}
 
-        return (cond,uc,traj,RT_list,traj_features,RT,noise_shape,context_overlap)
+        return (cond,uc,traj,RT_list,traj_features,RT,noise_shape,context_overlap,state)
 
 
 
@@ -378,8 +397,22 @@ class MotionctrlSampleSimple:
             },
             "optional": {
                 "traj_tool": ("STRING",{"multiline": False, "default": "https://chaojie.github.io/ComfyUI-MotionCtrl/tools/draw.html"}),
-                "draw_traj_dot": ("BOOLEAN", {"default": False}),#, "label_on": "draw", "label_off": "not draw"
-                "draw_camera_dot": ("BOOLEAN", {"default": False}),
+                "draw_traj_dot": ("BOOLEAN", {"default": False, "tooltip": "draw the trajectory points on the frames, the camera frustums are drawn by draw_camera_dot only"}),#, "label_on": "draw", "label_off": "not draw"
+                "draw_camera_dot": ("BOOLEAN", {"default": False, "tooltip": "draw the camera frustums on the frames, independently of draw_traj_dot (which used to draw them)"}),
+                "camera_overlay": (CAMERA_OVERLAY_MODES, {"default": "fast"}),
+                "n_samples": ("INT", {"default": 1, "min": 1, "max": 4, "tooltip": "variants side by side; with more than one, variant i is seeded with seed+i and differs from the single-sample output of seed"}),
+                "batched_cfg": ("BOOLEAN", {"default": False}),
+                "decode_frame_chunk": ("INT", {"default": 0, "min": 0, "max": 256}),
+                "decode_tile_size": ("INT", {"default": 0, "min": 0, "max": 256}),
+                "state": ("MOTIONCTRL_STATE",),
+                "cond_T": ("INT", {"default": 800, "min": 0, "max": 1000}),
+                "camera_T": ("INT", {"default": 0, "min": 0, "max": 1000}),
+                "text_T": ("INT", {"default": 0, "min": 0, "max": 1000}),
+                "sampler": (["loader"] + list(SAMPLERS.keys()), {"default": "loader"}),
+                "preview": (PREVIEW_MODES, {"default": "latent2rgb"}),
+                "preview_every": ("INT", {"default": 5, "min": 1, "max": 1000}),
+                "restart_T": ("INT", {"default": 0, "min": 0, "max": 1000}),
+                "edit_tolerance": ("FLOAT", {"default": 0.05, "min": 0.0, "max": 1.0, "step": 0.01}),
             }
         }
 
@@ -387,17 +420,18 @@ class MotionctrlSampleSimple:
     FUNCTION = "run_inference"
     CATEGORY = "motionctrl"
 
-    def run_inference(self,model,clip,vae,ddim_sampler,positive, negative,traj_list,rt_list,traj,rt,steps,seed,noise_shape,context_overlap,traj_tool="https://chaojie.github.io/ComfyUI-MotionCtrl/tools/draw.html",draw_traj_dot=False,draw_camera_dot=False):
+    def run_inference(self,model,clip,vae,ddim_sampler,positive, negative,traj_list,rt_list,traj,rt,steps,seed,noise_shape,context_overlap,traj_tool="https://chaojie.github.io/ComfyUI-MotionCtrl/tools/draw.html",draw_traj_dot=False,draw_camera_dot=False,batched_cfg=False,decode_frame_chunk=0,decode_tile_size=0,camera_overlay="fast",state=None,n_samples=1,sampler="loader",cond_T=800,camera_T=0,text_T=0,preview="latent2rgb",preview_every=5,restart_T=0,edit_tolerance=0.05):
         frame_length=model.temporal_length
+        if sampler != "loader":
+            # sampler chosen on this node, the loader's one otherwise
+            ddim_sampler = make_sampler(sampler, model, compile=ddim_sampler.compile)
         device = model.betas.device
         print(f'frame_length{frame_length}')
         #noise_shape = [1, 4, 16, 32, 32]
         unconditional_guidance_scale = 7.5
         unconditional_guidance_scale_temporal = None
-        n_samples = 1
         ddim_steps= steps
-        ddim_eta=1.0
-        cond_T=800
+        ddim_eta=1.0 if ddim_sampler.stochastic else 0.
         #seed = args["seed"]
 
         if n_samples < 1:
@@ -407,76 +441,66 @@ class MotionctrlSampleSimple:
 
         seed_everything(seed)
 
-        batch_images=[]
-        batch_variants = []
-        intermediates = {}
-
         x0=None
         x_T=None
-        pre_x0=None
-        pre_x_T=None
 
-        comfy_path = os.path.dirname(folder_paths.__file__)
-        pred_x0_path = os.path.join(comfy_path, 'custom_nodes/ComfyUI-MotionCtrl/pred_x0.pt')
-        x_inter_path = os.path.join(comfy_path, 'custom_nodes/ComfyUI-MotionCtrl/x_inter.pt')
+        if state is None:
+            state = get_continuation_store().get(DEFAULT_SESSION, device=device)
         randt=torch.randn([noise_shape[0],noise_shape[1],frame_length-context_overlap,noise_shape[3],noise_shape[4]], device=device)
-        randt_np=randt.detach().cpu().numpy()
 
         if context_overlap>0:
-            if os.path.exists(pred_x0_path):
-                pre_x0=torch.load(pred_x0_path)
-                pre_x0_np=pre_x0[-1].detach().cpu().numpy()
-                pre_x0_np_overlap = np.concatenate((pre_x0_np[:,:,-context_overlap:], randt_np), axis=2)
-                x0=torch.tensor(pre_x0_np_overlap, device=device)
-            if os.path.exists(x_inter_path):
-                pre_x_T=torch.load(x_inter_path)
-                pre_x_T_np=pre_x_T[-1].detach().cpu().numpy()
-                pre_x_T_np_overlap = np.concatenate((pre_x_T_np[:,:,-context_overlap:], randt_np), axis=2)
-                x_T=torch.tensor(pre_x_T_np_overlap, device=device)
+            # previous chunk's trailing latent frames followed by fresh noise, all on the device
+            x0, x_T = state.continuation_latents(randt, context_overlap)
+
+        # edits of one clip (restart_T > 0, no continuation, single sample): a run whose camera / trajectory moved
+        # by at most edit_tolerance from the session's last full run resumes that run's latent at restart_T and only
+        # samples the steps below it; a full run becomes the new anchor
+        restart_kwargs = {}
+        edit_signature = None
+        sampled_steps = ddim_steps
+        if restart_T > 0 and context_overlap == 0 and n_samples == 1:
+            ddim_sampler.make_schedule(ddim_num_steps=ddim_steps, ddim_eta=ddim_eta, verbose=False)
+            skipped, remaining = restart_split(ddim_sampler.ddim_timesteps, restart_T)
+            if skipped > 0:
+                edit_signature = (model_identity(model), tensor_digest(positive), seed, ddim_steps, skipped,
+                                  type(ddim_sampler).__name__, tuple(noise_shape), cond_T, camera_T, text_T,
+                                  traj is None, rt is None)
+                edit_camera = None if rt is None else rt.detach().cpu().numpy()
+                edit_points = None if traj is None else json.loads(traj_list)
+                restart = state.edit_restart(edit_signature, edit_camera, edit_points, edit_tolerance)
+                if restart is not None:
+                    x_T = restart[1]
+                    restart_kwargs = {'timesteps': remaining + 1}
+                    sampled_steps = remaining
+                else:
+                    restart_kwargs = {'log_every_t': 1}
         
-        for _ in range(n_samples):
-            if ddim_sampler is not None:
-                samples, intermediates = ddim_sampler.sample(S=ddim_steps,
-                                                conditioning=positive,
-                                                batch_size=noise_shape[0],
-                                                shape=noise_shape[1:],
-                                                verbose=False,
-                                                unconditional_guidance_scale=unconditional_guidance_scale,
-                                                unconditional_conditioning=negative,
-                                                eta=ddim_eta,
-                                                temporal_length=noise_shape[2],
-                                                conditional_guidance_scale_temporal=unconditional_guidance_scale_temporal,
-                                                features_adapter=traj,
-                                                pose_emb=rt,
-                                                cond_T=cond_T,
-                                                x0=x0,
-                                                x_T=x_T
-                                                )        
-            #print(f'{samples}')
-            ## reconstruct from latent to pixel space
-            batch_images = model.decode_first_stage(samples)
-            batch_variants.append(batch_images)
-            '''
-            batch_images = model.decode_first_stage(intermediates['pred_x0'][0])
-            batch_variants.append(batch_images)
-            batch_images = model.decode_first_stage(intermediates['pred_x0'][1])
-            batch_variants.append(batch_images)
-            batch_images = model.decode_first_stage(intermediates['pred_x0'][2])
-            batch_variants.append(batch_images)
-            batch_images = model.decode_first_stage(intermediates['x_inter'][0])
-            batch_variants.append(batch_images)
-            batch_images = model.decode_first_stage(intermediates['x_inter'][1])
-            batch_variants.append(batch_images)
-            batch_images = model.decode_first_stage(intermediates['x_inter'][2])
-            batch_variants.append(batch_images)
-            '''
-        ## variants, batch, c, t, h, w
-        batch_variants = torch.stack(batch_variants, dim=1)
+        batch_variants, intermediates = sample_variants(model, ddim_sampler, positive, negative, noise_shape,
+                                                        n_samples=n_samples,
+                                                        seed=seed,
+                                                        ddim_steps=ddim_steps,
+                                                        decode_frame_chunk=decode_frame_chunk or None,
+                                                        decode_tile_size=decode_tile_size,
+                                                        unconditional_guidance_scale=unconditional_guidance_scale,
+                                                        eta=ddim_eta,
+                                                        conditional_guidance_scale_temporal=unconditional_guidance_scale_temporal,
+                                                        features_adapter=traj,
+                                                        pose_emb=rt,
+                                                        cond_T=cond_T,
+                                                        guidance_windows={'text': text_T, 'camera': camera_T},
+                                                        img_callback=sampling_progress(model, sampled_steps, preview, preview_every),
+                                                        x0=x0,
+                                                        x_T=x_T,
+                                                        batched_cfg=batched_cfg,
+                                                        **restart_kwargs)
         batch_variants = batch_variants[0]
+        if 'log_every_t' in restart_kwargs:
+            state.update_edit_anchor(edit_signature, edit_camera, edit_points, skipped, intermediates['x_inter'][skipped])
         
-        torch.save(intermediates['x_inter'], x_inter_path)
-        torch.save(intermediates['pred_x0'], pred_x0_path)
-        ret = save_results(batch_variants, fps=10,traj=traj_list,draw_traj_dot=draw_traj_dot,cameras=rt_list,draw_camera_dot=draw_camera_dot,context_overlap=context_overlap)
+        # the next chunk continues the first variant
+        batch_size = noise_shape[0]
+        state.update_latents(intermediates['x_inter'][-1][:batch_size], intermediates['pred_x0'][-1][:batch_size], context_overlap)
+        ret = save_results(batch_variants, fps=10,traj=traj_list,draw_traj_dot=draw_traj_dot,cameras=rt_list,draw_camera_dot=draw_camera_dot,context_overlap=context_overlap,camera_overlay=camera_overlay)
         #print(ret)
         return ret
         
@@ -495,9 +519,23 @@ class MotionctrlSample:
             },
             "optional": {
                 "traj_tool": ("STRING",{"multiline": False, "default": "https://chaojie.github.io/ComfyUI-MotionCtrl/tools/draw.html"}),
-                "draw_traj_dot": ("BOOLEAN", {"default": False}),#, "label_on": "draw", "label_off": "not draw"
-                "draw_camera_dot": ("BOOLEAN", {"default": False}),
+                "draw_traj_dot": ("BOOLEAN", {"default": False, "tooltip": "draw the trajectory points on the frames, the camera frustums are drawn by draw_camera_dot only"}),#, "label_on": "draw", "label_off": "not draw"
+                "draw_camera_dot": ("BOOLEAN", {"default": False, "tooltip": "draw the camera frustums on the frames, independently of draw_traj_dot (which used to draw them)"}),
+                "camera_overlay": (CAMERA_OVERLAY_MODES, {"default": "fast"}),
+                "n_samples": ("INT", {"default": 1, "min": 1, "max": 4, "tooltip": "variants side by side; with more than one, variant i is seeded with seed+i and differs from the single-sample output of seed"}),
                 "ckpt_name": (folder_paths.get_filename_list("checkpoints"), {"default": "motionctrl.pth"}),
+                "batched_cfg": ("BOOLEAN", {"default": False}),
+                "dtype": (["fp32", "fp16", "bf16"], {"default": "fp32"}),
+                "attention": (ATTENTION_BACKENDS, {"default": "auto"}),
+                "compile": (COMPILE_MODES, {"default": "off"}),
+                "sampler": (list(SAMPLERS.keys()), {"default": "ddim"}),
+                "decode_frame_chunk": ("INT", {"default": 0, "min": 0, "max": 256}),
+                "decode_tile_size": ("INT", {"default": 0, "min": 0, "max": 256}),
+                "cond_T": ("INT", {"default": 800, "min": 0, "max": 1000}),
+                "camera_T": ("INT", {"default": 0, "min": 0, "max": 1000}),
+                "text_T": ("INT", {"default": 0, "min": 0, "max": 1000}),
+                "preview": (PREVIEW_MODES, {"default": "latent2rgb"}),
+                "preview_every": ("INT", {"default": 5, "min": 1, "max": 1000}),
             }
         }
 
@@ -505,7 +543,7 @@ class MotionctrlSample:
     FUNCTION = "run_inference"
     CATEGORY = "motionctrl"
         
-    def run_inference(self,prompt,camera,traj,frame_length,steps,seed,traj_tool="https://chaojie.github.io/ComfyUI-MotionCtrl/tools/draw.html",draw_traj_dot=False,draw_camera_dot=False,ckpt_name="motionctrl.pth"):
+    def run_inference(self,prompt,camera,traj,frame_length,steps,seed,traj_tool="https://chaojie.github.io/ComfyUI-MotionCtrl/tools/draw.html",draw_traj_dot=False,draw_camera_dot=False,ckpt_name="motionctrl.pth",batched_cfg=False,dtype="fp32",decode_frame_chunk=0,decode_tile_size=0,camera_overlay="fast",n_samples=1,attention="auto",compile="off",sampler="ddim",cond_T=800,camera_T=0,text_T=0,preview="latent2rgb",preview_every=5):
         gpu_num=1
         gpu_no=0
         ckpt_path = folder_paths.get_full_path("checkpoints", ckpt_name)
@@ -522,15 +560,7 @@ class MotionctrlSample:
         print(traj_flow.shape)
         
         args["savedir"]=f'./output/{args["condtype"]}_seed{args["seed"]}'
-        config = OmegaConf.load(args["base"])
-        OmegaConf.update(config, "model.params.unet_config.params.temporal_length", frame_length)
-        model_config = config.pop("model", OmegaConf.create())
-        model = instantiate_from_config(model_config)
-        model = model.cuda(gpu_no)
-        assert os.path.exists(args["ckpt_path"]), f'Error: checkpoint {args["ckpt_path"]} Not Found!'
-        print(f'Loading checkpoint from {args["ckpt_path"]}')
-        model = load_model_checkpoint(model, args["ckpt_path"], args["adapter_ckpt"])
-        model.eval()
+        model = load_model(args["base"], args["ckpt_path"], frame_length, args["adapter_ckpt"], device=f'cuda:{gpu_no}', dtype=dtype, attention=attention)
        
         ## run over data
         assert (args["height"] % 16 == 0) and (args["width"] % 16 == 0), "Error: image size [h,w] should be multiples of 16!"
@@ -548,10 +578,8 @@ class MotionctrlSample:
         #noise_shape = [1, 4, 16, 32, 32]
         unconditional_guidance_scale = 7.5
         unconditional_guidance_scale_temporal = None
-        n_samples = 1
         ddim_steps= steps
-        ddim_eta=1.0
-        cond_T=800
+        ddim_eta=1.0 if SAMPLERS[sampler].stochastic else 0.
         #seed = args["seed"]
 
         if n_samples < 1:
@@ -571,7 +599,7 @@ class MotionctrlSample:
             camera_poses = camera_poses.cuda()
             trajs = trajs.cuda()
         
-        ddim_sampler = DDIMSampler(model)
+        ddim_sampler = make_sampler(sampler, model, compile=compile)
         batch_size = noise_shape[0]
         prompts=prompt
         ## get condition embeddings (support single prompt only)
@@ -581,7 +609,8 @@ class MotionctrlSample:
         for i in range(len(prompts)):
             prompts[i] = f'{prompts[i]}, {post_prompt}'
 
-        cond = model.get_learned_conditioning(prompts)
+        cond_cache = get_cond_cache()
+        cond = cond_cache.get_learned_conditioning(model, prompts)
         if camera_poses is not None:
             RT = camera_poses[..., None]
         else:
@@ -589,7 +618,7 @@ class MotionctrlSample:
 
         traj_features = None
         if trajs is not None:
-            traj_features = model.get_traj_features(trajs)
+            traj_features = cond_cache.get_traj_features(model, trajs, traj_key=traj)
         else:
             traj_features = None
             
@@ -597,42 +626,33 @@ class MotionctrlSample:
         if unconditional_guidance_scale != 1.0:
             # prompts = batch_size * [""]
             prompts = batch_size * [DEFAULT_NEGATIVE_PROMPT]
-            uc = model.get_learned_conditioning(prompts)
+            uc = cond_cache.get_learned_conditioning(model, prompts)
             if traj_features is not None:
-                un_motion = model.get_traj_features(torch.zeros_like(trajs))
+                un_motion = cond_cache.get_uncond_traj_features(model, trajs)
             else:
                 un_motion = None
             uc = {"features_adapter": un_motion, "uc": uc}
         else:
             uc = None
         
-        batch_images=[]
-        batch_variants = []
-        for _ in range(n_samples):
-            if ddim_sampler is not None:
-                samples, _ = ddim_sampler.sample(S=ddim_steps,
-                                                conditioning=cond,
-                                                batch_size=noise_shape[0],
-                                                shape=noise_shape[1:],
-                                                verbose=False,
-                                                unconditional_guidance_scale=unconditional_guidance_scale,
-                                                unconditional_conditioning=uc,
-                                                eta=ddim_eta,
-                                                temporal_length=noise_shape[2],
-                                                conditional_guidance_scale_temporal=unconditional_guidance_scale_temporal,
-                                                features_adapter=traj_features,
-                                                pose_emb=RT,
-                                                cond_T=cond_T
-                                                )        
-            #print(f'{samples}')
-            ## reconstruct from latent to pixel space
-            batch_images = model.decode_first_stage(samples)
-            batch_variants.append(batch_images)
-        ## variants, batch, c, t, h, w
-        batch_variants = torch.stack(batch_variants, dim=1)
+        batch_variants, _ = sample_variants(model, ddim_sampler, cond, uc, noise_shape,
+                                            n_samples=n_samples,
+                                            seed=seed,
+                                            ddim_steps=ddim_steps,
+                                            decode_frame_chunk=decode_frame_chunk or None,
+                                            decode_tile_size=decode_tile_size,
+                                            unconditional_guidance_scale=unconditional_guidance_scale,
+                                            eta=ddim_eta,
+                                            conditional_guidance_scale_temporal=unconditional_guidance_scale_temporal,
+                                            features_adapter=traj_features,
+                                            pose_emb=RT,
+                                            cond_T=cond_T,
+                                            guidance_windows={'text': text_T, 'camera': camera_T},
+                                            img_callback=sampling_progress(model, ddim_steps, preview, preview_every),
+                                            batched_cfg=batched_cfg)
         batch_variants = batch_variants[0]
         
-        ret = save_results(batch_variants, fps=10,traj=traj,draw_traj_dot=draw_traj_dot,cameras=RT_list,draw_camera_dot=draw_camera_dot)
+        ret = save_results(batch_variants, fps=10,traj=traj,draw_traj_dot=draw_traj_dot,cameras=RT_list,draw_camera_dot=draw_camera_dot,camera_overlay=camera_overlay)
         #print(ret)
         return ret
         
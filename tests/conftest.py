@@ -0,0 +1,86 @@
+"""
+The repository is a ComfyUI custom node package imported as `custom_nodes.ComfyUI-MotionCtrl` (the name its
+configs' targets use). The tests register it under that name without running its __init__, which needs ComfyUI,
+also as the module pytest imports for the repository directory, and build a tiny randomly initialised MotionCtrl
+model from configs/inference/config_both.yaml.
+"""
+import importlib
+import os
+import sys
+import types
+
+import pytest
+import torch
+from omegaconf import OmegaConf
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = 'custom_nodes.ComfyUI-MotionCtrl'
+
+
+def register_package():
+    if PACKAGE in sys.modules:
+        return
+    namespace = sys.modules.setdefault('custom_nodes', types.ModuleType('custom_nodes'))
+    namespace.__path__ = getattr(namespace, '__path__', [])
+    package = types.ModuleType(PACKAGE)
+    package.__path__ = [ROOT]
+    package.__file__ = os.path.join(ROOT, '__init__.py')
+    package.__package__ = PACKAGE
+    sys.modules[PACKAGE] = package
+    sys.modules.setdefault(os.path.basename(ROOT), package)
+
+
+register_package()
+
+
+def load(module):
+    """ a module of the package by its path inside it, e.g. load('lvdm.common') """
+    register_package()
+    return importlib.import_module(f'{PACKAGE}.{module}')
+
+
+class TinyText(torch.nn.Module):
+    """ stand-in of the OpenCLIP text encoder: 8 character embeddings per prompt """
+    def __init__(self, context_dim=1024):
+        super().__init__()
+        self.emb = torch.nn.Embedding(256, context_dim)
+
+    def encode(self, prompts):
+        ids = [[ord(c) % 256 for c in (prompt + ' ' * 8)[:8]] for prompt in prompts]
+        return self.emb(torch.tensor(ids, device=self.emb.weight.device))
+
+
+def tiny_config(temporal_length=4):
+    config = OmegaConf.load(os.path.join(ROOT, 'configs', 'inference', 'config_both.yaml')).model
+    unet = config.params.unet_config.params
+    unet.model_channels = 32
+    unet.num_head_channels = 16
+    unet.temporal_length = temporal_length
+    unet.use_checkpoint = False
+    config.params.omcm_config.params.channels = [32, 64, 128, 128]
+    ddconfig = config.params.first_stage_config.params.ddconfig
+    ddconfig.ch = 32
+    ddconfig.ch_mult = [1, 2, 2, 2]
+    ddconfig.num_res_blocks = 1
+    config.params.cond_stage_config = {'target': 'conftest.TinyText'}
+    config.params.pop('scheduler_config')
+    return config
+
+
+def build_tiny_model():
+    """ a new tiny model, the same weights on every call """
+    register_package()
+    instantiate_from_config = load('utils.utils').instantiate_from_config
+    torch.manual_seed(0)
+    model = instantiate_from_config(tiny_config())
+    with torch.no_grad():
+        # zero-initialised output layers would make every prediction 0
+        for param in model.parameters():
+            if param.abs().sum() == 0:
+                param.normal_(0, 0.02)
+    return model.eval()
+
+
+@pytest.fixture(scope='session')
+def tiny_model():
+    return build_tiny_model()
@@ -0,0 +1,31 @@
+import pytest
+import torch
+
+from conftest import load
+
+
+@pytest.mark.parametrize('backend', ['xformers', 'sdpa'])
+@pytest.mark.parametrize('masked', [False, True], ids=['unmasked', 'masked'])
+def test_attention_batch_above_kernel_limit_is_chunked(monkeypatch, backend, masked):
+    attention_backend = load('lvdm.modules.attention_backend')
+    heads = 2
+    calls = []
+
+    def kernel(q, k, v, heads, mask=None):
+        # stands in for a kernel launched with one block per (sequence, head)
+        assert q.shape[0] * heads <= attention_backend.MAX_ATTENTION_BATCH
+        calls.append(q.shape[0])
+        return attention_backend.naive_attention(q, k, v, heads, mask)
+
+    monkeypatch.setattr(attention_backend, 'XFORMERS_IS_AVAILBLE', True)
+    monkeypatch.setattr(attention_backend, 'SDPA_IS_AVAILBLE', True)
+    monkeypatch.setattr(attention_backend, 'xformers_attention', kernel)
+    monkeypatch.setattr(attention_backend, 'sdpa_attention', kernel)
+    torch.manual_seed(0)
+    b = attention_backend.MAX_ATTENTION_BATCH // heads + 100  # e.g. batch * h * w of temporal attention
+    q, k, v = (torch.randn(b, 4, heads * 2) for _ in range(3))
+    mask = torch.tril(torch.ones(1, 4, 4, dtype=torch.bool)).expand(b, -1, -1) if masked else None
+    out = attention_backend.attention(q, k, v, heads, mask=mask, backend=backend)
+    expected = attention_backend.naive_attention(q, k, v, heads, mask)
+    assert calls == [attention_backend.MAX_ATTENTION_BATCH // heads, 100]
+    assert torch.allclose(out, expected, atol=1e-6)
@@ -0,0 +1,38 @@
+from conftest import load
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+def store(**kwargs):
+    return load('utils.continuation_state').ContinuationStateStore(**kwargs)
+
+
+def test_least_recently_used_sessions_are_forgotten():
+    states = store(max_sessions=2, idle_seconds=None)
+    first = states.get('room1')
+    states.get('room2')
+    assert states.get('room1') is first
+    states.get('room3')
+    assert list(states.states) == ['room1', 'room3']
+    assert states.get('room2') is not None and states.evictions == 2
+
+
+def test_idle_sessions_are_forgotten():
+    clock = Clock()
+    states = store(max_sessions=None, idle_seconds=60, clock=clock)
+    first = states.get('room1')
+    states.get('room2')
+    clock.now = 50.
+    states.get('room2')
+    clock.now = 100.
+    states.get('room3')
+    assert list(states.states) == ['room2', 'room3']
+    clock.now = 1000.
+    assert states.get('room1') is not first
+    assert list(states.states) == ['room1']
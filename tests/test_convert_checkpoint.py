@@ -0,0 +1,48 @@
+import pytest
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+from conftest import build_tiny_model, load
+
+
+def converted(tmp_path, tiny_model, wrap):
+    convert_checkpoint = load('main.evaluation.convert_checkpoint').convert_checkpoint
+    ckpt_path = str(tmp_path / 'motionctrl.pth')
+    torch.save(wrap(tiny_model.state_dict()), ckpt_path)
+    return convert_checkpoint(ckpt_path)
+
+
+def deepspeed(state_dict):
+    return {'module': {f'_forward_module.{key}': value for key, value in state_dict.items()}}
+
+
+def test_converted_checkpoint_loads_the_same_weights(tmp_path, tiny_model):
+    inference = load('main.evaluation.motionctrl_inference')
+    out_path = converted(tmp_path, tiny_model, deepspeed)
+    model = build_tiny_model()
+    with torch.no_grad():
+        for param in model.parameters():
+            param.zero_()
+    inference.load_model_checkpoint(model, out_path)
+    expected = tiny_model.state_dict()
+    assert all(torch.equal(value, expected[key]) for key, value in model.state_dict().items())
+
+
+def test_renamed_key_raises_for_deepspeed_and_is_reported_otherwise(tmp_path, tiny_model):
+    inference = load('main.evaluation.motionctrl_inference')
+    for wrap, strict in [(deepspeed, True), (lambda state_dict: {'state_dict': state_dict}, False)]:
+        out_path = converted(tmp_path, tiny_model, wrap)
+        tensors = load_file(out_path)
+        key = next(iter(tensors))
+        tensors[f'renamed.{key}'] = tensors.pop(key)
+        with safe_open(out_path, 'pt') as f:
+            metadata = f.metadata()
+        save_file(tensors, out_path, metadata=metadata)
+        assert inference.is_deepspeed_safetensors(out_path) == strict
+        if strict:
+            with pytest.raises(RuntimeError, match='renamed'):
+                inference.load_model_checkpoint(build_tiny_model(), out_path)
+        else:
+            result = inference.load_safetensors_into_model(build_tiny_model(), out_path)
+            assert result.missing_keys == [key] and result.unexpected_keys == [f'renamed.{key}']
@@ -0,0 +1,113 @@
+import base64
+import importlib.util
+import io
+import json
+import os
+import shutil
+import subprocess
+
+import pytest
+from PIL import Image
+
+TURBO = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'turbo')
+spec = importlib.util.spec_from_file_location('turbo_frames', os.path.join(TURBO, 'frames.py'))
+frames = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(frames)
+
+# decodes the payload file argv[1] with the page's codec, prints {meta, data (base64)}
+DECODE_JS = """
+import { readFileSync } from 'fs';
+import { pathToFileURL } from 'url';
+const { unpackFrame } = await import(pathToFileURL(process.argv[2]).href);
+const { meta, data } = unpackFrame(readFileSync(process.argv[1]));
+console.log(JSON.stringify({ meta: meta, data: Buffer.from(data).toString('base64') }));
+"""
+
+# argv[1]: JSON list of ticks, each a list of base64 payloads arriving before it; prints the played {meta, data}
+PLAY_JS = """
+import { readFileSync } from 'fs';
+import { pathToFileURL } from 'url';
+const { FrameQueue, unpackFrame } = await import(pathToFileURL(process.argv[2]).href);
+const queue = new FrameQueue();
+const played = [];
+const tick = () => {
+    const next = queue.next();
+    if (next) played.push({ meta: next.meta, data: Buffer.from(next.item).toString('base64') });
+    return next;
+};
+for (const arrivals of JSON.parse(readFileSync(process.argv[1]))) {
+    for (const payload of arrivals) {
+        const { meta, data } = unpackFrame(Buffer.from(payload, 'base64'));
+        if ('seq' in meta) queue.pushFrame(meta, data); else queue.pushPreview(meta, data);
+    }
+    tick();
+}
+while (tick());
+console.log(JSON.stringify(played));
+"""
+
+
+def encoded_frame(red=200):
+    buffer = io.BytesIO()
+    Image.new('RGB', (16, 16), (red, 30, 90)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def frame_meta():
+    streams = frames.FrameStreams()
+    gen = streams.start('room')
+    return streams.meta('room', gen, 3, 16, 'image/png')
+
+
+def test_pack_frame_round_trip():
+    meta, data = frame_meta(), encoded_frame()
+    assert frames.unpack_frame(frames.pack_frame(meta, data)) == (meta, data)
+
+
+@pytest.mark.skipif(shutil.which('node') is None, reason='node is not installed')
+@pytest.mark.parametrize('meta', [frame_meta(), frames.preview_meta(2, 5, 25, 'image/jpeg')], ids=['frame', 'preview'])
+def test_page_decodes_packed_frame(tmp_path, meta):
+    data = encoded_frame()
+    payload = tmp_path / 'payload.bin'
+    payload.write_bytes(frames.pack_frame(meta, data))
+    out = subprocess.run(['node', '--input-type=module', '-e', DECODE_JS, str(payload),
+                          os.path.join(TURBO, 'frame_codec.mjs')], capture_output=True, text=True, check=True)
+    decoded = json.loads(out.stdout)
+    assert decoded['meta'] == meta
+    assert base64.b64decode(decoded['data']) == data
+
+
+def generation(streams, count=16):
+    """ payloads of one generation of `count` frames, as the server emits them in one burst """
+    gen = streams.start('room')
+    return [frames.pack_frame(streams.meta('room', gen, index, count, 'image/png'), encoded_frame(index))
+            for index in range(count)]
+
+
+def play(tmp_path, ticks):
+    """ (meta, data) of the frames the page plays, fed `ticks` as lists of payloads arriving before each tick """
+    arrivals = tmp_path / 'arrivals.json'
+    arrivals.write_text(json.dumps([[base64.b64encode(payload).decode() for payload in tick] for tick in ticks]))
+    out = subprocess.run(['node', '--input-type=module', '-e', PLAY_JS, str(arrivals),
+                          os.path.join(TURBO, 'frame_codec.mjs')], capture_output=True, text=True, check=True)
+    return [(played['meta'], base64.b64decode(played['data'])) for played in json.loads(out.stdout)]
+
+
+@pytest.mark.skipif(shutil.which('node') is None, reason='node is not installed')
+def test_page_plays_every_frame_of_a_generation(tmp_path):
+    streams = frames.FrameStreams()
+    preview = frames.pack_frame(frames.preview_meta(0, 5, 25, 'image/png'), encoded_frame(255))
+    payloads = generation(streams)
+    played = play(tmp_path, [[preview], payloads])
+    assert [meta.get('step') for meta, _ in played[:1]] == [5]
+    assert [meta['index'] for meta, _ in played[1:]] == list(range(16))
+    assert [data for _, data in played[1:]] == [frames.unpack_frame(payload)[1] for payload in payloads]
+
+
+@pytest.mark.skipif(shutil.which('node') is None, reason='node is not installed')
+def test_page_skips_to_a_newer_generation(tmp_path):
+    streams = frames.FrameStreams()
+    first, second = generation(streams), generation(streams)
+    played = play(tmp_path, [first, [], [], second])
+    assert [(meta['gen'], meta['index']) for meta, _ in played] == \
+        [(0, 0), (0, 1), (0, 2)] + [(1, index) for index in range(16)]
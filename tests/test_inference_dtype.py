@@ -0,0 +1,36 @@
+import torch
+
+from conftest import build_tiny_model, load
+
+
+def sample_video(model):
+    motionctrl_sample = load('main.evaluation.motionctrl_inference').motionctrl_sample
+    inputs = torch.Generator().manual_seed(0)
+    camera_poses = torch.randn(1, model.temporal_length, 12, generator=inputs)
+    trajs = torch.randn(1, 2, model.temporal_length, 64, 64, generator=inputs)
+    torch.manual_seed(1234)
+    return motionctrl_sample(model, ['a rose swaying in the wind'], [1, model.channels, model.temporal_length, 8, 8],
+                             camera_poses=camera_poses, trajs=trajs, unconditional_guidance_scale=7.5,
+                             ddim_steps=4, ddim_eta=0., cond_T=800)
+
+
+def test_bf16_inference_on_cpu_matches_fp32():
+    check_dtype_psnr = load('main.evaluation.check_dtype_psnr')
+    reference = sample_video(build_tiny_model())
+    model = build_tiny_model().cast_inference_dtype(torch.bfloat16)
+    video = sample_video(model)
+
+    # networks in bf16 but their norms, the diffusion schedule stays fp32
+    unet = model.model.diffusion_model
+    assert unet.input_blocks[0][0].weight.dtype == torch.bfloat16
+    assert model.first_stage_model.decoder.conv_out.weight.dtype == torch.bfloat16
+    assert model.cond_stage_model.emb.weight.dtype == torch.bfloat16
+    norms = [module for module in model.modules() if isinstance(module, (torch.nn.GroupNorm, torch.nn.LayerNorm))]
+    assert norms and all(param.dtype == torch.float32 for norm in norms for param in norm.parameters())
+    assert model.alphas_cumprod.dtype == torch.float32
+
+    # latents stay fp32 and decoded videos come out in fp32, only the forward passes are autocast
+    assert reference.dtype == video.dtype == torch.float32
+    assert not torch.equal(video, reference)
+    # ~46 dB on the tiny model
+    assert check_dtype_psnr.video_psnr(reference, video) >= 35.
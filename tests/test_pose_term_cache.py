@@ -0,0 +1,52 @@
+import pytest
+import torch
+
+from conftest import load
+from test_batched_cfg import sample
+
+
+def pose_blocks(model):
+    return [module for module in model.model.diffusion_model.modules() if hasattr(module, 'cc_projection')]
+
+
+def test_cached_pose_term_matches_uncached(monkeypatch, tiny_model):
+    modules = load('motionctrl.lvdm_modified_modules')
+    cached_term = modules.cc_projection_pose_term
+    computed = []
+
+    def count(self, pose_emb, dim):
+        if getattr(self, 'pose_term_cache', None) is None:
+            computed.append(self)
+        return cached_term(self, pose_emb, dim)
+
+    monkeypatch.setattr(modules, 'cc_projection_pose_term', count)
+    cached = sample(tiny_model, True, 0., 0)
+    assert len(computed) == len(pose_blocks(tiny_model))  # once per block for the whole run
+
+    def uncached_term(self, pose_emb, dim):
+        modules.clear_pose_term_cache(self)
+        return cached_term(self, pose_emb, dim)
+
+    monkeypatch.setattr(modules, 'cc_projection_pose_term', uncached_term)
+    assert torch.equal(sample(tiny_model, True, 0., 0), cached)
+
+
+def test_pose_term_cache_is_empty_after_sampling(tiny_model):
+    sample(tiny_model, True, 1., 0)
+    assert all(block.pose_term_cache is None for block in pose_blocks(tiny_model))
+
+
+def test_pose_term_cache_is_empty_after_a_failed_run(tiny_model):
+    DDIMSampler = load('lvdm.models.samplers.ddim').DDIMSampler
+
+    def interrupt(pred_x0, i):
+        # the pose terms are cached by now
+        assert all(block.pose_term_cache is not None for block in pose_blocks(tiny_model))
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        DDIMSampler(tiny_model).sample(S=4, batch_size=1, shape=[tiny_model.channels, tiny_model.temporal_length, 8, 8],
+                                       conditioning=torch.randn(1, 8, 1024), verbose=False, img_callback=interrupt,
+                                       pose_emb=torch.randn(1, tiny_model.temporal_length, 12, 1),
+                                       temporal_length=tiny_model.temporal_length)
+    assert all(block.pose_term_cache is None for block in pose_blocks(tiny_model))
@@ -0,0 +1,49 @@
+import pytest
+import torch
+from einops import rearrange, repeat
+
+from conftest import load
+
+
+def temporal_transformer(relative_position):
+    attention = load('lvdm.modules.attention')
+    torch.manual_seed(0)
+    transformer = attention.TemporalTransformer(32, n_heads=2, d_head=16, context_dim=64, use_checkpoint=False,
+                                                only_self_att=False, relative_position=relative_position,
+                                                temporal_length=4)
+    return transformer.eval()
+
+
+def per_sample_blocks(transformer, x, context, t, hw):
+    """ the cross-attention branch before batching: one sample at a time, its context repeated hw times """
+    b = x.shape[0] // hw
+    x = rearrange(x, '(b hw) t c -> b hw t c', b=b).clone()
+    context = rearrange(context, '(b t) l con -> b t l con', t=t)
+    for block in transformer.transformer_blocks:
+        for j in range(b):
+            context_j = repeat(context[j][0:1], 't l con -> (t r) l con', r=hw)
+            x[j] = block(x[j], context=context_j)
+    return rearrange(x, 'b hw t c -> (b hw) t c')
+
+
+@pytest.mark.parametrize('relative_position', [False, True], ids=['shared', 'relative_position'])
+@pytest.mark.parametrize('max_batch', [None, 2 * 6 * 2], ids=['one_chunk', 'chunks_of_2'])
+def test_cross_attention_blocks_match_per_sample_loop(monkeypatch, relative_position, max_batch):
+    if max_batch is not None:
+        monkeypatch.setattr(load('lvdm.modules.attention'), 'MAX_ATTENTION_BATCH', max_batch)
+    transformer = temporal_transformer(relative_position)
+    b, t, hw = 5, 4, 6
+    x = torch.randn(b * hw, t, 32)
+    context = torch.randn(b * t, 7, 64)
+    with torch.no_grad():
+        expected = per_sample_blocks(transformer, x, context, t, hw)
+        out = transformer.cross_attention_blocks(x, context, t, hw)
+    assert torch.allclose(out, expected, atol=1e-5)
+
+
+def test_context_batch_mismatch_raises():
+    transformer = temporal_transformer(False)
+    with pytest.raises(ValueError):
+        transformer.cross_attention_blocks(torch.randn(3 * 6, 4, 32), torch.randn(2 * 4, 7, 64), 4, 6)
+    with pytest.raises(ValueError):
+        transformer.transformer_blocks[0].attn2(torch.randn(5, 4, 32), context=torch.randn(2, 7, 64))
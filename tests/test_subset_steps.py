@@ -0,0 +1,36 @@
+import pytest
+import torch
+
+from conftest import load
+
+
+def test_subset_steps_is_one_less_than_timesteps():
+    subset_steps = load('lvdm.models.samplers.ddim').subset_steps
+    for total in range(1, 101):
+        for timesteps in range(1, total + 1):
+            assert subset_steps(timesteps, total) == timesteps - 1
+        assert subset_steps(total + 5, total) == total - 1
+
+
+@pytest.mark.parametrize('sampler', ['ddim', 'dpmpp_2m'])
+@pytest.mark.parametrize('steps, timesteps', [(22, 15), (50, 29), (8, 8)])
+def test_sampling_a_subset_runs_the_pinned_step_count(tiny_model, sampler, steps, timesteps):
+    make_sampler = load('lvdm.models.samplers.solvers').make_sampler
+    calls = []
+    make_sampler(sampler, tiny_model).sample(S=steps, batch_size=1,
+                                             shape=[tiny_model.channels, tiny_model.temporal_length, 8, 8],
+                                             conditioning=torch.randn(1, 8, 1024), verbose=False,
+                                             callback=calls.append, timesteps=timesteps,
+                                             temporal_length=tiny_model.temporal_length)
+    assert len(calls) == timesteps - 1
+
+
+def test_restart_runs_the_remaining_steps():
+    ddim = load('lvdm.models.samplers.ddim')
+    for total in (22, 25, 50):
+        ddim_timesteps = list(range(1, 1000, 1000 // total))[:total]
+        for restart_T in range(0, 1000, 37):
+            skipped, remaining = ddim.restart_split(ddim_timesteps, restart_T)
+            assert skipped + remaining == total
+            if skipped:  # a restart, without it the run is a full one
+                assert ddim.subset_steps(remaining + 1, total) == remaining
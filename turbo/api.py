@@ -1,112 +1,71 @@
-#This is an example that uses the websockets api to know when a prompt execution is done
-#Once the prompt execution is done it downloads the images using the /history endpoint
+#Turbo server: camera / trajectory updates of every room go through a latest-wins job queue to ComfyUI,
+#results are routed back to the room of their prompt id
+import asyncio
 import os
-import websocket #NOTE: websocket-client (https://github.com/websocket-client/websocket-client)
-import uuid
+import threading
 import json
-import urllib.request
-import urllib.parse
 from flask import Flask, request, jsonify, render_template, session, abort
 from flask_socketio import SocketIO, join_room, leave_room,send, emit
 import secrets
 
-from PIL import Image
-import io
-import base64
-
-import time
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
-
-class FileCreatedHandler(FileSystemEventHandler):
-    def on_created(self, event):
-        # 处理文件创建完成的逻辑
-        file_path = event.src_path
-        file_name = os.path.basename(file_path)
-        print(f"New file created: {file_name}")
-        
-        time.sleep(.1)
-        with open(file_path, 'rb') as fr:
-            image_data=fr.read()
-            b64img=base64.b64encode(image_data).decode('utf-8')
-            socketio.emit('server_response',{'b64img':b64img})
-
-folder_to_watch = "/home/admin/ComfyUI/output/motionctrl"  # 要监控的文件夹路径
-
-event_handler = FileCreatedHandler()  # 创建我们刚才定义的自定义处理类的实例
-observer = Observer()
-observer.schedule(event_handler, folder_to_watch, recursive=False)
-observer.start()
-
-server_address = "127.0.0.1:8188"
-client_id = str(uuid.uuid4())
-
-def queue_prompt(prompt):
-    p = {"prompt": prompt, "client_id": client_id}
-    data = json.dumps(p).encode('utf-8')
-    req =  urllib.request.Request("http://{}/prompt".format(server_address), data=data)
-    return json.loads(urllib.request.urlopen(req).read())
-
-def get_image(filename, subfolder, folder_type):
-    data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
-    url_values = urllib.parse.urlencode(data)
-    with urllib.request.urlopen("http://{}/view?{}".format(server_address, url_values)) as response:
-        return response.read()
-
-def get_history(prompt_id):
-    with urllib.request.urlopen("http://{}/history/{}".format(server_address, prompt_id)) as response:
-        return json.loads(response.read())
-
-def get_images(ws, prompt):
-    prompt_id = queue_prompt(prompt)['prompt_id']
-    output_images = {}
-    '''
-    while True:
-        out = ws.recv()
-        if isinstance(out, str):
-            message = json.loads(out)
-            if message['type'] == 'executing':
-                data = message['data']
-                if data['node'] is None and data['prompt_id'] == prompt_id:
-                    break #Execution is done
-        else:
-            continue #previews are binary data
-
-    history = get_history(prompt_id)[prompt_id]
-    for o in history['outputs']:
-        for node_id in history['outputs']:
-            node_output = history['outputs'][node_id]
-            if 'images' in node_output:
-                images_output = []
-                for image in node_output['images']:
-                    image_data = get_image(image['filename'], image['subfolder'], image['type'])
-                    images_output.append(image_data)
-            output_images[node_id] = images_output
-
-    return output_images
-    '''
-
-prompt={}
-with open('./workflow_api_motionctrl_turbo.json') as fr:
-    prompt = json.load(fr)
+from comfy_client import ComfyClient
+from frames import FRAME_FORMATS, FrameStreams, pack_animation, pack_frame, preview_meta
+from jobs import RoomJobQueue, build_prompt
 
-ws = websocket.WebSocket()
-ws.connect("ws://{}/ws?clientId={}".format(server_address, client_id))
+server_address = os.environ.get('COMFYUI_ADDRESS', "127.0.0.1:8188")
+max_in_flight = int(os.environ.get('TURBO_MAX_IN_FLIGHT', 2))  # prompts queued on ComfyUI at once, over all rooms
+# 'frames': every output image as its own binary event, 'webp': one animated WebP per generation
+frame_format = os.environ.get('TURBO_FRAME_FORMAT', 'frames')
+job_timeout = float(os.environ.get('TURBO_JOB_TIMEOUT', 120))  # seconds before a lost prompt frees its room
+assert frame_format in FRAME_FORMATS, f"TURBO_FRAME_FORMAT should be one of {FRAME_FORMATS}, got {frame_format}"
 
-#Commented out code to display the output images:
-
-# for node_id in images:
-#     for image_data in images[node_id]:
-#         from PIL import Image
-#         import io
-#         image = Image.open(io.BytesIO(image_data))
-#         image.show()
+with open('./workflow_api_motionctrl_turbo.json') as fr:
+    workflow = json.load(fr)
+
+# the ComfyUI client and the job queue live on their own event loop, socket handlers hand jobs over to it
+loop = asyncio.new_event_loop()
+threading.Thread(target=loop.run_forever, daemon=True).start()
+comfy = asyncio.run_coroutine_threadsafe(ComfyClient(server_address).start(), loop).result()
+
+async def run_job(room, prompt):
+    gen = streams.start(room)
+    def on_preview(run, data, mime):
+        # pred_x0 previews of the sampler node, see its `preview` / `preview_every` inputs
+        socketio.emit('preview', pack_frame(preview_meta(gen, *run.progress, mime), data), to=room)
+    run = await comfy.queue_prompt(prompt, on_preview)
+    # raises PromptError on execution_error / execution_interrupted, the room's next update runs anyway
+    await comfy.wait(run, job_timeout)
+    images = run.images()
+    if not images:
+        return
+    # all frames are fetched concurrently over the pooled connections and pushed in order
+    fetches = [asyncio.ensure_future(comfy.get_image(image)) for image in images]
+    try:
+        if frame_format == 'webp':
+            frames = await asyncio.gather(*fetches)
+            data = await loop.run_in_executor(None, pack_animation, frames)
+            socketio.emit('frame', pack_frame(streams.meta(room, gen, 0, 1, 'image/webp', animated=True), data),
+                          to=room)
+            return
+        for index, fetch in enumerate(fetches):
+            data = await fetch
+            mime = 'image/png' if images[index]['filename'].endswith('.png') else 'image/jpeg'
+            socketio.emit('frame', pack_frame(streams.meta(room, gen, index, len(images), mime), data), to=room)
+    finally:
+        for fetch in fetches:
+            fetch.cancel()
+
+jobs = RoomJobQueue(run_job, max_in_flight)
+streams = FrameStreams()
 
 app = Flask(__name__, template_folder=os.path.abspath('.'), static_folder='assets')
 app.secret_key = secrets.token_hex(16)
 
 socketio = SocketIO(app, cors_allowed_origins='*')
 connected_sids = set()  # 存放已连接的客户端
+sid_rooms = {}  # sid -> roomid
+heartbeat_lock = threading.Lock()
+heartbeat_started = False  # one heartbeat task broadcasts to every client
 
 #后端程序
 lockroom='None'
@@ -114,11 +73,19 @@ lockroom='None'
 def on_connect():
     connected_sids.add(request.sid)
     print(f'{request.sid} 已连接')
-    socketio.start_background_task(background_thread_heartbeat)
+    global heartbeat_started
+    with heartbeat_lock:
+        if not heartbeat_started:
+            heartbeat_started = True
+            socketio.start_background_task(background_thread_heartbeat)
 
 @socketio.on('disconnect')
 def on_disconnect():
     connected_sids.remove(request.sid)
+    room = sid_rooms.pop(request.sid, None)
+    if room is not None and room not in sid_rooms.values():
+        loop.call_soon_threadsafe(jobs.drop_room, room)
+        loop.call_soon_threadsafe(streams.drop, room)
     print(f'{request.sid} 已断开')
 
 @socketio.on('message')
@@ -128,31 +95,16 @@ def handle_message(message):
     json.loads(message)
 
 @socketio.on('camera_poses')
-def handle_message(camera_poses):
+def handle_camera_poses(camera_poses):
     print(f'camera_poses:{request.sid} {camera_poses}')
-    cams=json.loads(camera_poses["camera_poses"])
-    trajs=json.loads(camera_poses["trajs"])
-    if len(cams)>1 and len(trajs)>1:
-        prompt["60"]["inputs"]["infer_mode"] = "control both camera and object motion"
-    elif len(trajs)>1:
-        prompt["60"]["inputs"]["infer_mode"] = "control object trajectory"
-    else:
-        prompt["60"]["inputs"]["infer_mode"] = "control camera poses"
-
-    prompt["60"]["inputs"]["prompt"] = camera_poses["prompt"]
-    prompt["60"]["inputs"]["camera"] = camera_poses["camera_poses"]
-    prompt["60"]["inputs"]["traj"] = camera_poses["trajs"]
-    images = get_images(ws, prompt)
-    '''
-    for node_id in images:
-        for image_data in images[node_id]:
-            b64img=base64.b64encode(image_data).decode('utf-8')
-            socketio.emit('server_response',{'b64img':b64img}, to=camera_poses["roomid"])
-    '''
+    prompt = build_prompt(workflow, camera_poses)
+    # supersedes the room's update still waiting, if any
+    loop.call_soon_threadsafe(jobs.submit, camera_poses["roomid"], prompt)
 
 @socketio.on('server_reconnect')
 def server_reconnect(message):
     print(f'server_reconnect:{request.sid} {message}')
+    sid_rooms[request.sid] = message['roomid']
     join_room(message['roomid'])
 
 def background_thread_heartbeat():
@@ -0,0 +1,179 @@
+"""
+Async client of a ComfyUI server: one pooled aiohttp session for /prompt, /view and /history plus one websocket
+whose messages are routed by prompt id, so every room of the turbo server shares the same few connections.
+A prompt completes on its `executing` message with node None, which ComfyUI sends after success, error or
+interruption alike; outputs of nodes served from ComfyUI's cache come from /history.
+Sampling previews arrive as binary messages without a prompt id, they belong to the prompt executing then.
+"""
+import asyncio
+import json
+import struct
+import uuid
+from collections import deque
+
+import aiohttp
+
+
+PREVIEW_IMAGE = 1  # binary event type of ComfyUI's previews
+PREVIEW_MIMES = {1: 'image/jpeg', 2: 'image/png'}
+
+
+class PromptError(RuntimeError):
+    pass
+
+
+class PromptRun(object):
+    """ a queued prompt, filled from the websocket messages of its prompt id """
+    def __init__(self, prompt_id):
+        self.prompt_id = prompt_id
+        self.outputs = {}  # node id -> `output` of its `executed` message, in execution order
+        self.cached = []  # nodes ComfyUI did not execute as their outputs were cached
+        self.error = None
+        self.progress = (0, 0)  # (value, max) of the last `progress` message
+        self.on_preview = None  # on_preview(run, image bytes, mime) of sampling previews
+        self.done = asyncio.get_running_loop().create_future()
+
+    def images(self):
+        return [image for output in self.outputs.values() for image in output.get('images', [])]
+
+
+class ComfyClient(object):
+    def __init__(self, server_address="127.0.0.1:8188", max_connections=8, reconnect_delay=1.):
+        self.server_address = server_address
+        self.max_connections = max_connections
+        self.reconnect_delay = reconnect_delay
+        self.client_id = str(uuid.uuid4())
+        self.session = None
+        self.ws = None
+        self.reader = None
+        self.runs = {}  # prompt id -> PromptRun, until its completion has been awaited
+        self.forgotten = deque(maxlen=1024)  # recently awaited prompt ids, late messages of these are ignored
+        self.executing = None  # prompt id ComfyUI executes
+
+    async def start(self):
+        connector = aiohttp.TCPConnector(limit=self.max_connections)
+        self.session = aiohttp.ClientSession(f"http://{self.server_address}", connector=connector)
+        self.ws = await self.connect()
+        self.reader = asyncio.create_task(self.read_messages())
+        return self
+
+    async def connect(self):
+        return await self.session.ws_connect(f"/ws?clientId={self.client_id}", heartbeat=30)
+
+    async def close(self):
+        if self.reader is not None:
+            self.reader.cancel()
+        if self.ws is not None:
+            await self.ws.close()
+        if self.session is not None:
+            await self.session.close()
+
+    def run_for(self, prompt_id):
+        # messages of a prompt may arrive before the response of its /prompt request
+        if prompt_id not in self.runs:
+            self.runs[prompt_id] = PromptRun(prompt_id)
+        return self.runs[prompt_id]
+
+    async def read_messages(self):
+        while True:
+            async for msg in self.ws:
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    self.handle_message(json.loads(msg.data))
+                elif msg.type == aiohttp.WSMsgType.BINARY:
+                    self.handle_preview(msg.data)
+            # ComfyUI restarted or the connection dropped: reconnect, then settle the prompts that finished
+            # meanwhile from /history
+            while True:
+                await asyncio.sleep(self.reconnect_delay)
+                try:
+                    self.ws = await self.connect()
+                    break
+                except aiohttp.ClientError:
+                    continue
+            for run in list(self.runs.values()):
+                if not run.done.done():
+                    asyncio.create_task(self.settle_from_history(run))
+
+    def handle_message(self, message):
+        data = message.get('data') or {}
+        prompt_id = data.get('prompt_id')
+        kind = message['type']
+        if kind == 'executing':
+            self.executing = prompt_id if data['node'] is not None else None
+        if prompt_id is None or prompt_id in self.forgotten:
+            return  # queue status, or a prompt given up on after a timeout
+        if kind == 'progress':
+            self.run_for(prompt_id).progress = (data['value'], data['max'])
+        elif kind == 'executed':
+            self.run_for(prompt_id).outputs[data['node']] = data['output']
+        elif kind == 'execution_cached':
+            self.run_for(prompt_id).cached.extend(data.get('nodes', []))
+        elif kind in ('execution_error', 'execution_interrupted'):
+            detail = data.get('exception_message') or 'interrupted'
+            self.run_for(prompt_id).error = f"{kind} in node {data.get('node_id')} ({data.get('node_type')}): {detail}"
+        elif kind == 'executing' and data['node'] is None:
+            run = self.run_for(prompt_id)
+            if run.cached:
+                # cached output nodes send no `executed` message
+                asyncio.create_task(self.settle_from_history(run))
+            else:
+                self.settle(run)
+
+    def handle_preview(self, message):
+        if len(message) < 8 or self.executing not in self.runs:
+            return
+        event, image_type = struct.unpack('>II', message[:8])
+        run = self.runs[self.executing]
+        if event == PREVIEW_IMAGE and image_type in PREVIEW_MIMES and run.on_preview is not None:
+            run.on_preview(run, message[8:], PREVIEW_MIMES[image_type])
+
+    def settle(self, run):
+        if run.done.done():
+            return
+        if run.error is not None:
+            run.done.set_exception(PromptError(run.error))
+        else:
+            run.done.set_result(run)
+
+    async def settle_from_history(self, run):
+        try:
+            history = (await self.get_history(run.prompt_id)).get(run.prompt_id)
+        except aiohttp.ClientError as e:
+            if not run.done.done():
+                run.done.set_exception(e)
+            return
+        if history is None:
+            return  # still queued or running, its messages follow on the new connection
+        for node_id, output in history.get('outputs', {}).items():
+            run.outputs.setdefault(node_id, output)
+        self.settle(run)
+
+    async def queue_prompt(self, prompt, on_preview=None):
+        """ the PromptRun of a new prompt, previews before the response of /prompt are not passed to on_preview """
+        payload = {"prompt": prompt, "client_id": self.client_id}
+        async with self.session.post("/prompt", json=payload) as response:
+            if response.status != 200:
+                # invalid prompt, the body lists the node errors
+                raise PromptError(f"prompt rejected ({response.status}): {await response.text()}")
+            run = self.run_for((await response.json())['prompt_id'])
+        run.on_preview = on_preview
+        return run
+
+    async def wait(self, run, timeout=None):
+        """ the completed run, raises PromptError if it failed and asyncio.TimeoutError after `timeout` seconds """
+        try:
+            return await asyncio.wait_for(asyncio.shield(run.done), timeout)
+        finally:
+            self.runs.pop(run.prompt_id, None)
+            self.forgotten.append(run.prompt_id)
+
+    async def get_image(self, image):
+        params = {"filename": image['filename'], "subfolder": image['subfolder'], "type": image['type']}
+        async with self.session.get("/view", params=params) as response:
+            response.raise_for_status()
+            return await response.read()
+
+    async def get_history(self, prompt_id):
+        async with self.session.get(f"/history/{prompt_id}") as response:
+            response.raise_for_status()
+            return await response.json()
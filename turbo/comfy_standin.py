@@ -0,0 +1,158 @@
+"""
+Local stand-in of the ComfyUI server endpoints used by the turbo api (/prompt, /ws, /view, /history), to run
+and load-test the turbo server without a GPU. Prompts run one at a time per simulated worker for --delay
+seconds, every SaveImage node then outputs `frame_length` small PNG frames kept in memory. The websocket sends
+the same `executing` / `executed` messages as ComfyUI; like ComfyUI, a prompt identical to an executed one is
+served from the cache with `execution_cached` and no `executed` message, its outputs are only in /history.
+A node with a `steps` input stands for the sampler: it takes the --delay, sends `progress` every step and a
+binary JPEG preview every `preview_every` steps unless its `preview` is 'off'.
+    python comfy_standin.py --port 8188 --delay 0.5
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import struct
+import uuid
+
+from aiohttp import web
+from PIL import Image, ImageDraw
+
+
+def render_frame(prompt_id, index, size=256, format='PNG'):
+    image = Image.new('RGB', (size, size), tuple((hash(prompt_id) >> shift) & 255 for shift in (0, 8, 16)))
+    ImageDraw.Draw(image).text((8, 8), f'{prompt_id[:8]} #{index}', fill=(255, 255, 255))
+    buffer = io.BytesIO()
+    image.save(buffer, format=format)
+    return buffer.getvalue()
+
+
+class ComfyStandin(object):
+    def __init__(self, delay=0.5, workers=1, frame_size=256):
+        self.delay = delay
+        self.workers = workers
+        self.frame_size = frame_size
+        self.queue = asyncio.Queue()
+        self.sockets = {}  # client id -> websocket
+        self.files = {}  # (subfolder, filename) -> png bytes
+        self.history = {}
+        self.cache = {}  # prompt json -> outputs
+        self.counter = itertools.count()
+        self.stats = {'queued': 0, 'executed': 0, 'cached': 0, 'views': 0, 'previews': 0, 'max_queue': 0}
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post('/prompt', self.post_prompt)
+        app.router.add_get('/ws', self.websocket)
+        app.router.add_get('/view', self.view)
+        app.router.add_get('/history/{prompt_id}', self.get_history)
+        app.on_startup.append(self.start_workers)
+        return app
+
+    async def start_workers(self, app):
+        for _ in range(self.workers):
+            asyncio.create_task(self.worker())
+
+    async def send(self, client_id, message_type, data):
+        ws = self.sockets.get(client_id)
+        if ws is not None and not ws.closed:
+            await ws.send_json({'type': message_type, 'data': data})
+
+    async def send_preview(self, client_id, image):
+        ws = self.sockets.get(client_id)
+        if ws is not None and not ws.closed:
+            await ws.send_bytes(struct.pack('>II', 1, 1) + image)  # PREVIEW_IMAGE, JPEG
+            self.stats['previews'] += 1
+
+    async def sample(self, client_id, prompt_id, node_id, inputs):
+        steps = max(1, inputs['steps'])
+        every = inputs.get('preview_every', 5) if inputs.get('preview', 'off') != 'off' else 0
+        for step in range(1, steps + 1):
+            await asyncio.sleep(self.delay / steps)
+            await self.send(client_id, 'progress', {'value': step, 'max': steps, 'prompt_id': prompt_id,
+                                                    'node': node_id})
+            if every and step % every == 0 and step < steps:
+                await self.send_preview(client_id, render_frame(prompt_id, step, self.frame_size // 4, 'JPEG'))
+
+    async def post_prompt(self, request):
+        body = await request.json()
+        prompt_id = str(uuid.uuid4())
+        number = next(self.counter)
+        await self.queue.put((prompt_id, body['prompt'], body.get('client_id')))
+        self.stats['queued'] += 1
+        self.stats['max_queue'] = max(self.stats['max_queue'], self.queue.qsize())
+        return web.json_response({'prompt_id': prompt_id, 'number': number, 'node_errors': {}})
+
+    async def worker(self):
+        while True:
+            prompt_id, prompt, client_id = await self.queue.get()
+            frames = next((node['inputs']['frame_length'] for node in prompt.values()
+                           if 'frame_length' in node.get('inputs', {})), 16)
+            outputs = {}
+            await self.send(client_id, 'execution_start', {'prompt_id': prompt_id})
+            key = json.dumps(prompt, sort_keys=True)
+            if key in self.cache:
+                self.history[prompt_id] = {'prompt': prompt, 'outputs': self.cache[key]}
+                self.stats['cached'] += 1
+                await self.send(client_id, 'execution_cached', {'nodes': list(prompt), 'prompt_id': prompt_id})
+                await self.send(client_id, 'executing', {'node': None, 'prompt_id': prompt_id})
+                continue
+            sampled = any('steps' in node.get('inputs', {}) for node in prompt.values())
+            for node_id, node in prompt.items():
+                await self.send(client_id, 'executing', {'node': node_id, 'prompt_id': prompt_id})
+                if 'steps' in node.get('inputs', {}):
+                    await self.sample(client_id, prompt_id, node_id, node['inputs'])
+                if node['class_type'] != 'SaveImage':
+                    continue
+                if not sampled:
+                    await asyncio.sleep(self.delay)
+                prefix = node['inputs'].get('filename_prefix', 'ComfyUI')
+                subfolder, _, name = prefix.rpartition('/')
+                images = []
+                for i in range(frames):
+                    filename = f'{name}_{prompt_id[:8]}_{i:05d}_.png'
+                    self.files[(subfolder, filename)] = render_frame(prompt_id, i, self.frame_size)
+                    images.append({'filename': filename, 'subfolder': subfolder, 'type': 'output'})
+                outputs[node_id] = {'images': images}
+                await self.send(client_id, 'executed', {'node': node_id, 'output': outputs[node_id],
+                                                        'prompt_id': prompt_id})
+            self.history[prompt_id] = {'prompt': prompt, 'outputs': outputs}
+            self.cache[key] = outputs
+            self.stats['executed'] += 1
+            await self.send(client_id, 'executing', {'node': None, 'prompt_id': prompt_id})
+
+    async def websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        client_id = request.query.get('clientId') or str(uuid.uuid4())
+        self.sockets[client_id] = ws
+        await ws.send_json({'type': 'status', 'data': {'status': {'exec_info': {'queue_remaining': self.queue.qsize()}},
+                                                       'sid': client_id}})
+        try:
+            async for _ in ws:
+                pass
+        finally:
+            self.sockets.pop(client_id, None)
+        return ws
+
+    async def view(self, request):
+        key = (request.query.get('subfolder', ''), request.query['filename'])
+        if key not in self.files:
+            raise web.HTTPNotFound()
+        self.stats['views'] += 1
+        return web.Response(body=self.files[key], content_type='image/png')
+
+    async def get_history(self, request):
+        prompt_id = request.match_info['prompt_id']
+        return web.json_response({prompt_id: self.history[prompt_id]} if prompt_id in self.history else {})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8188)
+    parser.add_argument("--delay", type=float, default=0.5, help="seconds per generation")
+    parser.add_argument("--workers", type=int, default=1, help="prompts executed concurrently")
+    args = parser.parse_args()
+    web.run_app(ComfyStandin(args.delay, args.workers).app(), host=args.host, port=args.port)
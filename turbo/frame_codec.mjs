@@ -0,0 +1,57 @@
+// binary `frame` / `preview` payloads of the turbo server, the layout of pack_frame in frames.py:
+// uint32 big-endian n | n bytes of UTF-8 JSON metadata | frame bytes
+export function unpackFrame(payload){
+    var bytes=payload instanceof ArrayBuffer?new Uint8Array(payload):new Uint8Array(payload.buffer, payload.byteOffset, payload.byteLength);
+    var length=new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength).getUint32(0, false);
+    var meta=JSON.parse(new TextDecoder('utf-8').decode(bytes.subarray(4, 4+length)));
+    return {meta: meta, data: bytes.subarray(4+length)};
+}
+
+// frames waiting to be played, one per tick: the server sends a whole generation at once, so every frame of the
+// latest generation is kept and played in seq order; a newer generation drops what is still queued of older
+// ones, and frames of an older generation than the latest are dropped on arrival.
+// The latest sampling preview {gen, step, steps, mime} of a generation still running is played once the frames
+// are, if no frame of its generation arrived meanwhile.
+export class FrameQueue{
+    constructor(){
+        this.reset();
+    }
+
+    reset(){
+        this.latestGen=-1;
+        this.frames=[];
+        this.preview=null;
+    }
+
+    pushFrame(meta, item){
+        if(meta.gen<this.latestGen)return false;
+        if(meta.gen>this.latestGen){
+            this.latestGen=meta.gen;
+            this.frames=[];
+        }
+        var at=this.frames.length;
+        while(at>0&&this.frames[at-1].meta.seq>meta.seq)at--;
+        this.frames.splice(at, 0, {meta: meta, item: item});
+        return true;
+    }
+
+    pushPreview(meta, item){
+        if(meta.gen<=this.latestGen)return false;
+        var preview=this.preview;
+        if(preview&&(meta.gen<preview.meta.gen||(meta.gen==preview.meta.gen&&meta.step<=preview.meta.step)))return false;
+        this.preview={meta: meta, item: item};
+        return true;
+    }
+
+    // {meta, item} to play on this tick, or null
+    next(){
+        if(this.frames.length)return this.frames.shift();
+        if(this.preview&&this.preview.meta.gen>this.latestGen){
+            var preview=this.preview;
+            this.preview=null;
+            return preview;
+        }
+        this.preview=null;
+        return null;
+    }
+}
@@ -0,0 +1,60 @@
+"""
+Binary `frame` events of the turbo server: one binary Socket.IO payload per frame, no base64, laid out as
+    uint32 big-endian n | n bytes of UTF-8 JSON metadata | frame bytes
+(pack_frame here, unpackFrame in frame_codec.mjs for the page). `gen` numbers the results of a room and `seq` its frames, the client drops frames of
+an older generation than the one it shows. `preview` events carry a sampling preview of a generation still
+running, with the same `gen` its frames will have.
+"""
+import io
+import json
+import struct
+
+from PIL import Image
+
+FRAME_FORMATS = ['frames', 'webp']
+META_LENGTH = struct.Struct('>I')
+
+
+class FrameStreams(object):
+    """ per room generation & frame counters """
+    def __init__(self):
+        self.rooms = {}  # room -> [last generation, last frame seq]
+
+    def start(self, room):
+        counters = self.rooms.setdefault(room, [-1, -1])
+        counters[0] += 1
+        return counters[0]
+
+    def meta(self, room, gen, index, count, mime, animated=False):
+        counters = self.rooms.setdefault(room, [gen, -1])  # the room may have been dropped meanwhile
+        counters[1] += 1
+        return {'gen': gen, 'seq': counters[1], 'index': index, 'count': count, 'mime': mime, 'animated': animated}
+
+    def drop(self, room):
+        self.rooms.pop(room, None)
+
+
+def preview_meta(gen, step, steps, mime):
+    return {'gen': gen, 'step': step, 'steps': steps, 'mime': mime}
+
+
+def pack_frame(meta, data):
+    """ metadata dict + encoded image bytes -> one binary event payload """
+    header = json.dumps(meta, separators=(',', ':')).encode('utf-8')
+    return META_LENGTH.pack(len(header)) + header + bytes(data)
+
+
+def unpack_frame(payload):
+    """ inverse of pack_frame, (meta, data) """
+    length, = META_LENGTH.unpack_from(payload)
+    start = META_LENGTH.size + length
+    return json.loads(bytes(payload[META_LENGTH.size:start]).decode('utf-8')), bytes(payload[start:])
+
+
+def pack_animation(frames, fps=10, quality=80):
+    """ encoded frames (png, jpeg ...) -> one animated WebP """
+    images = [Image.open(io.BytesIO(frame)).convert('RGB') for frame in frames]
+    buffer = io.BytesIO()
+    images[0].save(buffer, format='WEBP', save_all=True, append_images=images[1:], duration=int(1000 / fps), loop=0,
+                   quality=quality)
+    return buffer.getvalue()
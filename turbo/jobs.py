@@ -0,0 +1,78 @@
+"""
+Per-room scheduling of turbo generations. A room is one browser tab dragging the camera / trajectory; it sends
+updates far faster than a generation runs, so only its latest update matters.
+"""
+import asyncio
+import copy
+import json
+import traceback
+from collections import OrderedDict
+
+COND_NODE = "60"
+
+
+def build_prompt(template, message):
+    """ the workflow of a `camera_poses` socket message, on a copy of the template """
+    prompt = copy.deepcopy(template)
+    cams = json.loads(message["camera_poses"])
+    trajs = json.loads(message["trajs"])
+    inputs = prompt[COND_NODE]["inputs"]
+    if len(cams) > 1 and len(trajs) > 1:
+        inputs["infer_mode"] = "control both camera and object motion"
+    elif len(trajs) > 1:
+        inputs["infer_mode"] = "control object trajectory"
+    else:
+        inputs["infer_mode"] = "control camera poses"
+    inputs["prompt"] = message["prompt"]
+    inputs["camera"] = message["camera_poses"]
+    inputs["traj"] = message["trajs"]
+    # continuation latents of `context_overlap` are kept per room
+    inputs["session_id"] = str(message["roomid"])
+    return prompt
+
+
+class RoomJobQueue(object):
+    """
+    Latest-wins job queue: each room has at most one waiting job, a newer job of the room replaces it, and at
+    most one running job. At most `max_in_flight` jobs run over all rooms, rooms take turns in the order they
+    started waiting. `run_job(room, job)` is a coroutine; all methods are called on the event loop thread.
+    """
+    def __init__(self, run_job, max_in_flight=2):
+        self.run_job = run_job
+        self.max_in_flight = max_in_flight
+        self.pending = OrderedDict()  # room -> latest job
+        self.running = set()
+        self.stats = {'submitted': 0, 'coalesced': 0, 'started': 0, 'finished': 0, 'failed': 0}
+
+    def submit(self, room, job):
+        self.stats['submitted'] += 1
+        if room in self.pending:
+            self.stats['coalesced'] += 1
+        self.pending[room] = job
+        self.schedule()
+
+    def schedule(self):
+        for room in list(self.pending):
+            if len(self.running) >= self.max_in_flight:
+                break
+            if room in self.running:
+                continue
+            job = self.pending.pop(room)
+            self.running.add(room)
+            self.stats['started'] += 1
+            asyncio.get_running_loop().create_task(self.run(room, job))
+
+    async def run(self, room, job):
+        try:
+            await self.run_job(room, job)
+            self.stats['finished'] += 1
+        except Exception:
+            self.stats['failed'] += 1
+            traceback.print_exc()
+        finally:
+            self.running.discard(room)
+            self.schedule()
+
+    def drop_room(self, room):
+        """ forget the waiting job of a room that left, its running job completes """
+        self.pending.pop(room, None)
@@ -0,0 +1,105 @@
+"""
+Offline load test of the turbo pipeline: --rooms simulated clients send camera updates at --rate per second for
+--duration seconds through the RoomJobQueue and ComfyClient of api.py, against a ComfyStandin (started in
+process on a free port unless --server is given).
+Reports how many updates were coalesced, how many prompts reached ComfyUI and the latency from a room's last
+update to the delivery of a result that includes it.
+    python load_test.py --rooms 20 --rate 10 --duration 10 --max_in_flight 2 --delay 0.3
+"""
+import argparse
+import asyncio
+import json
+import socket
+import statistics
+import time
+
+from aiohttp import web
+
+from comfy_client import ComfyClient
+from comfy_standin import ComfyStandin
+from jobs import RoomJobQueue, build_prompt
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def camera_message(room, step):
+    pose = [1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0.01 * step]
+    return {"roomid": room, "prompt": "a rose swaying in the wind",
+            "camera_poses": json.dumps([pose]), "trajs": json.dumps([[512, 512]])}
+
+
+async def load_test(args):
+    runner = None
+    server = args.server
+    if server is None:
+        standin = ComfyStandin(args.delay, args.workers, frame_size=64)
+        runner = web.AppRunner(standin.app())
+        await runner.setup()
+        port = free_port()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        server = f'127.0.0.1:{port}'
+    with open(args.workflow) as fr:
+        workflow = json.load(fr)
+    comfy = await ComfyClient(server).start()
+
+    last_update = {}  # room -> (step, time) of its latest update
+    latencies, frames, previews = [], [0], [0]
+
+    def on_preview(run, data, mime):
+        previews[0] += 1
+
+    async def run_job(room, job):
+        step, prompt = job
+        run = await comfy.queue_prompt(prompt, on_preview)
+        await comfy.wait(run)
+        for image in run.images():
+            await comfy.get_image(image)
+            frames[0] += 1
+        latest_step, latest_time = last_update[room]
+        if step == latest_step:
+            latencies.append(time.time() - latest_time)
+
+    jobs = RoomJobQueue(run_job, args.max_in_flight)
+
+    async def room_client(room):
+        step = 0
+        end = time.time() + args.duration
+        while time.time() < end:
+            last_update[room] = (step, time.time())
+            jobs.submit(room, (step, build_prompt(workflow, camera_message(room, step))))
+            step += 1
+            await asyncio.sleep(1. / args.rate)
+
+    start = time.time()
+    await asyncio.gather(*[room_client(room) for room in range(args.rooms)])
+    while jobs.pending or jobs.running:
+        await asyncio.sleep(0.05)
+    elapsed = time.time() - start
+    await comfy.close()
+    if runner is not None:
+        await runner.cleanup()
+
+    stats = jobs.stats
+    print(f"updates {stats['submitted']}, coalesced {stats['coalesced']}, prompts {stats['started']} "
+          f"({stats['failed']} failed), frames delivered {frames[0]}, previews {previews[0]} in {elapsed:.1f} s")
+    if latencies:
+        print(f"latest update -> result: median {statistics.median(latencies) * 1000:.0f} ms, "
+              f"max {max(latencies) * 1000:.0f} ms over {len(latencies)} rooms")
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--rate", type=float, default=10, help="updates per second and room")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of slider dragging")
+    parser.add_argument("--max_in_flight", type=int, default=2)
+    parser.add_argument("--delay", type=float, default=0.3, help="stand-in seconds per generation")
+    parser.add_argument("--workers", type=int, default=1, help="stand-in prompts executed concurrently")
+    parser.add_argument("--server", type=str, default=None, help="host:port of a running ComfyUI (or stand-in)")
+    parser.add_argument("--workflow", type=str, default='./workflow_api_motionctrl_turbo.json')
+    asyncio.run(load_test(parser.parse_args()))
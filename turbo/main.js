@@ -3,6 +3,7 @@ import * as THREE from 'three';
 import { OrbitControls } from 'three/examples/jsm/controls/OrbitControls.js';
 import { TransformControls } from 'three/examples/jsm/controls/TransformControls.js';
 import { io } from "https://cdn.socket.io/4.7.2/socket.io.esm.min.js";
+import { FrameQueue, unpackFrame } from './frame_codec.mjs';
 
 let cameraPersp, cameraPerspTransform, currentCamera, cameraPerspTransformHelper;
 let scene, renderer, control, orbit;
@@ -98,27 +99,73 @@ function userDrawnPixelsPush(point){
 
 var socket = io();
 socket.on('connect', function() {
+  // the server restarts the generation numbers of a room that reconnects
+  frameQueue.reset();
   socket.emit('server_reconnect', {roomid: roomid});
 });
 
+// binary frames: metadata {gen, seq, index, count, mime, animated} + image bytes in one ArrayBuffer, no base64,
+// see frame_codec.mjs.
+// frames play at FRAME_FPS, every frame of the latest generation; a newer generation drops what is still queued
+// of older ones (FrameQueue)
+const FRAME_FPS=10;
+const frameQueue=new FrameQueue();
+let decoding=false;
+let animatedImage=null;
+
+socket.on("frame", function (payload) {
+    var {meta, data}=unpackFrame(payload);
+    frameQueue.pushFrame(meta, new Blob([data], {type: meta.mime}));
+});
 
-socket.on("server_response", function (msg,ack) {
-    console.log(msg);
-    //接收到后端发送过来的消息
-    var b64img = msg.b64img;
-    if(!b64img)return;
+socket.on("preview", function (payload) {
+    // sampling preview {gen, step, steps, mime} of a generation still running, shown once the frames are played
+    var {meta, data}=unpackFrame(payload);
+    frameQueue.pushPreview(meta, new Blob([data], {type: meta.mime}));
+});
 
-    var image = new Image();
-    image.src = 'data:image/jpeg;base64,' + b64img;
+function drawFrame(image){
+    ctx.drawImage(image,0,0,256,256);
+    drawDot(ctx,userDrawnPixels1024[userDrawnPixels1024.length-1][0]/4,userDrawnPixels1024[userDrawnPixels1024.length-1][1]/4,6);
+}
 
-    image.onload=function(){
-        ctx.drawImage(image,0,0,256,256);
-        drawDot(ctx,userDrawnPixels1024[userDrawnPixels1024.length-1][0]/4,userDrawnPixels1024[userDrawnPixels1024.length-1][1]/4,6);
-    };
- });
+function playFrames(){
+    var item=decoding?null:frameQueue.next();
+    if(item){
+        if(item.meta.animated){
+            // an animated WebP of the whole generation, the browser plays it and every tick draws its current frame
+            var image=new Image();
+            image.onload=function(){
+                if(item.meta.gen<frameQueue.latestGen)return;
+                if(animatedImage)URL.revokeObjectURL(animatedImage.src);
+                animatedImage=image;
+            };
+            image.src=URL.createObjectURL(item.item);
+        }else{
+            decoding=true;
+            createImageBitmap(item.item).then(function(bitmap){
+                decoding=false;
+                if(item.meta.gen<frameQueue.latestGen)return;
+                if(animatedImage){
+                    URL.revokeObjectURL(animatedImage.src);
+                    animatedImage=null;
+                }
+                drawFrame(bitmap);
+                bitmap.close();
+            }, function(){
+                decoding=false;
+            });
+        }
+    }
+    if(animatedImage){
+        drawFrame(animatedImage);
+    }
+    setTimeout(playFrames, 1000/FRAME_FPS);
+}
 
 init();
 render();
+playFrames();
 
 
 
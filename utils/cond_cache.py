@@ -0,0 +1,156 @@
+import hashlib
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+import torch
+
+
+def tensor_digest(tensor):
+    """ content hash of a tensor (shape, dtype and values) """
+    tensor = tensor.detach()
+    digest = hashlib.sha1(f'{tuple(tensor.shape)}{tensor.dtype}'.encode('utf-8'))
+    digest.update(tensor.contiguous().cpu().reshape(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+
+def model_identity(model):
+    """
+    Stable identity of a model for cache keys. Models loaded through the model registry carry
+    `cache_identity` (derived from checkpoint path & mtime), others get a random per-object token.
+    """
+    identity = getattr(model, 'cache_identity', None)
+    if identity is None:
+        identity = f'anon-{uuid.uuid4().hex}'
+        model.cache_identity = identity
+    return identity
+
+
+def _to_device(value, device):
+    if isinstance(value, (list, tuple)):
+        return [v.to(device) for v in value]
+    return value.to(device)
+
+
+def _nbytes(value):
+    if isinstance(value, (list, tuple)):
+        return sum(v.numel() * v.element_size() for v in value)
+    return value.numel() * value.element_size()
+
+
+class ConditioningCache(object):
+    """
+    Bounded LRU cache of conditioning tensors (text embeddings, adapter features) kept on the
+    model's device, keyed by model identity plus the prompt strings or a trajectory hash.
+    :param max_entries: maximum number of cached conditionings.
+    :param max_bytes: memory budget for the cached tensors, None for no byte limit.
+    :param spill_dir: if set, evicted entries of registry-loaded models are saved there and
+                      reloaded on a later miss instead of being recomputed.
+    Cached tensors are shared between callers and must not be modified in place.
+    """
+    def __init__(self, max_entries=64, max_bytes=None, spill_dir=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.entries = OrderedDict()  # key -> (value, nbytes)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries),
+                    'bytes': sum(nbytes for _, nbytes in self.entries.values())}
+
+    def get_or_compute(self, key, compute_fn, device=None):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+
+            value = self._load_spilled(key, device)
+            if value is None:
+                with torch.no_grad():
+                    value = compute_fn()
+            self.entries[key] = (value, _nbytes(value))
+            self._shrink()
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def _shrink(self):
+        while len(self.entries) > 1:
+            total_bytes = sum(nbytes for _, nbytes in self.entries.values())
+            if len(self.entries) <= self.max_entries and (self.max_bytes is None or total_bytes <= self.max_bytes):
+                break
+            key, (value, _) = self.entries.popitem(last=False)
+            self._spill(key, value)
+
+    def _spill_path(self, key):
+        # only keys of registry-loaded models are meaningful across processes
+        if self.spill_dir is None or key[1].startswith('anon-'):
+            return None
+        return os.path.join(self.spill_dir, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.pt')
+
+    def _spill(self, key, value):
+        path = self._spill_path(key)
+        if path is None or os.path.exists(path):
+            return
+        os.makedirs(self.spill_dir, exist_ok=True)
+        torch.save(_to_device(value, 'cpu'), path)
+
+    def _load_spilled(self, key, device):
+        path = self._spill_path(key)
+        if path is None or not os.path.exists(path):
+            return None
+        return _to_device(torch.load(path, map_location='cpu'), device)
+
+    ## conditioning helpers
+    def get_learned_conditioning(self, model, prompts):
+        """ text embeddings of a list of prompts """
+        key = ('text', model_identity(model), tuple(prompts))
+        return self.get_or_compute(key, lambda: model.get_learned_conditioning(list(prompts)), model.device)
+
+    def get_traj_features(self, model, trajs, traj_key=None):
+        """
+        adapter features of `trajs` [b,c,t,h,w]; `traj_key` (e.g. the trajectory points string)
+        saves hashing the dense flow tensor when the caller already has a cheaper identity for it.
+        """
+        if traj_key is None:
+            traj_key = tensor_digest(trajs)
+        key = ('traj', model_identity(model), tuple(trajs.shape), traj_key)
+        return self.get_or_compute(key, lambda: model.get_traj_features(trajs), model.device)
+
+    def get_uncond_traj_features(self, model, trajs):
+        """ adapter features of an all-zeros trajectory, computed once per shape / temporal_length """
+        key = ('traj_zero', model_identity(model), tuple(trajs.shape), trajs.dtype)
+        return self.get_or_compute(key, lambda: model.get_traj_features(torch.zeros_like(trajs)), model.device)
+
+
+def _env_int(name):
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
+_cond_cache = None
+
+
+def get_cond_cache():
+    """
+    The shared conditioning cache. Configured once from the environment:
+    MOTIONCTRL_COND_CACHE_SIZE (entries, default 64), MOTIONCTRL_COND_CACHE_MB (memory budget)
+    and MOTIONCTRL_COND_CACHE_DIR (optional disk spill directory).
+    """
+    global _cond_cache
+    if _cond_cache is None:
+        max_entries = _env_int('MOTIONCTRL_COND_CACHE_SIZE')
+        max_mb = _env_int('MOTIONCTRL_COND_CACHE_MB')
+        _cond_cache = ConditioningCache(max_entries=64 if max_entries is None else max_entries,
+                                        max_bytes=None if max_mb is None else max_mb * 1024 * 1024,
+                                        spill_dir=os.environ.get('MOTIONCTRL_COND_CACHE_DIR') or None)
+    return _cond_cache
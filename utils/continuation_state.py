@@ -0,0 +1,197 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+DEFAULT_SESSION = 'default'
+
+
+class ContinuationState(object):
+    """
+    What a `context_overlap` continuation needs from the previous chunk of a video: the trailing latent frames
+    of the final sample (`x_inter`) and of its x0 prediction (`pred_x0`), kept on the sampling device, plus the
+    aligned camera / trajectory lists of the conditioning node.
+    For edits of the same clip it also keeps an edit anchor: the latent a full run had after its first
+    `skipped` steps, with the run's signature (everything but camera & trajectory) and camera / trajectory, so a
+    run that only moves these a little restarts from it. The anchor stays in memory, it is not persisted.
+    Passed between nodes as the MOTIONCTRL_STATE output, one instance per session (workflow, room, user ...).
+    """
+    def __init__(self, session_id, persist_dir=None):
+        self.session_id = session_id
+        self.persist_dir = persist_dir
+        self.x_inter = None
+        self.pred_x0 = None
+        self.camera_align = None
+        self.traj_align = None
+        self.edit_anchor = None  # (signature, camera, points, skipped, latent)
+        self.lock = threading.RLock()
+
+    @property
+    def path(self):
+        if self.persist_dir is None:
+            return None
+        name = hashlib.sha1(self.session_id.encode('utf-8')).hexdigest()
+        return os.path.join(self.persist_dir, f'{name}.pt')
+
+    def update_latents(self, x_inter, pred_x0, context_overlap=0):
+        """
+        keep the last `context_overlap` frames of the final [b,c,t,h,w] latents, all frames if 0 as the
+        overlap of the next chunk is not known yet
+        """
+        keep = context_overlap if context_overlap > 0 else x_inter.shape[2]
+        with self.lock:
+            self.x_inter = x_inter[:, :, -keep:].detach().clone()
+            self.pred_x0 = pred_x0[:, :, -keep:].detach().clone()
+            self.save()
+
+    def update_align(self, camera_align, traj_align):
+        with self.lock:
+            self.camera_align = camera_align
+            self.traj_align = traj_align
+            self.save()
+
+    def continuation_latents(self, noise, context_overlap):
+        """
+        (x0, x_T) of the next chunk: the last `context_overlap` frames of the previous chunk followed by `noise`,
+        (None, None) when there is no previous chunk with enough frames
+        """
+        with self.lock:
+            if self.x_inter is None or self.x_inter.shape[2] < context_overlap:
+                return None, None
+            x0 = torch.cat([self.pred_x0[:, :, -context_overlap:].to(noise), noise], dim=2)
+            x_T = torch.cat([self.x_inter[:, :, -context_overlap:].to(noise), noise], dim=2)
+            return x0, x_T
+
+    def update_edit_anchor(self, signature, camera, points, skipped, latent):
+        with self.lock:
+            self.edit_anchor = (signature, camera, points, skipped, latent.detach().clone())
+
+    def edit_restart(self, signature, camera, points, tolerance):
+        """
+        (skipped, latent) of the edit anchor if `signature` matches and neither the camera poses (largest change
+        of an RT entry) nor the trajectory points (largest move, as a fraction of the 1024 point range) moved by
+        more than `tolerance` from the anchor's, None otherwise
+        """
+        with self.lock:
+            if self.edit_anchor is None:
+                return None
+            anchor_signature, anchor_camera, anchor_points, skipped, latent = self.edit_anchor
+            if anchor_signature != signature or not edit_within(anchor_camera, camera, tolerance) \
+                    or not edit_within(anchor_points, points, tolerance * 1024):
+                return None
+            return skipped, latent
+
+    def reset(self):
+        with self.lock:
+            self.edit_anchor = None
+            self.x_inter = None
+            self.pred_x0 = None
+            self.camera_align = None
+            self.traj_align = None
+            if self.path is not None and os.path.exists(self.path):
+                os.remove(self.path)
+
+    def save(self):
+        if self.path is None:
+            return
+        os.makedirs(self.persist_dir, exist_ok=True)
+        to_cpu = lambda x: None if x is None else x.cpu()
+        torch.save({'session_id': self.session_id,
+                    'x_inter': to_cpu(self.x_inter),
+                    'pred_x0': to_cpu(self.pred_x0),
+                    'camera_align': self.camera_align,
+                    'traj_align': self.traj_align}, self.path)
+
+    def load(self, device=None):
+        if self.path is None or not os.path.exists(self.path):
+            return self
+        data = torch.load(self.path, map_location='cpu')
+        to_device = lambda x: None if x is None else x.to(device)
+        self.x_inter = to_device(data['x_inter'])
+        self.pred_x0 = to_device(data['pred_x0'])
+        self.camera_align = data['camera_align']
+        self.traj_align = data['traj_align']
+        return self
+
+
+def edit_within(before, after, tolerance):
+    """ whether two camera pose / point arrays (or both None) differ by at most `tolerance` in every entry """
+    if before is None or after is None:
+        return before is None and after is None
+    before, after = np.asarray(before, dtype=np.float64), np.asarray(after, dtype=np.float64)
+    return before.shape == after.shape and float(np.abs(before - after).max(initial=0.)) <= tolerance
+
+
+class ContinuationStateStore(object):
+    """
+    Process-wide LRU map of session id -> ContinuationState, so concurrent sessions never share continuation
+    state. Sessions come and go with their clients (a turbo room per browser tab), so the store forgets the least
+    recently used ones beyond `max_sessions` and those idle for more than `idle_seconds`; the session just
+    requested is never evicted. A forgotten session starts over, or from its persisted state.
+    :param persist_dir: if set, states are also written there after every update and reloaded on first use,
+                        e.g. to continue a video after a restart.
+    :param max_sessions: maximum number of sessions kept in memory, None for no count limit.
+    :param idle_seconds: sessions not requested for that long are forgotten, None to keep them.
+    """
+    def __init__(self, persist_dir=None, max_sessions=16, idle_seconds=3600, clock=time.monotonic):
+        self.persist_dir = persist_dir
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self.clock = clock
+        self.states = OrderedDict()  # session id -> (state, last use)
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def get(self, session_id=DEFAULT_SESSION, device=None):
+        session_id = session_id or DEFAULT_SESSION
+        with self.lock:
+            if session_id in self.states:
+                state = self.states.pop(session_id)[0]
+            else:
+                state = ContinuationState(session_id, self.persist_dir).load(device)
+            self.states[session_id] = (state, self.clock())
+            self._shrink()
+            return state
+
+    def _shrink(self):
+        now = self.clock()
+        # oldest first, the last entry is the session just requested
+        while len(self.states) > 1:
+            session_id, (_, last_use) = next(iter(self.states.items()))
+            idle = self.idle_seconds is not None and now - last_use > self.idle_seconds
+            if not idle and (self.max_sessions is None or len(self.states) <= self.max_sessions):
+                break
+            # only forgotten here: a running workflow may still hold the state, its persisted file stays
+            del self.states[session_id]
+            self.evictions += 1
+
+    def drop(self, session_id):
+        with self.lock:
+            entry = self.states.pop(session_id, None)
+        if entry is not None:
+            entry[0].reset()
+
+
+_store = None
+
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def get_continuation_store():
+    """
+    The shared store. MOTIONCTRL_STATE_DIR optionally enables disk persistence, MOTIONCTRL_STATE_SESSIONS
+    (default 16) and MOTIONCTRL_STATE_IDLE_SECONDS (default 3600) bound the sessions kept in memory.
+    """
+    global _store
+    if _store is None:
+        _store = ContinuationStateStore(persist_dir=os.environ.get('MOTIONCTRL_STATE_DIR') or None,
+                                        max_sessions=_env_int('MOTIONCTRL_STATE_SESSIONS', 16),
+                                        idle_seconds=_env_int('MOTIONCTRL_STATE_IDLE_SECONDS', 3600))
+    return _store
@@ -0,0 +1,80 @@
+"""
+Cheap previews of the denoised estimate pred_x0 while sampling, so a bad generation can be stopped after a few
+steps instead of paying for all of them. A preview shows the first sample of the batch as a grid of its frames.
+"""
+import math
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+PREVIEW_MODES = ['off', 'latent2rgb', 'vae']
+
+# linear map of the 4 SD 1.x latent channels (scaled by scale_factor) to RGB in [-1, 1], the one of ComfyUI's
+# Latent2RGB previewer
+LATENT_RGB_FACTORS = [
+    [0.3512, 0.2297, 0.3227],
+    [0.3250, 0.4974, 0.2350],
+    [-0.2829, 0.1762, 0.2721],
+    [-0.2120, -0.2616, -0.7177],
+]
+
+
+def latent_to_rgb(z):
+    """ latents [c,t,h,w] -> uint8 frames [t,h,w,3] at latent resolution, no decoder """
+    factors = torch.tensor(LATENT_RGB_FACTORS, dtype=torch.float32, device=z.device)
+    rgb = torch.einsum('cthw,cr->thwr', z.float(), factors)
+    return ((rgb + 1.) / 2.).clamp(0, 1).mul(255).to(torch.uint8).cpu()
+
+
+def decode_preview(model, z, max_frames=4, downscale=2):
+    """
+    latents [c,t,h,w] -> uint8 frames [t',h',w',3] by the VAE: at most `max_frames` evenly spaced frames, decoded
+    from latents downscaled by `downscale`
+    """
+    stride = max(1, math.ceil(z.shape[1] / max_frames))
+    frames = z[:, ::stride].transpose(0, 1)  # t',c,h,w
+    if downscale > 1:
+        frames = F.interpolate(frames.float(), scale_factor=1. / downscale, mode='bilinear', align_corners=False)
+    frames = frames.to(z.dtype).transpose(0, 1)[None]
+    video = model.decode_first_stage(frames, frame_chunk=frames.shape[2])[0]  # c,t',h',w'
+    return ((video.permute(1, 2, 3, 0) + 1.) / 2.).clamp(0, 1).mul(255).to(torch.uint8).cpu()
+
+
+def preview_grid(frames):
+    """ uint8 frames [t,h,w,3] -> one PIL image, frames in rows of ceil(sqrt(t)) """
+    t, h, w, _ = frames.shape
+    cols = math.ceil(math.sqrt(t))
+    rows = math.ceil(t / cols)
+    grid = np.zeros((rows * h, cols * w, 3), dtype=np.uint8)
+    for i, frame in enumerate(frames.numpy()):
+        r, c = divmod(i, cols)
+        grid[r*h:(r+1)*h, c*w:(c+1)*w] = frame
+    return Image.fromarray(grid)
+
+
+class SamplingPreview(object):
+    """
+    `img_callback(pred_x0, i)` of the samplers: calls `on_step(step, steps, image)` after every step, `image` is a
+    preview of pred_x0 every `every` steps (but the last, which gets decoded anyway) and None otherwise.
+    """
+    def __init__(self, model, steps, on_step, mode='latent2rgb', every=5):
+        assert mode in PREVIEW_MODES, f"preview should be one of {PREVIEW_MODES}, got {mode}"
+        self.model = model
+        self.steps = steps
+        self.on_step = on_step
+        self.mode = mode
+        self.every = max(1, every)
+
+    def preview(self, pred_x0):
+        z = pred_x0[0].detach()
+        frames = latent_to_rgb(z) if self.mode == 'latent2rgb' else decode_preview(self.model, z)
+        return preview_grid(frames)
+
+    def __call__(self, pred_x0, i):
+        step = min(i + 1, self.steps)
+        image = None
+        if self.mode != 'off' and step % self.every == 0 and step < self.steps:
+            image = self.preview(pred_x0)
+        self.on_step(step, self.steps, image)
@@ -0,0 +1,128 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+def module_nbytes(module):
+    """ bytes held by the parameters & buffers of a module """
+    total = 0
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        total += tensor.numel() * tensor.element_size()
+    return total
+
+
+def checkpoint_signature(ckpt_path):
+    """ (realpath, mtime) of a checkpoint, so a file replaced on disk is not served from the cache """
+    ckpt_path = os.path.realpath(ckpt_path)
+    return ckpt_path, os.path.getmtime(ckpt_path)
+
+
+class ModelRegistry(object):
+    """
+    Process-wide LRU cache of built & loaded models.
+    Entries are keyed by (checkpoint realpath, checkpoint mtime, *extra) where extra holds
+    everything else that changes the built module (temporal_length, config, device, ...).
+    :param max_bytes: memory budget for all cached models, None for no byte limit.
+    :param max_models: maximum number of cached models, None for no count limit.
+    The most recently used model is never evicted, even if it alone exceeds the budget.
+    """
+    def __init__(self, max_bytes=None, max_models=2):
+        self.max_bytes = max_bytes
+        self.max_models = max_models
+        self.entries = OrderedDict()  # key -> (model, nbytes)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    @property
+    def total_bytes(self):
+        return sum(nbytes for _, nbytes in self.entries.values())
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'models': len(self.entries),
+                'bytes': self.total_bytes,
+            }
+
+    def get(self, ckpt_path, build_fn, *extra):
+        """
+        Return the cached model for `ckpt_path` + `extra`, or call `build_fn()` to create it.
+        """
+        ckpt_path, mtime = checkpoint_signature(ckpt_path)
+        key = (ckpt_path, mtime) + tuple(extra)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                print(f'>>> model registry hit: {ckpt_path} {extra} {self.stats()}')
+                return self.entries[key][0]
+
+            self.misses += 1
+            # an older version of the same checkpoint can never be hit again
+            for stale_key in [k for k in self.entries if k[0] == ckpt_path and k[1] != mtime]:
+                self._evict(stale_key)
+            # make room before building, estimated from the checkpoint size
+            self._shrink(reserve_bytes=os.path.getsize(ckpt_path), reserve_models=1)
+
+            model = build_fn()
+            # stable across processes, used to key caches derived from this model
+            model.cache_identity = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+            self.entries[key] = (model, module_nbytes(model))
+            self._shrink()
+            print(f'>>> model registry miss: {ckpt_path} {extra} {self.stats()}')
+            return model
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries.keys()):
+                self._evict(key)
+
+    def _over_budget(self, reserve_bytes=0, reserve_models=0):
+        if self.max_models is not None and len(self.entries) + reserve_models > self.max_models:
+            return True
+        if self.max_bytes is not None and self.total_bytes + reserve_bytes > self.max_bytes:
+            return True
+        return False
+
+    def _shrink(self, reserve_bytes=0, reserve_models=0):
+        # keep the most recent entry when nothing is being reserved for a new one
+        min_entries = 0 if reserve_models else 1
+        while len(self.entries) > min_entries and self._over_budget(reserve_bytes, reserve_models):
+            self._evict(next(iter(self.entries)))
+
+    def _evict(self, key):
+        model, _ = self.entries.pop(key)
+        self.evictions += 1
+        del model
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+def _env_int(name):
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
+_registry = None
+
+
+def get_model_registry():
+    """
+    The shared registry. Budget is read once from the environment:
+    MOTIONCTRL_MODEL_CACHE_MB (memory budget) and MOTIONCTRL_MODEL_CACHE_SIZE (model count, default 2).
+    """
+    global _registry
+    if _registry is None:
+        max_mb = _env_int('MOTIONCTRL_MODEL_CACHE_MB')
+        max_models = _env_int('MOTIONCTRL_MODEL_CACHE_SIZE')
+        _registry = ModelRegistry(max_bytes=None if max_mb is None else max_mb * 1024 * 1024,
+                                  max_models=2 if max_models is None else max_models)
+    return _registry